@@ -31,8 +31,34 @@ config["dropout_rate"] = 0.35
 config["dropout_rate_speed"] = 0.25
 config["dropout_rate_dir"] = 0.35
 config["final_skip_connection"] = True
-config["distribution_strategy"] = None
+config["distribution_strategy"] = None  # None, "MirroredStrategy" or "Horovod"
+config["cluster_resolver"] = "slurm"  # MirroredStrategy: "slurm" or "tf_config" (see utils_bc/local_launcher.py)
+config["communication_implementation"] = "NCCL"  # MirroredStrategy: "NCCL" (GPU), "RING" or "AUTO"
 config["prefetch"] = "auto"
+# tf.data pipelines: cache (None, "memory" or file path), shuffle_buffer, seed, num_parallel_calls,
+# deterministic, drop_remainder, autotune_ram_budget (bytes), prefetch.
+# Caching is opt-in: cached elements include one topography map per row ("memory" can take tens of GB)
+config["pipeline_train"] = {"cache": None,
+                            "shuffle_buffer": None,
+                            "num_parallel_calls": "auto",
+                            "deterministic": True,
+                            "drop_remainder": False,
+                            "autotune_ram_budget": None,
+                            "prefetch": True}
+config["pipeline_val"] = {"cache": None,
+                          "num_parallel_calls": "auto",
+                          "prefetch": True}
+# Stream prepared splits from sharded TFRecord files exported with CustomDataHandler.export_tfrecords.
+# Splits are exported again when the data configuration changes (path_experiences/tfrecords/<hash of the config>)
+config["use_tfrecords"] = False
+config["tfrecords_nb_shards"] = 16
+config["tfrecords_compression"] = None  # None or "GZIP"
+# Uncentered topographies: 140 x 140 windows shifted from the center of 280 x 280 maps
+config["random_idx"] = False
+config["random_idx_per_epoch"] = True  # New training offsets at each epoch, cropped in the graph
+config["random_idx_seed"] = 42
+config["random_idx_min"] = -25
+config["random_idx_max"] = 25
 
 # Skip connections in dense network
 config["dense_with_skip_connection"] = False
@@ -44,6 +70,39 @@ config["epochs_speed"] = 10
 config["epochs_dir"] = 5
 config["learning_rate_speed"] = 0.001
 config["learning_rate_dir"] = 0.001
+# double_ann: fit speed and direction heads in a single fit (pipeline/7_double_v1.py)
+config["joint_training_speed_dir"] = False
+config["loss_weights_speed_dir"] = [1.0, 1.0]
+# Custom training loop (train/training_loop.py) instead of model.fit
+config["custom_training_loop"] = False
+config["jit_compile"] = False
+config["gradient_accumulation_steps"] = 1
+config["steps_per_execution"] = 1
+config["log_every_n_executions"] = 10  # Data wait / compute timings written to TensorBoard
+config["tf_profiler"] = False  # tf.profiler trace of fit_with_strategy in the TensorBoard logs
+# Resumable training (train/checkpointing.py): weights, optimizer, epoch, step, random generator and, with the
+# custom training loop, tf.data iterator state. Set resume_experience to the name of an interrupted experience
+config["resumable_checkpoints"] = False
+config["checkpoint_every_n_steps"] = 1000
+config["checkpoint_max_to_keep"] = 2
+config["resume_experience"] = False
+config["deterministic_training"] = False
+config["training_seed"] = 42
+# Incremental fine-tuning (train/incremental.py) on the rows observed after the last date seen by an experience
+config["incremental_start_date"] = None  # None: data_end_date of the previous experience
+config["incremental_epochs"] = 2
+config["incremental_learning_rate_factor"] = 0.1
+config["incremental_replay_ratio"] = 1.0  # Older rows replayed per new train row
+config["incremental_seed"] = 42
+# Hyperparameter sweep (train/sweep.py)
+config["sweep_workers"] = None  # None: available cores // sweep_threads_per_trial
+config["sweep_threads_per_trial"] = 1
+config["sweep_cpu_only"] = True
+config["sweep_monitor"] = "val_loss"
+config["sweep_pruning_warmup_epochs"] = 2  # Trials are not stopped before this number of epochs
+config["sweep_pruning_min_trials"] = 3  # Nor before this number of other trials reached the same epoch
+# Headless figure rendering (train/figure_jobs.py), see FIGURE_POOL in pipeline/7_double_v1.py
+config["figure_pool_workers"] = None  # None: available cores
 
 # Optimizer
 config["optimizer"] = "Adam"
@@ -141,7 +200,8 @@ config["kwargs_callbacks"] = {"ReduceLROnPlateau": {"monitor": "val_loss",
                               "LearningRateWarmupCallback": {"warmup_epochs": 5,
                                                              "verbose": 1},
 
-                              "FeatureImportanceCallback": {},
+                              "FeatureImportanceCallback": {"n_repeats": 1,
+                                                            "batch_size": 1024},
 
                               "BroadcastGlobalVariablesCallback": {},
 
@@ -156,10 +216,13 @@ config["kwargs_callbacks"] = {"ReduceLROnPlateau": {"monitor": "val_loss",
 
 # Metrics
 config["metrics"] = ["tf_mae", "tf_rmse", "tf_mbe"]
+# Quantile sketches of the streaming evaluation (pipeline/streaming_eval_double_v1.py): QQ plots and quantile tables
+config["quantile_sketch_k"] = 200
 
 # Split
 config["split_strategy_test"] = "time_and_space"  # "time", "space", "time_and_space", "random"
 config["split_strategy_val"] = "time_and_space"
+config["index_split"] = False  # Split on row positions and materialize each mode once
 
 # Random split
 config["random_split_state_test"] = 50  # Float. Default = 50
@@ -174,6 +237,10 @@ config["parameters_split_test"] = ["alti", "tpi_500_NN_0", "mu_NN_0", "laplacian
 config["parameters_split_val"] = ["alti", "tpi_500_NN_0"]
 config["country_to_reject_during_training"] = ["pyr", "corse"]
 config["metric_split"] = "rmse"
+config["stations_forced_in_test"] = ["Col du Lac Blanc"]
+config["split_search_candidates"] = 256  # Number of random candidate splits scored when stations are "random"
+config["split_search_seed"] = 42
+config["split_search_workers"] = 1
 
 # Space split
 config["stations_test"] = ['Col du Lac Blanc', 'GOE', 'WAE', 'TGKAL', 'LAG', 'AND', 'CHU', 'SMM', 'ULR', 'WFJ', 'TICAM',
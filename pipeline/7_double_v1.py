@@ -34,8 +34,9 @@ from bias_correction.train.config_handler import PersistentConfig
 from bias_correction.train.windrose import plot_windrose
 from bias_correction.utils_bc.context_manager import timer_context
 from bias_correction.utils_bc.print_functions import print_intro, print_headline
-from bias_correction.train.visu import save_figure
+from bias_correction.train.visu import save_figure, compute_evolution_table
 from bias_correction.train.dataframe_computer import classify_topo_carac
+from bias_correction.train.figure_jobs import FigureJobPool, get_figure_columns
 
 ALE = False
 ALE_TWO_VARIABLES = False
@@ -49,10 +50,17 @@ BOXPLOTS = True
 QQ_DOUBLE = False
 PARTIAL_DEPENDENCE = False
 PARTIAL_DEPENDENCE_DELTA = False
+# Render the 1-1, windrose, seasonal evolution, lead time and boxplot figures in a pool of headless workers
+FIGURE_POOL = False
 
 # Initialization
 persistent_config = PersistentConfig(config)
-if config["restore_experience"]:
+if config.get("resume_experience", False):
+    # Fits of an interrupted experience restart from their checkpoints, completed fits are skipped
+    print_headline("Resume experience", "")
+    exp, config = ExperienceManager.from_previous_experience(config["resume_experience"])
+    config["restore_experience"] = False
+elif config["restore_experience"]:
     print_headline("Restore experience", "")
     exp, config = ExperienceManager.from_previous_experience(config["restore_experience"])
     cm = CustomModel.from_previous_experience(exp, config, "last")
@@ -70,7 +78,35 @@ print(pprint(config), flush=True)
 
 print_headline("Launch training direction", "")
 
-if not config["restore_experience"]:
+if not config["restore_experience"] and config.get("joint_training_speed_dir", False):
+    #
+    #
+    # Single fit of speed and direction heads
+    #
+    #
+    print_headline("Launch training speed and direction", "")
+
+    # Config
+    config_speed_and_dir = persistent_config.config_fit_speed_and_dir(config)
+
+    # Model
+    cm = CustomModel(exp, config_speed_and_dir)
+    cm.build_model_with_strategy()
+    print(cm)
+
+    # Data
+    with timer_context("Prepare data"):
+        data_loader = CustomDataHandler(config_speed_and_dir)
+        data_loader.prepare_train_test_data()
+
+    # Fit
+    with tf.device('/GPU:0'), timer_context("fit"):
+        _ = cm.fit_with_strategy(data_loader.get_batched_inputs_labels(mode="train"),
+                                 dataloader=data_loader,
+                                 mode_callback="train")
+        exp.save_model(cm)
+
+elif not config["restore_experience"]:
     #
     #
     # First fit
@@ -260,7 +296,91 @@ for type_of_output, metrics, label in zip(["output_speed", "output_direction"],
         else:
             c_eval_other_countries.df2ae_dir(print_=True)
 
-    if ONE_PLOTS:
+    if FIGURE_POOL:
+        figure_pool = FigureJobPool(exp, nb_workers=config.get("figure_pool_workers"))
+        keys = (f'{cv}_AROME', f'{cv}_D', f'{cv}_nn', f'{cv}_int', f'{cv}_A', f'{cv}_DA')
+        dict_keys = {"_D": "DEVINE",
+                     "_AROME": "$AROME_{forecast}$",
+                     "_nn": "Neural Network + DEVINE",
+                     "_int": "Neural Network",
+                     "_A": "$AROME_{analysis}$",
+                     "_DA": "$AROME_{analysis}$ + DEVINE"
+                     }
+
+        if ONE_PLOTS and type_of_output == "output_speed":
+            figure_pool.add(f"1_1_all_{model}_{cv}", "plot_1_1_all", c_eval.df_results,
+                            columns=["name", f"{cv}_obs"] + list(keys),
+                            keys=keys,
+                            color=("C1", "C0", "C2", "C3", "C4", "C5"),
+                            name=f"1_1_all_{model}_{cv}",
+                            plot_text=False,
+                            fontsize=20,
+                            density=True,
+                            xlabel="Observed wind speed \n[$m\:s^{-1}$]",
+                            ylabel="Modeled wind speed \n[$m\:s^{-1}$]")
+
+        if WINDROSE and type_of_output == "output_direction":
+            figure_pool.add(f"wind_direction_all_{model}_{cv}", "plot_wind_direction_all", c_eval.df_results,
+                            columns=get_figure_columns(c_eval.df_results, ("abs_bias_direction",), keys,
+                                                       extra_columns=list(keys)),
+                            keys=keys,
+                            metrics=("abs_bias_direction",),
+                            name=f"wind_direction_all_2023_01_30_v0")
+
+        if SEASONAL_EVOLUTION:
+            figure_pool.add(f"Seasonal_evolution_{model}_{cv}", "plot_seasonal_evolution", c_eval.df_results,
+                            columns=get_figure_columns(c_eval.df_results, metrics, keys, extra_columns=()),
+                            keys=keys,
+                            metrics=metrics,
+                            name=f"Seasonal_evolution_{model}_{cv}",
+                            errorbar="sd",
+                            yerr=False)
+
+        if LEAD_TIME:
+            figure_pool.add(f"Lead_time_{model}_{cv}", "plot_lead_time", c_eval.df_results,
+                            columns=get_figure_columns(c_eval.df_results, metrics, keys, extra_columns=("lead_time",)),
+                            keys=keys,
+                            color=("C1", "C0", "C2", "C3", "C4", "C5"),
+                            metrics=metrics,
+                            name=f"Lead_time_{model}_{cv}",
+                            yerr=True)
+
+        for list_x, name_shadow, flag in [(('month',), "SeasonalEvolution_no_errorbar", SEASONAL_EVOLUTION),
+                                          (('lead_time',), "LeadTime_no_errorbar", LEAD_TIME)]:
+            if flag:
+                figure_pool.add(f"{name_shadow}_{model}_{cv}", "plot_lead_time_shadow", c_eval.df_results,
+                                columns=get_figure_columns(c_eval.df_results, metrics, keys),
+                                metrics=metrics,
+                                list_x=list_x,
+                                dict_keys=dict_keys,
+                                figsize=(15, 10),
+                                name=name_shadow,
+                                errorbar=None,
+                                fontsize=20)
+
+        if BOXPLOTS:
+            c_eval.df_results = classify_topo_carac(data_loader.get_stations(),
+                                                    c_eval.df_results,
+                                                    config=config)
+            topo_carac = ('mu', 'curvature', 'tpi_500', 'tpi_2000', 'laplacian', 'alti')
+            figure_pool.add(f"Boxplot_topo_carac_{model}_{cv}", "plot_boxplot_topo_carac", c_eval.df_results,
+                            columns=get_figure_columns(c_eval.df_results, metrics, keys,
+                                                       extra_columns=["name"] + [f"class_{c}" for c in topo_carac]),
+                            name=f"Boxplot_topo_carac_{model}_{cv}",
+                            dict_keys={key: value for key, value in dict_keys.items() if key != "_DA"},
+                            hue_order=("$AROME_{forecast}$",
+                                       "DEVINE",
+                                       "Neural Network",
+                                       "Neural Network + DEVINE",
+                                       "$AROME_{analysis}$",
+                                       ),
+                            palette=("C1", "C0", "C3", "C2", "C4"),
+                            metrics=metrics)
+
+        with timer_context("Figure pool"):
+            print(figure_pool.run().sort_values("seconds", ascending=False).to_string(index=False), flush=True)
+
+    if ONE_PLOTS and not FIGURE_POOL:
         if type_of_output == "output_speed":
             try:
                 with timer_context("1-1 plots"):
@@ -284,7 +404,7 @@ for type_of_output, metrics, label in zip(["output_speed", "output_direction"],
             except Exception as e:
                 print(f"\nWARNING Exception for 1-1 plots: {e}", flush=True)
 
-    if WINDROSE:
+    if WINDROSE and not FIGURE_POOL:
         if type_of_output == "output_direction":
             try:
                 with timer_context("plot_wind_direction_all"):
@@ -302,7 +422,15 @@ for type_of_output, metrics, label in zip(["output_speed", "output_direction"],
             except Exception as e:
                 print(f"\nWARNING Exception for plot_wind_direction_all: {e}", flush=True)
 
-    if SEASONAL_EVOLUTION:
+    if (SEASONAL_EVOLUTION or LEAD_TIME) and not FIGURE_POOL:
+        # Means and standard deviations by model, metric, station, month and lead time, shared by the plots below
+        with timer_context("Evolution table"):
+            evolution_table = compute_evolution_table(c_eval.df_results,
+                                                      metrics,
+                                                      keys=(f'{cv}_AROME', f'{cv}_D', f'{cv}_nn', f'{cv}_int', f'{cv}_A',
+                                                            f'{cv}_DA'))
+
+    if SEASONAL_EVOLUTION and not FIGURE_POOL:
         try:
             with timer_context("Seasonal evolution"):
                 c_eval.plot_seasonal_evolution(c_eval.df_results,
@@ -311,7 +439,8 @@ for type_of_output, metrics, label in zip(["output_speed", "output_direction"],
                                                name=f"Seasonal_evolution_{model}_{cv}",
                                                errorbar="sd",
                                                yerr=False,
-                                               print_=True)
+                                               print_=True,
+                                               table=evolution_table)
                 # c_eval.plot_seasonal_evolution_by_station(c_eval.df_results,
                 #                                          keys=(f'{cv}_AROME', f'{cv}_D', f'{cv}_nn', f'{cv}_int', f'{cv}_A'),
                 #                                          metrics=metrics,
@@ -336,11 +465,12 @@ for type_of_output, metrics, label in zip(["output_speed", "output_direction"],
                                          name="SeasonalEvolution_no_errorbar",
                                          errorbar=None,
                                          print_=False,
-                                         fontsize=20)
+                                         fontsize=20,
+                                         table=evolution_table)
         except Exception as e:
             print(f"\nWARNING Exception for seasonal evolution similar to lead time sd: {e}", flush=True)
 
-    if LEAD_TIME:
+    if LEAD_TIME and not FIGURE_POOL:
         try:
             with timer_context("Lead time"):
                 c_eval.plot_lead_time(c_eval.df_results,
@@ -349,7 +479,8 @@ for type_of_output, metrics, label in zip(["output_speed", "output_direction"],
                                       metrics=metrics,
                                       name=f"Lead_time_{model}_{cv}",
                                       print_=True,
-                                      yerr=True)
+                                      yerr=True,
+                                      table=evolution_table)
         except Exception as e:
             print(f"\nWARNING Exception for Lead time: {e}", flush=True)
 
@@ -368,11 +499,12 @@ for type_of_output, metrics, label in zip(["output_speed", "output_direction"],
                                          name="LeadTime_no_errorbar",
                                          errorbar=None,
                                          print_=False,
-                                         fontsize=20)
+                                         fontsize=20,
+                                         table=evolution_table)
         except Exception as e:
             print(f"\nWARNING Exception for Lead time sd: {e}", flush=True)
 
-    if BOXPLOTS:
+    if BOXPLOTS and not FIGURE_POOL:
         c_eval.df_results = classify_topo_carac(data_loader.get_stations(),
                                                 c_eval.df_results,
                                                 config=config)
@@ -597,4 +729,5 @@ for type_of_output, metrics, label in zip(["output_speed", "output_direction"],
                                           nb_points=10,
                                           ylim=(-180, 110),
                                           name="Delta_partial_dependence_plot_2022_01_19_v0")
+exp.save_profiling()
 print_intro()
@@ -0,0 +1,37 @@
+import subprocess
+import sys
+
+modules = ["bias_correction.train.metrics",
+           "bias_correction.train.dataframe_computer",
+           "bias_correction.train.dataloader",
+           "bias_correction.train.experience_manager",
+           "bias_correction.train.eval",
+           "bias_correction.train.model",
+           "bias_correction.pre_process.stations",
+           "bias_correction.pre_process.time_series"]
+
+heavy_modules = ["tensorflow", "tensorflow_addons", "horovod", "matplotlib", "seaborn", "sklearn"]
+
+# Each module is imported in a fresh interpreter so that the timings are not affected by the import cache
+code = """
+import sys
+import time
+t0 = time.perf_counter()
+import {module}
+t1 = time.perf_counter()
+heavy = [name for name in {heavy_modules} if name in sys.modules]
+print(f"{{t1 - t0:.2f}}s", ", ".join(heavy) if heavy else "-")
+"""
+
+if __name__ == "__main__":
+    print(f"{'module':45s} {'import time':12s} heavy dependencies loaded", flush=True)
+    for module in modules:
+        result = subprocess.run([sys.executable, "-c", code.format(module=module, heavy_modules=heavy_modules)],
+                                capture_output=True,
+                                text=True)
+        if result.returncode != 0:
+            error = result.stderr.strip().split("\n")[-1]
+            print(f"{module:45s} failed: {error}", flush=True)
+            continue
+        duration, heavy = result.stdout.strip().split(" ", 1)
+        print(f"{module:45s} {duration:12s} {heavy}", flush=True)
@@ -0,0 +1,24 @@
+from bias_correction.train.dataloader import CustomDataHandler
+from bias_correction.config.config_double_v1 import config
+
+# Steps/sec of the training pipeline for several tf.data configurations (no model is trained)
+configurations = {"baseline": {"prefetch": True},
+                  "parallel_batch": {"num_parallel_calls": "auto", "prefetch": True},
+                  "memory_cache": {"cache": "memory", "num_parallel_calls": "auto", "prefetch": True},
+                  "memory_cache_shuffle": {"cache": "memory", "shuffle_buffer": 10_000, "seed": 42,
+                                           "num_parallel_calls": "auto", "prefetch": True},
+                  "non_deterministic": {"cache": "memory", "shuffle_buffer": 10_000, "seed": 42,
+                                        "num_parallel_calls": "auto", "deterministic": False,
+                                        "drop_remainder": True, "prefetch": True},
+                  "ram_budget_4gb": {"cache": "memory", "shuffle_buffer": 10_000, "seed": 42,
+                                     "num_parallel_calls": "auto", "deterministic": False,
+                                     "drop_remainder": True, "autotune_ram_budget": 4 * 1024 ** 3,
+                                     "prefetch": True}}
+
+if __name__ == "__main__":
+    data_loader = CustomDataHandler(config)
+    data_loader.prepare_train_test_data()
+    df_results = data_loader.batcher.benchmark_pipelines(lambda: data_loader.get_tf_zipped_inputs_labels(mode="train"),
+                                                         configurations,
+                                                         nb_steps=config.get("benchmark_nb_steps", 200))
+    print(df_results, flush=True)
@@ -0,0 +1,17 @@
+import sys
+
+from bias_correction.config.config_double_v1 import config
+from bias_correction.train.incremental import IncrementalTrainer
+
+# Monthly update: fine-tune the last experience on the observations it has not seen
+# python incremental_double_v1.py 2023_1_5_labia_v2 [start date]
+if __name__ == "__main__":
+    config_updates = {key: config[key] for key in ["incremental_epochs",
+                                                   "incremental_learning_rate_factor",
+                                                   "incremental_replay_ratio",
+                                                   "incremental_seed"]}
+    if len(sys.argv) > 2:
+        config_updates["incremental_start_date"] = sys.argv[2]
+    trainer = IncrementalTrainer(sys.argv[1], config_updates=config_updates)
+    exp, cm, data_loader = trainer.fit()
+    print(f"Fine-tuned {trainer.previous_exp.name_current_experience} in {exp.name_current_experience}", flush=True)
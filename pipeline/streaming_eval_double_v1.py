@@ -0,0 +1,61 @@
+import numpy as np
+
+import os
+import sys
+
+from bias_correction.config.config_double_v1 import config
+from bias_correction.train.model import CustomModel
+from bias_correction.train.dataloader import CustomDataHandler
+from bias_correction.train.experience_manager import ExperienceManager
+from bias_correction.train.config_handler import PersistentConfig
+from bias_correction.train.eval import StreamingEvaluation
+from bias_correction.utils_bc.context_manager import timer_context
+from bias_correction.utils_bc.print_functions import print_headline
+
+# Metric tables, quantile tables and QQ plots of a trained experience computed while predictions are streamed
+# (no df_results)
+# python streaming_eval_double_v1.py 2023_1_5_labia_v2
+groupbys = (None, "name", "month", "lead_time", "class_alti0", "class_mu", "class_tpi_500")
+quantiles = np.round(np.linspace(0, 1, 101), 2)
+
+if __name__ == "__main__":
+    exp, config = ExperienceManager.from_previous_experience(sys.argv[1] if len(sys.argv) > 1
+                                                             else config["restore_experience"])
+    config_predict_speed = PersistentConfig(config).config_predict_parser("output_speed", config)
+
+    cm = CustomModel(exp, config_predict_speed)
+    cm.build_model_with_strategy(print_=False)
+    cm.model.load_weights(cm.exp.path_to_last_model)
+    cm.model_version = "last"
+
+    with timer_context("Prepare data"):
+        data_loader = CustomDataHandler(config_predict_speed)
+        data_loader.prepare_train_test_data()
+
+    print_headline("Streaming evaluation", "test")
+    with timer_context("StreamingEvaluation"):
+        c_eval = StreamingEvaluation(exp,
+                                     data_loader,
+                                     cm,
+                                     mode="test",
+                                     groupbys=groupbys,
+                                     quantile_sketch_k=config.get("quantile_sketch_k", 200)).run()
+
+    for groupby in groupbys:
+        name = c_eval.get_groupby_name(groupby)
+        c_eval.df2grouped_metrics(groupby).to_csv(os.path.join(exp.path_to_current_experience,
+                                                               f"metrics_by_{name}.csv"),
+                                                  index=False)
+        c_eval.df2quantiles(quantiles, groupby).to_csv(os.path.join(exp.path_to_current_experience,
+                                                                    f"quantiles_by_{name}.csv"),
+                                                       index=False)
+
+    # QQ plots from the sketches of the streaming pass: all stations, then by elevation category
+    c_eval.qq_sketches(c_eval.get_sketches(), name_figure="qq_plot_streaming_test")
+    for idx, group in enumerate(c_eval.accumulators["class_alti0"].group_ids):
+        print(f"QQ plot class_alti0 {idx}: {group[0]}", flush=True)
+        c_eval.qq_sketches(c_eval.get_sketches("class_alti0", group),
+                           name_figure=f"qq_plot_streaming_test_class_alti0_{idx}")
+
+    mae, rmse, mbe, corr = c_eval.print_stats()
+    exp.save_results(c_eval, mae, rmse, mbe, corr)
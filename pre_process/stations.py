@@ -2,6 +2,7 @@ import numpy as np
 from scipy.spatial import cKDTree
 
 from bias_correction.pre_process.topo_characteristics import TopoCaracteristics
+from bias_correction.utils_bc.instrumentation import profiled
 
 
 class Stations(TopoCaracteristics):
@@ -79,6 +80,7 @@ class Stations(TopoCaracteristics):
         assert "X_L93" in nwp, "NWP need to have projected coordinates"
         assert "Y_L93" in nwp, "NWP need to have projected coordinates"
 
+    @profiled
     def update_stations_with_knn_from_nwp(self,
                                           interpolated=False):
         """
@@ -165,6 +167,7 @@ class Stations(TopoCaracteristics):
 
             self.stations.loc[self.stations["country"] == country] = stations_i
 
+    @profiled
     def update_stations_with_knn_from_mnt_using_ckdtree(self):
         """
         Add columns to stations: 'X_L93_AROME_NN_0', 'Y_L93_AROME_NN_0', 'delta_x_AROME_NN_0'
@@ -201,6 +204,7 @@ class Stations(TopoCaracteristics):
                 self.stations.loc[filter_country, [str_y_l93]] = nn_l93[neighbor, :, 1]
                 self.stations.loc[filter_country, [str_delta_x]] = nn_delta_x[neighbor, :]
 
+    @profiled
     def update_stations_with_knn_of_nwp_in_mnt_using_ckdtree(self,
                                                              interpolated=False):
 
@@ -393,6 +397,7 @@ class Stations(TopoCaracteristics):
         projected_points = [point for point in gps_to_l93_func.itransform([(lon, lat)])][0]
         return projected_points
 
+    @profiled
     def convert_lat_lon_to_l93(self):
         """
         Convert lat/lon in stations to L93
@@ -411,6 +416,7 @@ class Stations(TopoCaracteristics):
         self.stations.loc[filter_nan, ["X"]] = x_list
         self.stations.loc[filter_nan, ["Y"]] = y_list
 
+    @profiled
     def interpolate_nwp(self):
         self.nwp_france = self.interpolate_wind_grid_xarray(self.nwp_france.isel(time=slice(0, 2)),
                                                             interp=self.config["interp"],
@@ -435,6 +441,7 @@ class Stations(TopoCaracteristics):
                                                                verbose=self.config["verbose"])
             print("Interpolation not computed on nwp_corse (nwp_corse is None)")
 
+    @profiled
     def change_dtype_stations(self, analysis=False):
         """
         Change the dtype for each column of the DataFrame.
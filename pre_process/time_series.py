@@ -10,6 +10,7 @@ logger.setLevel(logging.DEBUG)
 
 from downscale.operators.wind_utils import Wind_utils
 from downscale.operators.interpolation import Interpolation
+from bias_correction.utils_bc.instrumentation import profiled
 
 
 class TimeSeries(Interpolation):
@@ -23,6 +24,7 @@ class TimeSeries(Interpolation):
         self.config = config
         self.interpolated = interpolated
 
+    @profiled
     def keep_minimal_variables(self):
         variables_to_return = ['date', 'name', 'T2m(degC)', 'vw10m(m/s)', 'winddir(deg)', 'HTN(cm)']
         if "qc" in self.time_series.columns:
@@ -66,6 +68,7 @@ class TimeSeries(Interpolation):
                                                  method=self.config["method"],
                                                  verbose=self.config["verbose"])
 
+    @profiled
     def add_arome_variables(self):
 
         if self.config["network"] == "local":
@@ -119,6 +122,7 @@ class TimeSeries(Interpolation):
                     self._add_AROME_variable_station(station, str_x, str_y, variables, filter_time, nwp)
             """
 
+    @profiled
     def compute_u_and_v(self):
         U_obs, V_obs = self.horizontal_wind_component(self.time_series["vw10m(m/s)"].values,
                                                       self.time_series["winddir(deg)"].values)
@@ -143,6 +147,7 @@ class TimeSeries(Interpolation):
             except ValueError:
                 pass
 
+    @profiled
     def change_dtype_time_series(self):
         if self.config["network"] == "local":
             print("Not changing dtype since AROME variable are not in time_series")
@@ -158,6 +163,7 @@ class TimeSeries(Interpolation):
         self.time_series.to_csv(self.config["path_time_series_pre_processed"]+f"time_series_bc{name}.csv")
         print(f"Saved {self.config['path_time_series_pre_processed']+f'time_series_bc{name}.csv'}")
 
+    @profiled
     def save_to_pickle(self, name=None):
         interp_str = "_interpolated" if self.interpolated else ""
         if name is None:
@@ -24,8 +24,9 @@ from scipy.spatial import cKDTree
 
 from bias_correction.train.utils import create_folder_if_doesnt_exist
 from bias_correction.train.metrics import bias_direction
+from bias_correction.train.batched_predictor import BatchedPredictor
 
-__all__ = ("ale_plot",)
+__all__ = ("ale_plot", "ALEEngine")
 
 
 class MidPointNorm(Normalize):
@@ -445,10 +446,47 @@ def _first_order_ale_quant(predictor, train_set, feature, bins,
     elif type_of_output == "dir":
         effects = bias_direction(predictions[0], predictions[1])
 
-    # Average these differences within each bin.
-    index_groupby = pd.DataFrame({"index": indices, "effects": effects}).groupby("index")
+    return _first_order_ale_from_effects(effects, indices, quantiles,
+                                         use_std=use_std,
+                                         only_local_effects=only_local_effects)
+
 
-    mean_effects = index_groupby.mean().to_numpy().flatten()
+def _mean_std_by_bin(indices, effects, nb_bins):
+    """Mean and standard deviation of the effects in each non empty bin, and the number of samples of these bins.
+
+    Vectorized equivalent of grouping the effects by bin index with pandas: NaN effects are ignored in the mean
+    and the standard deviation but counted in the number of samples.
+    """
+    valid = ~np.isnan(effects)
+    effects = np.where(valid, effects, 0)
+    size = np.bincount(indices, minlength=nb_bins)
+    counts = np.bincount(indices, weights=valid, minlength=nb_bins)
+    sums = np.bincount(indices, weights=effects, minlength=nb_bins)
+    sums_squared = np.bincount(indices, weights=effects ** 2, minlength=nb_bins)
+
+    non_empty = size > 0
+    size, counts, sums, sums_squared = size[non_empty], counts[non_empty], sums[non_empty], sums_squared[non_empty]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sums / counts
+        var = (sums_squared - counts * mean ** 2) / (counts - 1)
+    std = np.sqrt(np.clip(var, 0, None))
+    return mean, std, size
+
+
+def _first_order_ale_from_effects(effects, indices, quantiles, use_std=True, only_local_effects=False, bin_sizes=None):
+    """
+    First-order ALE from the individual effects (difference between the predictions at both bin edges).
+
+    bin_sizes: number of samples in each bin of the full data, when the effects are computed on a subsample.
+    The ALE is centered with these populations.
+    """
+    n_rows = len(indices)
+
+    # Average these differences within each bin.
+    mean_effects, mean_effects_std, size = _mean_std_by_bin(indices, effects, len(quantiles) - 1)
+    if bin_sizes is not None:
+        size = bin_sizes[bin_sizes > 0]
+        n_rows = np.sum(size)
 
     """
     if use_std:
@@ -459,11 +497,10 @@ def _first_order_ale_quant(predictor, train_set, feature, bins,
             ale_std = np.array([0, mean_effects_std])
         ale_std = _get_centres(ale_std)
         if not only_local_effects:
-            ale_std -= np.sum(ale_std * index_groupby.size() / train_set.shape[0])
+            ale_std -= np.sum(ale_std * size / n_rows)
     """
 
     if use_std:
-        mean_effects_std = index_groupby.std().to_numpy().flatten()
         mean_effects_lower = mean_effects - mean_effects_std
         mean_effects_upper = mean_effects + mean_effects_std
 
@@ -495,12 +532,12 @@ def _first_order_ale_quant(predictor, train_set, feature, bins,
 
     if use_std:
         if not only_local_effects:
-            ale_std -= np.sum(ale_std * index_groupby.size() / train_set.shape[0])
-            ale_std_lower -= np.sum(ale * index_groupby.size() / train_set.shape[0])
-            ale_std_upper -= np.sum(ale * index_groupby.size() / train_set.shape[0])
+            ale_std -= np.sum(ale_std * size / n_rows)
+            ale_std_lower -= np.sum(ale * size / n_rows)
+            ale_std_upper -= np.sum(ale * size / n_rows)
 
     if not only_local_effects:
-        ale -= np.sum(ale * index_groupby.size() / train_set.shape[0])
+        ale -= np.sum(ale * size / n_rows)
 
     if use_std:
         if not only_local_effects:
@@ -604,66 +641,26 @@ def _second_order_ale_quant(predictor, train_set, features, bins, data_loader=No
     else:
         effects = bias_direction(predictions[(1, 0)], predictions[(1, 1)]) - bias_direction(predictions[(0, 0)], predictions[(0, 1)])
 
-    """
-    array([ 3.9888620e-03,  3.6303997e-03,  6.0257912e-03, ...,
-            -4.2915344e-06,  6.1130524e-04, -3.4993887e-01], dtype=float32)
-    """
-    # Group the effects by their indices along both axes.
-    index_groupby = pd.DataFrame({"index_0": indices_list[0],
-                                  "index_1": indices_list[1],
-                                  "effects": effects}).groupby(["index_0", "index_1"])
-
-    # Compute mean effects.
-    mean_effects = index_groupby.mean()
-    """
-                      effects
-    index_0 index_1          
-    0       18       0.056193
-            19       0.043221
-    1       17       0.007076
-            18       0.027295
-    2       16       0.003114
-            17       0.008690
-            18       0.013942
-    3       15       0.003245
-            16       0.006434
-    4       14       0.000753
-            15       0.002147
-    5       13       0.000112
-            14       0.000088
-        """
+    return _second_order_ale_from_effects(effects, indices_list, quantiles_list, bins_list)
 
-    # Get the indices of the mean values.
-    group_indices = mean_effects.index
-    """
-    MultiIndex([( 0, 18),
-            ( 0, 19),
-            ( 1, 17),
-            ( 1, 18),
-            ( 2, 16),
-            ( 2, 17),
-            ( 2, 18),
-            ( 3, 15),
-            ( 3, 16),
-            ( 4, 14),
-            ( 4, 15),
-           names=['index_0', 'index_1'])
-    """
 
-    valid_grid_indices = tuple(zip(*group_indices))
-    """
-    ((0, 0, 1, 1, 2, 2, 2, 3, ...), (18, 19, 17, 18, 16, 17, 18, 15, ...))
-    """
+def _second_order_ale_from_effects(effects, indices_list, quantiles_list, bins_list):
+    """Second-order ALE from the individual effects (second order difference between the bin corners)."""
 
-    # Extract only the data.
-    mean_effects = mean_effects.to_numpy().flatten()
     """
-    array([ 5.61932288e-02,  4.32208516e-02,  7.07637845e-03,  2.72951536e-02, 3.11421417e-03,  8.68970156e-03, ...])
+    array([ 3.9888620e-03,  3.6303997e-03,  6.0257912e-03, ...,
+            -4.2915344e-06,  6.1130524e-04, -3.4993887e-01], dtype=float32)
     """
-    # Get the number of samples in each bin.
-    n_samples = index_groupby.size().to_numpy()
+    # Group the effects by their indices along both axes and compute the mean effects of the non empty bins.
+    # Bins are flattened in row-major order, so that non empty bins are sorted as with a pandas groupby.
+    flat_indices = np.ravel_multi_index(tuple(indices_list), bins_list)
+    mean_effects, _, n_samples = _mean_std_by_bin(flat_indices, effects, bins_list[0] * bins_list[1])
+    valid_grid_indices = np.unravel_index(np.flatnonzero(np.bincount(flat_indices,
+                                                                    minlength=bins_list[0] * bins_list[1])),
+                                          bins_list)
     """
-    array([502, 849, 818, 379, 476, 446, 214, 374,...])
+    valid_grid_indices = ((0, 0, 1, 1, 2, 2, 2, 3, ...), (18, 19, 17, 18, 16, 17, 18, 15, ...))
+    n_samples = array([502, 849, 818, 379, 476, 446, 214, 374,...])
     """
 
     # Create a 2D array of the number of samples in each bin.
@@ -826,7 +823,7 @@ def _second_order_ale_quant(predictor, train_set, features, bins, data_loader=No
     )
 
     # Centre the ALE by subtracting its expectation value.
-    ale -= np.sum(samples_grid * ale) / train_set.shape[0]
+    ale -= np.sum(samples_grid * ale) / len(effects)
 
     # Mark the originally missing points as such to enable later interpretation.
     ale.mask = missing_bin_mask
@@ -834,6 +831,139 @@ def _second_order_ale_quant(predictor, train_set, features, bins, data_loader=No
     return ale, quantiles_list
 
 
+class ALEEngine:
+    """Estimate first or second order ALE of many features with a single batched prediction stream.
+
+    The lower and upper bin edges of all the requested features (or the four bin corners of all the requested
+    pairs) are predicted in one pass over the dataset by a BatchedPredictor, so that each batch and its
+    topography maps are loaded once. Optionally, at most `budget_per_bin` samples are drawn in each bin.
+    """
+
+    def __init__(self,
+                 data_loader,
+                 model,
+                 mode="test",
+                 bins=10,
+                 budget_per_bin=None,
+                 batch_size=1024,
+                 seed=42,
+                 type_of_output="speed"):
+        self.predictor = BatchedPredictor(data_loader, model, mode=mode, batch_size=batch_size)
+        self.inputs = data_loader.get_inputs(mode)
+        self.columns = list(self.inputs.columns)
+        self.bins = bins
+        self.budget_per_bin = budget_per_bin
+        self.seed = seed
+        self.type_of_output = type_of_output
+
+    def _subsample(self, indices, nb_bins, rng):
+        """Positions of at most `budget_per_bin` random samples in each bin (all samples if no budget)."""
+        if self.budget_per_bin is None:
+            return np.arange(len(indices))
+        order = rng.permutation(len(indices))
+        order = order[np.argsort(indices[order], kind="stable")]
+        sorted_indices = indices[order]
+        starts = np.searchsorted(sorted_indices, np.arange(nb_bins))
+        rank = np.arange(len(order)) - starts[sorted_indices]
+        return np.sort(order[rank < self.budget_per_bin])
+
+    def _predict(self, corners):
+        """
+        Predictions at every corner.
+
+        corners: list of (feature -> values for every sample, positions of the samples used for this corner)
+        """
+        all_selected = [selected for _, selected in corners]
+        if self.budget_per_bin is None:
+            rows = None
+            modifications = [({self.columns.index(feature): values for feature, values in features_values.items()},
+                              None)
+                             for features_values, _ in corners]
+        else:
+            rows = np.unique(np.concatenate(all_selected))
+            modifications = [({self.columns.index(feature): values[rows] for feature, values in features_values.items()},
+                              np.isin(rows, selected))
+                             for features_values, selected in corners]
+
+        predictions = self.predictor.predict(modifications, rows=rows)
+
+        if rows is None:
+            return list(predictions)
+        # rows and selected are sorted: the predicted values of a corner are in the same order as selected
+        return [prediction[modification[1]] for prediction, modification in zip(predictions, modifications)]
+
+    def _get_indices(self, feature, quantiles):
+        return np.clip(np.digitize(self.inputs[feature], quantiles, right=True) - 1, 0, None)
+
+    def first_order(self, features, use_std=True, only_local_effects=False):
+        """
+        First order ALE of each feature.
+
+        :return: dict feature -> output of _first_order_ale_quant
+        """
+        rng = np.random.default_rng(self.seed)
+        corners = []
+        parameters = {}
+        for feature in features:
+            quantiles, nb_bins = _get_quantiles(self.inputs, feature, self.bins)
+            indices = self._get_indices(feature, quantiles)
+            selected = self._subsample(indices, nb_bins, rng)
+            parameters[feature] = (quantiles, indices[selected], np.bincount(indices, minlength=len(quantiles) - 1))
+            for offset in range(2):
+                corners.append(({feature: quantiles[indices + offset]}, selected))
+
+        predictions = self._predict(corners)
+
+        results = {}
+        for idx, feature in enumerate(features):
+            lower, upper = predictions[2 * idx], predictions[2 * idx + 1]
+            if self.type_of_output == "speed":
+                effects = upper - lower
+            else:
+                effects = bias_direction(lower, upper)
+            quantiles, indices, bin_sizes = parameters[feature]
+            results[feature] = _first_order_ale_from_effects(effects, indices, quantiles,
+                                                             use_std=use_std and not only_local_effects,
+                                                             only_local_effects=only_local_effects,
+                                                             bin_sizes=bin_sizes)
+        return results
+
+    def second_order(self, pairs):
+        """
+        Second order ALE of each pair of features.
+
+        :return: dict (feature_0, feature_1) -> output of _second_order_ale_quant
+        """
+        rng = np.random.default_rng(self.seed)
+        corners = []
+        parameters = {}
+        for pair in pairs:
+            pair = tuple(_parse_features(pair))
+            quantiles_list, bins_list = tuple(
+                zip(*(_get_quantiles(self.inputs, feature, n_bin)
+                      for feature, n_bin in zip(pair, _check_two_ints(self.bins)))))
+            indices_list = [self._get_indices(feature, quantiles) for feature, quantiles in zip(pair, quantiles_list)]
+            flat_indices = np.ravel_multi_index(tuple(indices_list), bins_list)
+            selected = self._subsample(flat_indices, bins_list[0] * bins_list[1], rng)
+            parameters[pair] = (quantiles_list, [indices[selected] for indices in indices_list], bins_list)
+            for shifts in product(*(range(2),) * 2):
+                corners.append(({pair[i]: quantiles_list[i][indices_list[i] + shifts[i]] for i in range(2)}, selected))
+
+        predictions = self._predict(corners)
+
+        results = {}
+        for idx, pair in enumerate(parameters):
+            # Same order as product(*(range(2),) * 2): (0, 0), (0, 1), (1, 0), (1, 1)
+            p00, p01, p10, p11 = predictions[4 * idx: 4 * idx + 4]
+            if self.type_of_output == "speed":
+                effects = (p11 - p10) - (p01 - p00)
+            else:
+                effects = bias_direction(p10, p11) - bias_direction(p00, p01)
+            quantiles_list, indices_list, bins_list = parameters[pair]
+            results[pair] = _second_order_ale_from_effects(effects, indices_list, quantiles_list, bins_list)
+        return results
+
+
 def ale_plot(
     model,
     train_set,
@@ -857,7 +987,8 @@ def ale_plot(
     folder_name="",
     type_of_output="speed",
     only_local_effects=False,
-    linewidth=1
+    linewidth=1,
+    precomputed=None
 ):
     """Plots ALE function of specified features based on training set.
     Parameters
@@ -890,6 +1021,9 @@ def ale_plot(
         Set to None to always plot rug plots. Set to 0 to always plot rug plots.
     data_loader : any, optional
         custom dataloader
+    precomputed : tuple, optional
+        ALE already computed by ALEEngine for these features. `model` and `predictor`
+        are not used in this case.
     Raises
     ------
     ValueError
@@ -902,7 +1036,7 @@ def ale_plot(
         If `features_classes` is not None.
     """
 
-    if model is None and predictor is None:
+    if model is None and predictor is None and precomputed is None:
         raise ValueError("If 'model' is None, 'predictor' must be supplied.")
 
     if features_classes is not None:
@@ -951,7 +1085,11 @@ def ale_plot(
                 """
                 raise NotImplementedError
 
-            if use_std and not only_local_effects:
+            if precomputed is not None and use_std and not only_local_effects:
+                ale, quantiles, ale_std_lower, ale_std_upper = precomputed
+            elif precomputed is not None:
+                ale, quantiles = precomputed[:2]
+            elif use_std and not only_local_effects:
                 ale, quantiles, ale_std_lower, ale_std_upper = _first_order_ale_quant(
                     model.predict if predictor is None else predictor,
                     train_set,
@@ -1004,14 +1142,17 @@ def ale_plot(
     elif len(features) == 2:
         if features_classes is None:
             # Continuous data.
-            ale, quantiles_list = _second_order_ale_quant(
-                model.predict if predictor is None else predictor,
-                train_set,
-                features,
-                bins,
-                data_loader=data_loader,
-                type_of_output=type_of_output
-            )
+            if precomputed is not None:
+                ale, quantiles_list = precomputed
+            else:
+                ale, quantiles_list = _second_order_ale_quant(
+                    model.predict if predictor is None else predictor,
+                    train_set,
+                    features,
+                    bins,
+                    data_loader=data_loader,
+                    type_of_output=type_of_output
+                )
             _second_order_quant_plot(fig, ax, quantiles_list, ale)
             _ax_labels(
                 ax,
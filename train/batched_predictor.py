@@ -0,0 +1,122 @@
+import numpy as np
+
+from typing import Dict, List, Tuple, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tensorflow as tf
+    from bias_correction.train.dataloader import CustomDataHandler
+
+# A modification replaces some input columns (column index -> values for every streamed row, or a scalar).
+# The optional boolean mask restricts the rows that are predicted for this modification.
+Modification = Tuple[Dict[int, Union[np.ndarray, float]], Union[np.ndarray, None]]
+
+
+class BatchedPredictor:
+    """
+    Predict many modified copies of the same inputs in a single pass over the dataset.
+
+    Each batch (topographic maps included) is read once and every modification of the tabular inputs of this batch
+    is streamed through the same compiled prediction function.
+    Used by permutation feature importance, ALE and partial dependence.
+    """
+
+    def __init__(self,
+                 data: 'CustomDataHandler',
+                 model: 'tf.keras.Model',
+                 mode: str = "test",
+                 batch_size: int = 1024
+                 ) -> None:
+        self.data = data
+        self.model = model
+        self.mode = mode
+        self.batch_size = batch_size
+        self.predict_fn = None
+
+    def _get_predict_fn(self):
+        import tensorflow as tf
+
+        if self.predict_fn is None:
+            model = self.model
+
+            @tf.function(reduce_retracing=True)
+            def predict_fn(inputs):
+                return model(inputs, training=False)
+
+            self.predict_fn = predict_fn
+
+        return self.predict_fn
+
+    def output2values(self, result) -> np.ndarray:
+        setter = self.data.results_setter
+        result = setter._prepare_final_outputs(result)
+        if isinstance(result, (list, tuple)):
+            result = [np.asarray(r) for r in result]
+        else:
+            result = np.asarray(result)
+        return np.atleast_1d(setter.nn_output2values(result))
+
+    def get_dataset(self,
+                    rows: Union[np.ndarray, None] = None
+                    ) -> 'tf.data.Dataset':
+        import tensorflow as tf
+
+        if rows is None:
+            dataset = self.data.get_tf_zipped_inputs(mode=self.mode)
+        else:
+            inputs = self.data.get_inputs(self.mode).iloc[rows]
+            names = self.data.get_names(self.mode).iloc[rows]
+            if self.data.config.get("random_idx", False):
+                idx_x, idx_y = self.data.get_idx(self.mode)
+                idx_x, idx_y = np.asarray(idx_x)[rows], np.asarray(idx_y)[rows]
+            else:
+                idx_x, idx_y = None, None
+            dataset = self.data.get_tf_zipped_inputs(mode=self.mode,
+                                                     inputs=inputs,
+                                                     names=names,
+                                                     idx_x=idx_x,
+                                                     idx_y=idx_y)
+        return dataset.batch(self.batch_size).prefetch(tf.data.AUTOTUNE)
+
+    def predict(self,
+                modifications: List[Modification],
+                rows: Union[np.ndarray, None] = None
+                ) -> np.ndarray:
+        """
+        :param modifications: list of (column index -> values, mask). An empty dict predicts the unmodified inputs.
+        :param rows: positions of the streamed rows in the inputs of the mode. All rows if None.
+        :return: predictions of shape (len(modifications), nb_rows). NaN where a mask excludes a row.
+        """
+        import tensorflow as tf
+
+        values = self.data.get_inputs(self.mode).values.astype(np.float32)
+        if rows is not None:
+            values = values[rows]
+        length = len(values)
+
+        predict_fn = self._get_predict_fn()
+        predictions = np.full((len(modifications), length), np.nan, dtype=np.float32)
+
+        index = 0
+        for batch in self.get_dataset(rows):
+            batch = list(batch)
+            index_end = index + int(batch[1].shape[0])
+            for idx_modification, (columns, mask) in enumerate(modifications):
+                if mask is None:
+                    selected = slice(None)
+                else:
+                    selected = np.flatnonzero(mask[index:index_end])
+                    if len(selected) == 0:
+                        continue
+                inputs_modified = values[index:index_end][selected].copy()
+                for idx_column, column_values in columns.items():
+                    if np.ndim(column_values) == 0:
+                        inputs_modified[:, idx_column] = column_values
+                    else:
+                        inputs_modified[:, idx_column] = column_values[index:index_end][selected]
+                batch_modified = [tensor if mask is None else tf.gather(tensor, selected) for tensor in batch]
+                batch_modified[1] = tf.convert_to_tensor(inputs_modified)
+                result = self.output2values(predict_fn(tuple(batch_modified)))
+                predictions[idx_modification, index:index_end][selected] = result
+            index = index_end
+
+        return predictions
@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras.callbacks import TensorBoard, \
     ReduceLROnPlateau,\
@@ -6,18 +7,15 @@ from tensorflow.keras.callbacks import TensorBoard, \
     ModelCheckpoint,\
     LearningRateScheduler
 
-try:
-    import horovod.tensorflow as hvd
-    _horovod = True
-except ModuleNotFoundError:
-    _horovod = False
-
 import os
+import importlib.util
 from typing import List
 from copy import deepcopy
 
-from bias_correction.train.eval import Interpretability
-from bias_correction.train.utils import no_raise_on_key_error
+from bias_correction.train.utils import no_raise_on_key_error, create_folder_if_doesnt_exist
+
+# Horovod is imported only when Horovod callbacks are requested
+_horovod = importlib.util.find_spec("horovod") is not None
 
 initial_learning_rate = 0.01
 epochs = 100
@@ -30,23 +28,60 @@ def learning_rate_time_decay(epoch, lr):
 
 class FeatureImportanceCallback(tf.keras.callbacks.Callback):
 
-    def __init__(self, data_loader, cm, exp, mode):
+    def __init__(self, data_loader, cm, exp, mode, n_repeats=1, batch_size=1024):
         super().__init__()
-        self.it = Interpretability(data_loader, cm, exp)
+        from bias_correction.train.feature_importance import PermutationImportance
+        self.exp = exp
         self.mode = mode
+        # The engine reads each batch once per epoch and streams every permuted copy through a compiled predict
+        self.engine = PermutationImportance(data_loader,
+                                            cm.model,
+                                            mode=mode,
+                                            n_repeats=n_repeats,
+                                            batch_size=batch_size)
 
     def on_epoch_end(self, epoch, logs={}):
-        df_rmse, df_ae, _, _ = self.it.compute_feature_importance(self.mode)
-        name_figure = str(int(epoch))
-        save_path = os.path.join(self.it.exp.path_to_feature_importance, name_figure, "figure_tmp.tmp")
-        subfolder_in_filename = self.it.check_if_subfolder_in_filename(save_path)
-        if subfolder_in_filename:
-            new_path, _ = self.it.create_subfolder_if_necessary(name_figure, save_path)
-        df_rmse.to_csv(os.path.join(save_path, "df_rmse.csv"))
+        df_ae = self.engine.compute()
+        save_path = os.path.join(self.exp.path_to_feature_importance, str(int(epoch)))
+        create_folder_if_doesnt_exist(save_path, _raise=False)
         df_ae.to_csv(os.path.join(save_path, "df_ae.csv"))
         print("Feature importance computed and saved")
 
 
+class SweepPruningCallback(tf.keras.callbacks.Callback):
+    """
+    Record the validation metric of each epoch in the experiment registry and stop the trial when it is worse
+    than the median of the other trials of the same sweep at the same epoch.
+    """
+
+    def __init__(self, registry, exp_name, sweep_key, monitor="val_loss", min_epochs=2, min_trials=3):
+        super().__init__()
+        self.registry = registry
+        self.exp_name = exp_name
+        self.sweep_key = sweep_key
+        self.monitor = monitor
+        self.min_epochs = min_epochs
+        self.min_trials = min_trials
+        self.pruned_at_epoch = None
+
+    def on_epoch_end(self, epoch, logs={}):
+        value = logs.get(self.monitor)
+        if value is None:
+            return
+        name = f"{self.monitor}_epoch_{epoch}"
+        other_values = self.registry.get_metric_values(name, "sweep_key", self.sweep_key)
+        self.registry.set_metric(self.exp_name, name, value)
+
+        enough_epochs = epoch + 1 >= self.min_epochs
+        enough_trials = len(other_values) >= self.min_trials
+        if enough_epochs and enough_trials and value > np.median(other_values):
+            self.pruned_at_epoch = epoch
+            self.registry.set_metric(self.exp_name, "pruned_at_epoch", epoch)
+            self.model.stop_training = True
+            print(f"Trial pruned at epoch {epoch}: {self.monitor}={value:.4f} "
+                  f"> median of {len(other_values)} trials {np.median(other_values):.4f}", flush=True)
+
+
 callbacks_dict = {"TensorBoard": TensorBoard,
                   "ReduceLROnPlateau": ReduceLROnPlateau,
                   "EarlyStopping": EarlyStopping,
@@ -57,7 +92,9 @@ callbacks_dict = {"TensorBoard": TensorBoard,
                   "learning_rate_decay": LearningRateScheduler(learning_rate_time_decay, verbose=1)
                   }
 
-if _horovod:
+
+def add_horovod_callbacks() -> None:
+    import horovod.tensorflow as hvd
     try:
         # Horovod: broadcast initial variable states from rank 0 to all other processes.
         # This is necessary to ensure consistent initialization of all workers when
@@ -88,9 +125,13 @@ def load_callbacks(callbacks_str: List[str], args_callbacks: dict, kwargs_callba
 
 
 def get_callbacks(callbacks_str: List[str], distribution_strategy: str, args_callbacks: dict, kwargs_callbacks: dict):
+    if distribution_strategy == "Horovod" and _horovod:
+        add_horovod_callbacks()
+
     normal_callbacks = load_callbacks(callbacks_str, args_callbacks, kwargs_callbacks)
 
     if distribution_strategy == "Horovod" and _horovod:
+        import horovod.tensorflow as hvd
         callbacks_str = ["BroadcastGlobalVariablesCallback", "MetricAverageCallback"]
         hvdcallbacks = load_callbacks(callbacks_str, args_callbacks, kwargs_callbacks)
         if hvd.rank() == 0:
@@ -0,0 +1,129 @@
+import os
+import signal
+from typing import List, Tuple, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tensorflow as tf
+
+
+class TrainingPreempted(Exception):
+    """Raised after the checkpoint written when the job received SIGTERM: resubmit the job to resume"""
+    pass
+
+
+def set_training_seed(config: dict) -> None:
+    """Seed python, numpy and tensorflow, and use deterministic kernels (config["deterministic_training"])"""
+    if not config.get("deterministic_training", False):
+        return
+    import tensorflow as tf
+    tf.keras.utils.set_random_seed(config.get("training_seed", 42))
+    tf.config.experimental.enable_op_determinism()
+
+
+class ResumableCheckpoint:
+    """
+    Checkpoint of a training in progress, written with tf.train.Checkpoint.
+
+    It contains the weights, the optimizer state, the gradient accumulators, the epoch, the step in the epoch,
+    the global step, the random generator and the state of the tf.data iterator of the current epoch (position in
+    the data, shuffle buffer, random offsets). A training restored from it continues at the step where it stopped
+    with the same batches, even in the middle of an accumulation group.
+
+    A checkpoint is written every checkpoint_every_n_steps steps, at the end of each epoch and when the process
+    receives SIGTERM (preemption).
+    """
+
+    def __init__(self,
+                 model: 'tf.keras.Model',
+                 directory: str,
+                 config: dict,
+                 accumulators: Union[List['tf.Variable'], None] = None
+                 ) -> None:
+        import tensorflow as tf
+
+        self.directory = directory
+        self.every_n_steps = config.get("checkpoint_every_n_steps", 1000)
+        self.is_preempted = False
+
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.global_step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.generator = tf.random.Generator.from_seed(config.get("training_seed", 42))
+        tf.random.set_global_generator(self.generator)
+
+        self.checkpoint = tf.train.Checkpoint(model=model,
+                                              optimizer=model.optimizer,
+                                              epoch=self.epoch,
+                                              step=self.step,
+                                              global_step=self.global_step,
+                                              generator=self.generator)
+        if accumulators is not None:
+            self.checkpoint.accumulators = accumulators
+        self.manager = tf.train.CheckpointManager(self.checkpoint,
+                                                  directory,
+                                                  max_to_keep=config.get("checkpoint_max_to_keep", 2),
+                                                  step_counter=self.global_step)
+
+    def install_preemption_handler(self) -> None:
+        """On SIGTERM, write a checkpoint after the current step and stop (Slurm: sbatch --signal=TERM@120)"""
+
+        def handler(signum, frame):
+            print("SIGTERM received: checkpoint after the current step", flush=True)
+            self.is_preempted = True
+
+        try:
+            signal.signal(signal.SIGTERM, handler)
+        except ValueError:
+            # Signal handlers can only be installed from the main thread
+            pass
+
+    def restore(self) -> Tuple[int, int, int]:
+        """Restore the latest checkpoint, except the iterator. Returns epoch, step in the epoch and global step."""
+        path = self.manager.latest_checkpoint
+        if path is None:
+            return 0, 0, 0
+        self.checkpoint.restore(path).expect_partial()
+        print(f"Resume training from {path}: epoch {int(self.epoch.numpy())}, step {int(self.step.numpy())}",
+              flush=True)
+        return int(self.epoch.numpy()), int(self.step.numpy()), int(self.global_step.numpy())
+
+    def restore_iterator(self,
+                         iterator: 'tf.data.Iterator'
+                         ) -> None:
+        """Restore the position of the iterator of the interrupted epoch (the iterator must be a new one)"""
+        import tensorflow as tf
+        tf.train.Checkpoint(iterator=iterator).read(self.manager.latest_checkpoint).expect_partial()
+
+    def should_save(self,
+                    step: int,
+                    nb_steps: int
+                    ) -> bool:
+        """nb_steps: steps done since the previous call"""
+        return self.is_preempted or step // self.every_n_steps > (step - nb_steps) // self.every_n_steps
+
+    def save(self,
+             epoch: int,
+             step: int,
+             global_step: int,
+             iterator: Union['tf.data.Iterator', None] = None
+             ) -> str:
+        self.epoch.assign(epoch)
+        self.step.assign(step)
+        self.global_step.assign(global_step)
+        if iterator is not None:
+            self.checkpoint.iterator = iterator
+        elif hasattr(self.checkpoint, "iterator"):
+            # End of epoch: the exhausted iterator of the epoch must not be restored
+            del self.checkpoint.iterator
+        path = self.manager.save(checkpoint_number=global_step)
+        if self.is_preempted:
+            raise TrainingPreempted(f"Training preempted, checkpoint saved in {path}")
+        return path
+
+
+def get_checkpoint_directory(exp,
+                             name: str
+                             ) -> str:
+    """One checkpoint directory per fit of an experience (e.g. per type of output)"""
+    path = getattr(exp, "path_to_checkpoints", None) or os.path.join(exp.path_to_current_experience, "checkpoints")
+    return os.path.join(path, name)
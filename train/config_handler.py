@@ -65,12 +65,14 @@ class DataFitSpeedDir:
     batch_size: int
     epochs: int
     learning_rate: int
+    loss_speed: str = "pinball_proportional"
+    loss_weights: MutableSequence[float] = field(default_factory=lambda: [1.0, 1.0])
     loss: str = "mixed"
     labels: MutableSequence[str] = field(default_factory=lambda: ["vw10m(m/s)", "winddir(deg)"])
     type_of_output: str = "output_speed_and_dir"
+    # Null speeds are masked in the direction loss instead of being removed
     remove_null_speeds: bool = False
     csv_logger: str = "CSVLogger"
-    # We don't fit a model with two outputs because it cause error in the loss function
     get_intermediate_output: bool = False
     current_variable: str = "UV"
     name: str = "fit_speed_and_dir"
@@ -98,10 +100,9 @@ class PersistentConfig:
 
         self.data_fit_speed_and_dir = DataFitSpeedDir(config["batch_size"],
                                                       config["epochs"],
-                                                      config["learning_rate"])
-        batch_size: int
-        epochs: int
-        learning_rate: int
+                                                      config["learning_rate"],
+                                                      loss_speed=config["loss"],
+                                                      loss_weights=config.get("loss_weights_speed_dir", [1.0, 1.0]))
 
         self.data_predict_speed = DataPredictSpeed()
         self.data_predict_direction = DataPredictDirection()
@@ -114,7 +115,7 @@ class PersistentConfig:
 
     @staticmethod
     def modify_config_for_fit(config: Dict,
-                              fit_data: Union[DataFitDirection, DataFitSpeed]
+                              fit_data: Union[DataFitDirection, DataFitSpeed, DataFitSpeedDir]
                               ) -> Dict:
         """Adapts the configuration in order to fit model on direction or speed"""
         config["labels"] = fit_data.labels
@@ -141,8 +142,8 @@ class PersistentConfig:
 
     @staticmethod
     def modify_csvlogger_in_callbacks(config: Dict,
-                                      fit_data: Union[DataFitDirection, DataFitSpeed],
-                                      not_fit_data: Union[DataFitDirection, DataFitSpeed]
+                                      fit_data: Union[DataFitDirection, DataFitSpeed, DataFitSpeedDir],
+                                      not_fit_data: Union[DataFitDirection, DataFitSpeed, DataFitSpeedDir]
                                       ) -> Dict:
         """Ensures speed CSVLogger is not in callbacks during fit on direction and vice-versa."""
         logger_not_wanted_in_callbacks = not_fit_data.csv_logger in config["callbacks"]
@@ -162,10 +163,12 @@ class PersistentConfig:
         return self.modify_csvlogger_in_callbacks(config, self.data_fit_direction, self.data_fit_speed)
 
     def config_fit_speed_and_dir(self, config: Dict) -> Dict:
-        """Adapts the configuration in order to fit model on direction"""
+        """Adapts the configuration in order to fit speed and direction heads together"""
         print(self.data_fit_speed_and_dir)
         config = self.modify_config_for_fit(config, self.data_fit_speed_and_dir)
-        return self.modify_csvlogger_in_callbacks(config, self.data_fit_direction, self.data_fit_speed)
+        config["losses_mixed"] = (self.data_fit_speed_and_dir.loss_speed, "cosine_distance")
+        config["loss_weights_speed_dir"] = self.data_fit_speed_and_dir.loss_weights
+        return self.modify_csvlogger_in_callbacks(config, self.data_fit_speed_and_dir, self.data_fit_direction)
 
     def config_fit_speed(self, config: Dict) -> Dict:
         """Adapts the configuration in order to fit model on direction"""
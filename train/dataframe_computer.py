@@ -1,11 +1,44 @@
 import numpy as np
 import pandas as pd
 
-from typing import List, Tuple, Union
-
+from typing import Dict, List, Tuple, Union, TYPE_CHECKING
 
 from bias_correction.train.metrics import get_metric
-from bias_correction.train.dataloader import CustomDataHandler
+
+if TYPE_CHECKING:
+    from bias_correction.train.dataloader import CustomDataHandler
+
+
+TOPO_CARAC_CLASSES = ("$x \leq q_{25}$", "$q_{25}<x \leq q_{50}$", "$q_{50}<x \leq q_{75}$", "$q_{75}<x$")
+ALTI_CLASSES = ("$Elevation [m] \leq 500$", "$500<Elevation [m] \leq 1000$",
+                "$1000<Elevation [m] \leq 2000$", "$2000<Elevation [m]$")
+ALTI_CLASSES_EDGES = (500, 1000, 2000)
+
+
+def classify(values: np.ndarray,
+             edges: Union[List[float], Tuple[float, ...], np.ndarray],
+             labels: Tuple[str, ...]
+             ) -> pd.Categorical:
+    """
+    Classes of values in the intervals x <= edges[0], edges[0] < x <= edges[1], ..., edges[-1] < x.
+
+    Classes are stored as an ordered pd.Categorical (int8 codes and one label per class): one byte per row.
+    NaN values have no class.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    codes = np.digitize(values, edges, right=True).astype(np.int8)
+    codes[np.isnan(values)] = -1
+    return pd.Categorical.from_codes(codes, categories=list(labels), ordered=True)
+
+
+def _broadcast_station_classes(df: pd.DataFrame,
+                               station_classes: pd.Series
+                               ) -> pd.Categorical:
+    """Classes of the stations (categorical Series indexed by name) on each row of df, through df["name"]"""
+    indexer = station_classes.index.get_indexer(df["name"].values)
+    codes = np.asarray(station_classes.cat.codes.values)[indexer]
+    codes[indexer < 0] = -1
+    return pd.Categorical.from_codes(codes, dtype=station_classes.dtype)
 
 
 def classify_topo_carac(stations: pd.DataFrame,
@@ -13,34 +46,28 @@ def classify_topo_carac(stations: pd.DataFrame,
                         topo_carac: list = ['mu', 'curvature', 'tpi_500', 'tpi_2000', 'laplacian', 'alti'],
                         config: Union[dict, None] = None
                         ) -> pd.DataFrame:
+    """
+    Quartile classes of the topographic characteristics of the stations (class_mu, class_alti...).
+
+    With a config, quartiles are computed without the rejected countries and stations. Classes are then computed
+    once for every station (including rejected ones, e.g. for the evaluation on other countries) and broadcast
+    to the rows of df through their station name.
+    """
+    stations_quantiles = stations
     if config is not None:
-        stations = stations[~stations["country"].isin(config["country_to_reject_during_training"]) & ~stations["name"].isin(
-            config["stations_to_reject"])]
-        df = df[df["name"].isin(stations["name"].unique())]
-
-    print("\ndebug")
-    print(df["name"].unique())
+        stations_quantiles = stations[~stations["country"].isin(config["country_to_reject_during_training"])
+                                      & ~stations["name"].isin(config["stations_to_reject"])]
 
+    stations_unique = stations.drop_duplicates("name").set_index("name")
     for carac in topo_carac:
 
-        if not hasattr(df, f"class_{carac}"):
-            df[f"class_{carac}"] = np.nan
-
         carac_nn = carac + '_NN_0' if carac not in ["alti", "country"] else carac
 
-        q25 = np.quantile(stations[carac_nn].values, 0.25)
-        q50 = np.quantile(stations[carac_nn].values, 0.5)
-        q75 = np.quantile(stations[carac_nn].values, 0.75)
+        q25, q50, q75 = np.quantile(stations_quantiles[carac_nn].values, [0.25, 0.5, 0.75])
 
-        filter_1 = (df[carac_nn] <= q25)
-        filter_2 = (df[carac_nn] > q25) & (df[carac_nn] <= q50)
-        filter_3 = (df[carac_nn] > q50) & (df[carac_nn] <= q75)
-        filter_4 = (df[carac_nn] > q75)
-
-        df.loc[filter_1, f"class_{carac}"] = "$x \leq q_{25}$"
-        df.loc[filter_2, f"class_{carac}"] = "$q_{25}<x \leq q_{50}$"
-        df.loc[filter_3, f"class_{carac}"] = "$q_{50}<x \leq q_{75}$"
-        df.loc[filter_4, f"class_{carac}"] = "$q_{75}<x$"
+        station_classes = pd.Series(classify(stations_unique[carac_nn].values, (q25, q50, q75), TOPO_CARAC_CLASSES),
+                                    index=stations_unique.index)
+        df[f"class_{carac}"] = _broadcast_station_classes(df, station_classes)
 
         print(f"Quantiles {carac}: ", q25, q50, q75)
     return df
@@ -49,20 +76,10 @@ def classify_topo_carac(stations: pd.DataFrame,
 def classify_alti(df: pd.DataFrame
                   ) -> pd.DataFrame:
 
-    df.loc[:, "class_alti0"] = np.nan
-
-    filter_1 = (df["alti"] <= 500)
-    filter_2 = (500 < df["alti"]) & (df["alti"] <= 1000)
-    filter_3 = (1000 < df["alti"]) & (df["alti"] <= 2000)
-    filter_4 = (2000 < df["alti"])
-
-    df.loc[filter_1, "class_alti0"] = "$Elevation [m] \leq 500$"
-    df.loc[filter_2, "class_alti0"] = "$500<Elevation [m] \leq 1000$"
-    df.loc[filter_3, "class_alti0"] = "$1000<Elevation [m] \leq 2000$"
-    df.loc[filter_4, "class_alti0"] = "$2000<Elevation [m]$"
+    df["class_alti0"] = classify(df["alti"].values, ALTI_CLASSES_EDGES, ALTI_CLASSES)
 
-    for filter_alti in [filter_1, filter_2, filter_3, filter_4]:
-        print(len(df.loc[filter_alti, "name"].unique()))
+    for nb_stations in df.groupby("class_alti0", observed=False)["name"].nunique().values:
+        print(nb_stations)
 
     return df
 
@@ -71,9 +88,9 @@ def classify_forecast_term(df: pd.DataFrame
                            ) -> pd.DataFrame:
 
     def compute_lead_time(hour):
-        return (hour - 6) % 24 + 6
+        return ((hour - 6) % 24 + 6).astype(np.int8)
 
-    df.loc[:, "lead_time"] = compute_lead_time(df.index.hour.values)
+    df["lead_time"] = compute_lead_time(df.index.hour.values)
 
     return df
 
@@ -113,32 +130,68 @@ def add_topo_carac_from_stations_to_df(df, stations,
     return df
 
 
+def _index_on_name_and_time(df: pd.DataFrame
+                            ) -> pd.MultiIndex:
+    return pd.MultiIndex.from_arrays([df["name"].values, df.index], names=["name", "time"])
+
+
+def join_models_on_name_and_time(df: pd.DataFrame,
+                                 models: Dict[str, pd.DataFrame],
+                                 print_: bool = False
+                                 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Join the predictions of other models on df with a keyed join on (name, time), without looping on stations.
+
+    :param df: DataFrame with a "name" column and a time index (e.g. df_results)
+    :param models: column name -> DataFrame with a "name" column, a time index and this column
+    :param print_: print coverage statistics
+    :return: df with one new column per model and coverage statistics of each model
+    """
+    index_df = _index_on_name_and_time(df)
+
+    df = df.copy()
+    coverage = []
+    nb_stations = df["name"].nunique()
+    for column, model in models.items():
+        # Duplicated (name, time) in a model are ambiguous: the first prediction is kept
+        index_model = _index_on_name_and_time(model)
+        filter_unique = ~index_model.duplicated(keep="first")
+        index_model = index_model[filter_unique]
+        values_model = model[column].values[filter_unique]
+
+        # Position of each (name, time) of df in the model, -1 if missing
+        positions = index_model.get_indexer(index_df)
+        available = positions >= 0
+        values = np.full(len(df), np.nan)
+        values[available] = values_model[positions[available]]
+        df[column] = values
+
+        available = available & ~np.isnan(values)
+        coverage.append({"model": column,
+                         "nb_rows": len(df),
+                         "nb_rows_available": int(available.sum()),
+                         "coverage": available.mean() if len(df) else np.nan,
+                         "nb_stations": nb_stations,
+                         "nb_stations_available": df.loc[available, "name"].nunique()})
+    coverage = pd.DataFrame(coverage)
+
+    if print_:
+        print("\nCoverage of other models on (name, time):", flush=True)
+        print(coverage, flush=True)
+
+    return df, coverage
+
+
 def add_other_models(df: pd.DataFrame,
                      models: List[str],
                      current_variable: str,
-                     data_loader: CustomDataHandler):
+                     data_loader: 'CustomDataHandler'):
 
+    other_models = {}
     for model_str in models:
-
         assert hasattr(data_loader, f"predicted{model_str}")
-        results = []
+        other_models[current_variable + model_str] = getattr(data_loader, f"predicted{model_str}")
 
-        df.loc[:, current_variable + model_str] = np.nan
-
-        for station in df["name"].unique():
-            filter_df_results = df["name"] == station
-            df_station = df.loc[filter_df_results, :]
-
-            model = getattr(data_loader, f"predicted{model_str}")
-            filter_df_model = model["name"] == station
-            model_station = model.loc[filter_df_model, :]
-
-            filter_time = df_station.index.intersection(model_station.index)
-            df_station.loc[filter_time, current_variable + model_str] = model_station.loc[
-                filter_time, current_variable + model_str]
-            results.append(df_station)
-
-        df = pd.concat(results)
+    df, _ = join_models_on_name_and_time(df, other_models, print_=True)
 
     return df
-
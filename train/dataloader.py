@@ -1,47 +1,99 @@
 import numpy as np
 import pandas as pd
-import tensorflow as tf
-from tensorflow.python.data.ops.dataset_ops import DatasetV2
 
 from copy import copy
 import pickle
-from sklearn.utils import shuffle
-from sklearn.model_selection import train_test_split
-from typing import Optional, Tuple, Union, Any, List, MutableSequence, Generator
+from typing import Optional, Tuple, Union, Any, List, Dict, MutableSequence, Generator, TYPE_CHECKING
 from dataclasses import dataclass
 
 from bias_correction.train.metrics import get_metric
+from bias_correction.train.tfrecords import TFRecordStore
 from bias_correction.train.wind_utils import wind2comp
+from bias_correction.utils_bc.instrumentation import profiled, profiler
 
+# Tensorflow and scikit-learn are imported where they are used,
+# so that data preparation does not pay for their import time.
+if TYPE_CHECKING:
+    import tensorflow as tf
+    from tensorflow.python.data.ops.dataset_ops import DatasetV2
 
-class MapGeneratorUncentered:
+
+class UncenteredTopos:
+    """
+    Uncentered topographies cropped in the graph.
+
+    The 280 x 280 topographies of the stations stay resident in one tensor. A 140 x 140 window shifted by
+    (idx_x, idx_y) from the center is cropped for each sample, either with given offsets or with offsets drawn
+    by a stateless random generator: new offsets at each epoch, reproducible with config["random_idx_seed"].
+    """
 
     def __init__(self,
-                 names: MutableSequence[str],
-                 idx_x: np.ndarray,
-                 idx_y: np.ndarray,
+                 stations: MutableSequence[str],
                  config: dict
                  ) -> None:
+        import tensorflow as tf
 
         loader = Loader(config)
-
-        try:
-            self.names = names.values
-        except AttributeError:
-            self.names = names
-
-        self.idx_x = idx_x
-        self.idx_y = idx_y
+        dict_topos = loader.load_large_topos()
+
+        self.stations = pd.Index(list(stations))
+        self.topos = tf.constant(np.stack([dict_topos[station]["data"] for station in self.stations]),
+                                 dtype=tf.float32)
+        self.min_idx = config.get("random_idx_min", -25)
+        self.max_idx = config.get("random_idx_max", 25)
+        self.seed = config.get("random_idx_seed", 42)
         self.idx_center = 140
-        self.list_dict_topos = loader.load_large_topos()
 
-    def __call__(self):
-        for name, ix, iy in zip(self.names, self.idx_x, self.idx_y):
-            y_l = (self.idx_center + iy) - 70
-            y_r = (self.idx_center + iy) + 70
-            x_l = (self.idx_center + ix) - 70
-            x_r = (self.idx_center + ix) + 70
-            yield self.list_dict_topos[name]["data"][y_l:y_r, x_l:x_r, :]
+    def get_station_idx(self,
+                        names: MutableSequence[str]
+                        ) -> np.ndarray:
+        return self.stations.get_indexer(np.asarray(names))
+
+    def crop(self,
+             idx_station: 'tf.Tensor',
+             idx_x: 'tf.Tensor',
+             idx_y: 'tf.Tensor'
+             ) -> 'tf.Tensor':
+        import tensorflow as tf
+        offset = self.idx_center - 70
+        return tf.image.crop_to_bounding_box(tf.gather(self.topos, idx_station),
+                                             offset + tf.cast(idx_y, tf.int32),
+                                             offset + tf.cast(idx_x, tf.int32),
+                                             140,
+                                             140)
+
+    def random_crop(self,
+                    idx_station: 'tf.Tensor',
+                    sample_seed: 'tf.Tensor'
+                    ) -> 'tf.Tensor':
+        import tensorflow as tf
+        idx = tf.random.stateless_uniform([2],
+                                          seed=tf.stack([tf.constant(self.seed, tf.int64), sample_seed]),
+                                          minval=self.min_idx,
+                                          maxval=self.max_idx + 1,
+                                          dtype=tf.int32)
+        return self.crop(idx_station, idx[0], idx[1])
+
+    def get_dataset(self,
+                    names: MutableSequence[str],
+                    idx_x: Union[MutableSequence[int], None] = None,
+                    idx_y: Union[MutableSequence[int], None] = None
+                    ) -> 'tf.data.Dataset':
+        """Crops with the given offsets, or with new random offsets at each iteration if idx_x and idx_y are None"""
+        import tensorflow as tf
+
+        idx_station = tf.data.Dataset.from_tensor_slices(self.get_station_idx(names))
+
+        if idx_x is None and idx_y is None:
+            # One seed per sample, drawn again at each iteration over the dataset (i.e. each epoch)
+            seeds = tf.data.Dataset.random(seed=self.seed, rerandomize_each_iteration=True)
+            return tf.data.Dataset.zip((idx_station, seeds)).map(self.random_crop,
+                                                                 num_parallel_calls=tf.data.AUTOTUNE)
+
+        idx = tf.data.Dataset.from_tensor_slices((np.asarray(idx_x, dtype=np.int32),
+                                                  np.asarray(idx_y, dtype=np.int32)))
+        return tf.data.Dataset.zip((idx_station, idx)).map(lambda station, xy: self.crop(station, xy[0], xy[1]),
+                                                           num_parallel_calls=tf.data.AUTOTUNE)
 
 
 class MapGenerator:
@@ -105,6 +157,25 @@ class MeanGenerator:
 
 
 class Batcher:
+    """
+    Build the tf.data pipelines of each mode.
+
+    Stages are configured per mode with config["pipeline_train"], config["pipeline_val"] and config["pipeline_test"]:
+        "cache": None (default), "memory" or a file path (on-disk cache). Cached elements include one map per row.
+            Not for train with random_idx_per_epoch (frozen crops)
+        "shuffle_buffer": None or buffer size. Shuffling is applied after the cache, so that each epoch has a new order
+        "seed": seed of the shuffle
+        "num_parallel_calls": parallelism of the map and batch stages ("auto" for tf.data.AUTOTUNE)
+        "deterministic": False allows tf.data to return elements out of order when it is faster
+        "drop_remainder": True gives static batch shapes
+        "autotune_ram_budget": RAM budget (in bytes) of tf.data autotuning
+        "auto_shard_policy": "OFF", "AUTO", "FILE" or "DATA". Defaults to "DATA" with MirroredStrategy
+    Without configuration, the pipelines are the same as before: batch and prefetch for train, batch for val and test.
+    """
+
+    default_pipelines = {"train": {"prefetch": True},
+                         "val": {"prefetch": False},
+                         "test": {"prefetch": False}}
 
     def __init__(self,
                  config: dict
@@ -112,30 +183,142 @@ class Batcher:
         self.config = config
 
     def _get_prefetch(self):
+        import tensorflow as tf
         if self.config.get("prefetch") == "auto":
             return tf.data.AUTOTUNE
         else:
             return self.config["prefetch"]
 
+    @staticmethod
+    def _get_num_parallel_calls(num_parallel_calls: Union[int, str, None]):
+        import tensorflow as tf
+        if num_parallel_calls == "auto":
+            return tf.data.AUTOTUNE
+        return num_parallel_calls
+
+    def get_pipeline_parameters(self,
+                                mode: str
+                                ) -> dict:
+        parameters = dict(self.default_pipelines.get(mode, {}))
+        parameters.update(self.config.get(f"pipeline_{mode}", {}))
+        return parameters
+
+    def _get_options(self,
+                     parameters: dict
+                     ) -> 'tf.data.Options':
+        import tensorflow as tf
+        options = tf.data.Options()
+        if parameters.get("deterministic") is not None:
+            options.deterministic = parameters["deterministic"]
+        if parameters.get("autotune_ram_budget") is not None:
+            options.autotune.ram_budget = int(parameters["autotune_ram_budget"])
+        auto_shard_policy = parameters.get("auto_shard_policy", self._get_default_auto_shard_policy())
+        if auto_shard_policy is not None:
+            options.experimental_distribute.auto_shard_policy = getattr(tf.data.experimental.AutoShardPolicy,
+                                                                        auto_shard_policy)
+        return options
+
+    def _get_default_auto_shard_policy(self) -> Union[str, None]:
+        """Multi-worker training: each worker reads its own part of the batches"""
+        if self.config.get("distribution_strategy") == "MirroredStrategy":
+            return "DATA"
+        return None
+
+    def build_pipeline(self,
+                       dataset: 'tf.data.Dataset',
+                       parameters: dict,
+                       map_func=None
+                       ) -> 'DatasetV2':
+        num_parallel_calls = self._get_num_parallel_calls(parameters.get("num_parallel_calls"))
+        deterministic = parameters.get("deterministic")
+
+        if map_func is not None:
+            dataset = dataset.map(map_func, num_parallel_calls=num_parallel_calls, deterministic=deterministic)
+
+        cache = parameters.get("cache")
+        if cache == "memory":
+            dataset = dataset.cache()
+        elif cache:
+            dataset = dataset.cache(cache)
+
+        if parameters.get("shuffle_buffer"):
+            dataset = dataset.shuffle(parameters["shuffle_buffer"],
+                                      seed=parameters.get("seed"),
+                                      reshuffle_each_iteration=True)
+
+        dataset = dataset.batch(batch_size=self.config["global_batch_size"],
+                                drop_remainder=parameters.get("drop_remainder", False),
+                                num_parallel_calls=num_parallel_calls,
+                                deterministic=deterministic)
+
+        if parameters.get("prefetch", True):
+            dataset = dataset.prefetch(self._get_prefetch())
+
+        return dataset.with_options(self._get_options(parameters))
+
     def batch_train(self,
-                    dataset: tf.data.Dataset
-                    ) -> DatasetV2:
-        # Before .cache before prefetch
-        return dataset \
-            .batch(batch_size=self.config["global_batch_size"]) \
-            .prefetch(self._get_prefetch())
+                    dataset: 'tf.data.Dataset'
+                    ) -> 'DatasetV2':
+        parameters = self.get_pipeline_parameters("train")
+        if parameters.get("cache") and self.config.get("random_idx", False) \
+                and self.config.get("random_idx_per_epoch", True):
+            # The cache would store the crops of the first epoch
+            raise ValueError("pipeline_train['cache'] can not be used with random_idx_per_epoch: "
+                             "disable the cache or set random_idx_per_epoch to False")
+        return self.build_pipeline(dataset, parameters)
 
     def batch_test(self,
-                   dataset: tf.data.Dataset
-                   ) -> DatasetV2:
+                   dataset: 'tf.data.Dataset'
+                   ) -> 'DatasetV2':
         print("\n\nWARNING: usually test data are not batched")
-        return dataset.batch(batch_size=self.config[
-            "global_batch_size"])  # todo put raise NotImplementedError("Test data are not batched")
+        # todo put raise NotImplementedError("Test data are not batched")
+        return self.build_pipeline(dataset, self.get_pipeline_parameters("test"))
 
     def batch_val(self,
-                  dataset: tf.data.Dataset
-                  ) -> DatasetV2:
-        return dataset.batch(batch_size=self.config["global_batch_size"])
+                  dataset: 'tf.data.Dataset'
+                  ) -> 'DatasetV2':
+        return self.build_pipeline(dataset, self.get_pipeline_parameters("val"))
+
+    @staticmethod
+    def measure_steps_per_second(dataset: 'tf.data.Dataset',
+                                 nb_steps: int = 100,
+                                 nb_warmup_steps: int = 5,
+                                 nb_epochs: int = 2
+                                 ) -> float:
+        """Iterate over the dataset without a model. Several epochs are measured so that caches are used."""
+        import time
+        steps = 0
+        duration = 0
+        for _ in range(nb_epochs):
+            iterator = iter(dataset)
+            for _ in range(nb_warmup_steps):
+                next(iterator, None)
+            t0 = time.perf_counter()
+            for step, _ in enumerate(iterator):
+                if step >= nb_steps:
+                    break
+                steps += 1
+            duration += time.perf_counter() - t0
+        return steps / duration if duration else np.nan
+
+    def benchmark_pipelines(self,
+                            get_dataset,
+                            configurations: Dict[str, dict],
+                            nb_steps: int = 100
+                            ) -> pd.DataFrame:
+        """
+        Measure the steps/sec of several pipeline configurations.
+
+        :param get_dataset: callable returning a new unbatched dataset
+        :param configurations: name -> pipeline parameters
+        """
+        results = []
+        for name, parameters in configurations.items():
+            dataset = self.build_pipeline(get_dataset(), parameters)
+            steps_per_second = self.measure_steps_per_second(dataset, nb_steps=nb_steps)
+            print(f"Pipeline {name}: {steps_per_second:.2f} steps/sec", flush=True)
+            results.append({"pipeline": name, "steps_per_second": steps_per_second, **parameters})
+        return pd.DataFrame(results)
 
 
 class Splitter:
@@ -187,6 +370,7 @@ class Splitter:
         else:
             test_size = self.config[str_test_size]
 
+        from sklearn.model_selection import train_test_split
         return train_test_split(time_series, test_size=test_size, random_state=self.config[str_random_state])
 
     def _split_time_and_space(self,
@@ -254,6 +438,7 @@ class Splitter:
         else:
             raise NotImplementedError("Split strategy not referenced")
 
+    @profiled
     def split_train_test_val(self,
                              time_series: pd.DataFrame,
                              split_strategy: Union[str, None] = None
@@ -282,6 +467,143 @@ class Splitter:
         return time_series_train, time_series_test, time_series_val
 
 
+    # Index mode: splits return integer row positions in one immutable time_series instead of DataFrame copies
+
+    def _index_split_by_time(self,
+                             time_series: pd.DataFrame,
+                             rows: np.ndarray,
+                             mode: Union[str, None] = None,
+                             **kwargs: Any
+                             ) -> Tuple[np.ndarray, np.ndarray]:
+
+        assert mode is not None, "mode must be specified"
+
+        filter_train = time_series.index[rows] < self.config[f"date_split_train_{mode}"]
+        return rows[filter_train], rows[~filter_train]
+
+    def _index_split_by_space(self,
+                              time_series: pd.DataFrame,
+                              rows: np.ndarray,
+                              mode: Union[str, None] = None,
+                              **kwargs: Any
+                              ) -> Tuple[np.ndarray, np.ndarray]:
+
+        assert mode is not None, "mode must be specified"
+
+        names = time_series["name"].values[rows]
+        filter_train = np.isin(names, self.config[f"stations_train"])
+        filter_test = np.isin(names, self.config[f"stations_{mode}"])
+        return rows[filter_train], rows[filter_test]
+
+    def _index_split_random(self,
+                            time_series: pd.DataFrame,
+                            rows: np.ndarray,
+                            mode: Union[str, None] = None,
+                            **kwargs: Any
+                            ) -> Tuple[np.ndarray, np.ndarray]:
+
+        assert mode is not None, "mode must be specified"
+
+        if self.config["quick_test"] and mode == "test":
+            test_size = 0.05
+        elif self.config["quick_test"] and mode == "val":
+            test_size = 0.01
+        else:
+            test_size = self.config[f"random_split_test_size_{mode}"]
+
+        # Splitting the positions gives the same rows as splitting the DataFrame with the same random state
+        from sklearn.model_selection import train_test_split
+        rows_train, rows_test = train_test_split(rows,
+                                                 test_size=test_size,
+                                                 random_state=self.config[f"random_split_state_{mode}"])
+        return rows_train, rows_test
+
+    def _index_split_time_and_space(self,
+                                    time_series: pd.DataFrame,
+                                    rows: np.ndarray,
+                                    mode: Union[str, None] = None,
+                                    **kwargs: Any
+                                    ) -> Tuple[np.ndarray, np.ndarray]:
+
+        assert mode is not None, "mode must be specified"
+
+        rows_train, rows_test = self._index_split_by_space(time_series, rows, mode)
+        rows_train, _ = self._index_split_by_time(time_series, rows_train, mode)
+        _, rows_test = self._index_split_by_time(time_series, rows_test, mode)
+
+        return rows_train, rows_test
+
+    def _index_split_by_country(self,
+                                time_series: pd.DataFrame,
+                                rows: np.ndarray,
+                                stations: Union[pd.DataFrame, None] = None,
+                                **kwargs: Any
+                                ) -> Tuple[np.ndarray, np.ndarray]:
+
+        assert stations is not None, "stations pd.DataFrame must be specified"
+
+        countries_to_reject = self.config["country_to_reject_during_training"]
+        names_country_to_reject = stations["name"][stations["country"].isin(countries_to_reject)].values
+        filter_other_countries = np.isin(time_series["name"].values[rows], names_country_to_reject)
+        return rows[~filter_other_countries], rows[filter_other_countries]
+
+    def index_split_wrapper(self,
+                            time_series: pd.DataFrame,
+                            rows: Union[np.ndarray, None] = None,
+                            mode: str = "test",
+                            stations: Union[pd.DataFrame, None] = None,
+                            split_strategy: Union[str, None] = None,
+                            ) -> Tuple[np.ndarray, np.ndarray]:
+
+        split_strategy = self.config[f"split_strategy_{mode}"] if split_strategy is None else split_strategy
+
+        if rows is None:
+            rows = np.arange(len(time_series))
+
+        strategies = {"time": self._index_split_by_time,
+                      "space": self._index_split_by_space,
+                      "time_and_space": self._index_split_time_and_space,
+                      "random": self._index_split_random,
+                      "country": self._index_split_by_country}
+
+        return strategies[split_strategy](time_series, rows, mode=mode, stations=stations)
+
+    @profiled
+    def index_split_train_test_val(self,
+                                   time_series: pd.DataFrame,
+                                   rows: Union[np.ndarray, None] = None,
+                                   split_strategy: Union[str, None] = None
+                                   ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Same splits as split_train_test_val, returned as row positions in time_series"""
+
+        self._check_split_strategy_is_correct()
+
+        strat_t = self.config["split_strategy_test"]
+        strat_v = self.config["split_strategy_val"]
+
+        if rows is None:
+            rows = np.arange(len(time_series))
+
+        rows_train, rows_test = self.index_split_wrapper(time_series,
+                                                         rows,
+                                                         mode="test",
+                                                         split_strategy=split_strategy)
+
+        if "time_and_space" == strat_t and "time_and_space" == strat_v:
+            rows_ts = rows
+        else:
+            rows_ts = rows_train
+
+        if self.config["stations_val"]:
+            rows_train, rows_val = self.index_split_wrapper(time_series,
+                                                            rows_ts,
+                                                            mode="val",
+                                                            split_strategy=split_strategy)
+        else:
+            rows_val = np.array([], dtype=np.int64)
+        return rows_train, rows_test, rows_val
+
+
 class Loader:
 
     def __init__(self, config: dict) -> None:
@@ -347,6 +669,14 @@ class ResultsSetter:
                                  ) -> Union[bool]:
         return isinstance(results, tuple) and len(results) > 1 and self.config.get("get_intermediate_output", False)
 
+    def nn_output2values(self,
+                         result: MutableSequence[float]
+                         ) -> np.ndarray:
+        if "component" in self.config["type_of_output"]:
+            return np.sqrt(result[0] ** 2 + result[1] ** 2)
+        else:
+            return np.squeeze(result)
+
     def _nn_output2df(self,
                       result: MutableSequence[float],
                       names: MutableSequence[str],
@@ -355,10 +685,7 @@ class ResultsSetter:
 
         df = pd.DataFrame()
         df["name"] = names
-        if "component" in self.config["type_of_output"]:
-            df[name_uv] = np.sqrt(result[0] ** 2 + result[1] ** 2)
-        else:
-            df[name_uv] = np.squeeze(result)
+        df[name_uv] = self.nn_output2values(result)
 
         return df[["name", name_uv]]
 
@@ -429,9 +756,11 @@ class CustomDataHandler:
         self.splitter = Splitter(config)
         self.loader = Loader(config)
         self.results_setter = ResultsSetter(config)
+        self.tfrecord_store = TFRecordStore(config)
 
         # Attributes defined later
         self.dict_topos = None
+        self.uncentered_topos = None
         self.inputs_train = None
         self.inputs_test = None
         self.inputs_val = None
@@ -448,6 +777,10 @@ class CustomDataHandler:
         self.names_test = None
         self.names_val = None
         self.names_other_countries = None
+        self.rows_train = None
+        self.rows_test = None
+        self.rows_val = None
+        self.rows_other_countries = None
         self.mean_standardize = None
         self.std_standardize = None
         self.is_prepared = None
@@ -468,6 +801,7 @@ class CustomDataHandler:
         self.idx_x_other_countries = None
         self.idx_y_other_countries = None
 
+    @profiled
     def _select_all_variables_needed(self,
                                      df: pd.DataFrame,
                                      variables_needed: Union[bool, None] = None
@@ -479,6 +813,7 @@ class CustomDataHandler:
             self.variables_needed.remove("ZS")
         return df[variables_needed]
 
+    @profiled
     def add_topo_carac_time_series(self,
                                    time_series: pd.DataFrame,
                                    stations: pd.DataFrame
@@ -492,6 +827,7 @@ class CustomDataHandler:
                     time_series.loc[time_series["name"] == station, topo_carac] = value_topo_carac
         return time_series
 
+    @profiled
     def add_topographic_parameters_llt(self,
                                        time_series: pd.DataFrame
                                        ) -> pd.DataFrame:
@@ -537,6 +873,7 @@ class CustomDataHandler:
 
         return time_series
 
+    @profiled
     def reject_stations(self,
                         time_series: pd.DataFrame,
                         stations: pd.DataFrame
@@ -609,24 +946,6 @@ class CustomDataHandler:
         self.names_train = np.concatenate([res_neg_names, pos_names], axis=0)
         self.length_train = len(self.inputs_train)
 
-    @staticmethod
-    def _try_random_choice(list_stations: MutableSequence[str],
-                           station: pd.DataFrame,
-                           patience: int = 10,
-                           stations_to_exclude: MutableSequence = []
-                           ) -> MutableSequence[str]:
-        i = 0
-        while i < patience:
-            station_name = np.random.choice(station["name"].values)
-            station_already_selected = (station_name in list_stations) or (station_name in stations_to_exclude)
-            if station_already_selected:
-                print(station_name, patience)
-                i += 1
-            else:
-                list_stations.append(station_name)
-                i = patience + 1
-        return list_stations
-
     @staticmethod
     def add_nwp_stats_to_stations(stations: pd.DataFrame,
                                   time_series: pd.DataFrame,
@@ -673,6 +992,7 @@ class CustomDataHandler:
         return df
 
     @staticmethod
+    @profiled
     def add_country_to_time_series(time_series: pd.DataFrame,
                                    stations: pd.DataFrame
                                    ) -> pd.DataFrame:
@@ -694,74 +1014,17 @@ class CustomDataHandler:
             df.loc[filter_alti, ["cat_zs"]] = f"{int(z_min)}m $\leq$ Station elevation $<$ {int(z_max)}m"
         return df
 
-    def _select_randomly_test_val_stations(self,
-                                           time_series: pd.DataFrame,
-                                           stations: pd.DataFrame,
-                                           mode: str,
-                                           stations_to_exclude: MutableSequence = []):
-        metric = self.config["metric_split"]
-
-        stations = self.add_nwp_stats_to_stations(stations, time_series, [metric])
-
-        if mode == "test":
-            list_parameters = self.config["parameters_split_test"]
-            list_stations = ["Col du Lac Blanc"]
-        else:
-            list_parameters = self.config["parameters_split_val"]
-            list_stations = []
-
-        for parameter in list_parameters:
-            print(f"Parameter: {parameter}")
-            q33 = np.quantile(stations[parameter].values, 0.33)
-            q66 = np.quantile(stations[parameter].values, 0.66)
-
-            small_values = stations[stations[parameter].values <= q33]
-            medium_values = stations[(q33 <= stations[parameter].values) & (stations[parameter].values < q66)]
-            large_values = stations[q66 <= stations[parameter].values]
-
-            for index, stratified_stations in enumerate([small_values, medium_values, large_values]):
-                q33_strat = np.nanquantile(stratified_stations[metric].values, 0.33)
-                q66_strat = np.nanquantile(stratified_stations[metric].values, 0.66)
-
-                first_q = stratified_stations[metric] < q33_strat
-                second_q = (q33_strat <= stratified_stations[metric]) & (stratified_stations[metric] < q66_strat)
-                third_q = q66_strat <= stratified_stations[metric]
-
-                strat_0 = stratified_stations[first_q]
-                strat_1 = stratified_stations[second_q]
-                strat_2 = stratified_stations[third_q]
-
-                for idx, station in enumerate([strat_0, strat_1, strat_2]):
-                    list_stations = self._try_random_choice(list_stations,
-                                                            station,
-                                                            patience=10,
-                                                            stations_to_exclude=stations_to_exclude)
-
-        return list_stations
-
+    @profiled
     def define_test_and_val_stations(self,
                                      time_series: pd.DataFrame,
                                      stations: pd.DataFrame
                                      ) -> None:
-        i = 0
+        from bias_correction.train.split_search import StationSplitSearch
 
         time_series, stations = self.reject_country(time_series, stations)
 
-        self.config["stations_test"] = []
-        self.config["stations_val"] = []
-        col_du_lac_blanc_not_in_test = "Col du Lac Blanc" not in self.config["stations_test"]
-        while col_du_lac_blanc_not_in_test:
-            i += 1
-            self.config["stations_test"] = self._select_randomly_test_val_stations(time_series,
-                                                                                   stations,
-                                                                                   mode="test")
-            self.config["stations_val"] = self._select_randomly_test_val_stations(time_series,
-                                                                                  stations,
-                                                                                  mode="val",
-                                                                                  stations_to_exclude=self.config[
-                                                                                      "stations_test"])
-
-            col_du_lac_blanc_not_in_test = "Col du Lac Blanc" not in self.config["stations_test"]
+        split_search = StationSplitSearch(self.config)
+        self.config["stations_test"], self.config["stations_val"] = split_search.search(time_series, stations)
 
     def _apply_quick_test(self,
                           time_series: pd.DataFrame
@@ -780,6 +1043,7 @@ class CustomDataHandler:
         self._set_is_prepared()
 
     @staticmethod
+    @profiled
     def add_month_and_hour_to_time_series(time_series: pd.DataFrame
                                           ) -> pd.DataFrame:
         time_series["month"] = time_series.index.month
@@ -799,14 +1063,11 @@ class CustomDataHandler:
         time_series["idx_y"] = np.random.randint(min_, max_ + 1, size=len(time_series))
         return time_series
 
-    def prepare_train_test_data(self,
-                                _shuffle: bool = True,
-                                variables_needed: bool = None):
-
-        # Pre-processing time_series
-        time_series = self.loader.load_time_series_pkl()
-        stations = self.loader.load_stations_pkl()
-
+    def _preprocess_time_series(self,
+                                time_series: pd.DataFrame,
+                                stations: pd.DataFrame,
+                                variables_needed: bool = None
+                                ) -> Tuple[pd.DataFrame, pd.DataFrame]:
         # Remove null wind speed (to fit direction, which is not defined for null speeds)
         if self.config.get("remove_null_speeds", False):
             print("\nRemoved null speeds.\n")
@@ -832,7 +1093,9 @@ class CustomDataHandler:
 
         # Random idx for uncentered training
         if self.config.get("random_idx", False):
-            time_series = self.generate_random_idx(time_series)
+            time_series = self.generate_random_idx(time_series,
+                                                   min_=self.config.get("random_idx_min", -25),
+                                                   max_=self.config.get("random_idx_max", 25))
 
         # Wind fields to wind components
         if (['U_obs'] in self.config["labels"]) or ('V_obs' in self.config["labels"]):
@@ -848,10 +1111,28 @@ class CustomDataHandler:
             self.define_test_and_val_stations(time_series, stations)
 
         # Dropna
-        time_series = time_series.dropna()
+        return time_series.dropna(), stations
+
+    @profiled
+    def prepare_train_test_data(self,
+                                _shuffle: bool = True,
+                                variables_needed: bool = None):
+
+        # Pre-processing time_series
+        time_series = self.loader.load_time_series_pkl()
+        stations = self.loader.load_stations_pkl()
+        self.config["data_end_date"] = str(time_series.index.max())
+        time_series, stations = self._preprocess_time_series(time_series, stations, variables_needed)
+
+        # Index split: splits are row positions and each mode is materialized once from time_series
+        if self.config.get("index_split", False):
+            self._set_data_from_index_split(time_series, stations)
+            self._finalize_train_test_data()
+            return
 
         # Shuffle
         if self.config.get("shuffle", True):
+            from sklearn.utils import shuffle
             time_series = shuffle(time_series)
 
         # Split time_series with countries
@@ -918,15 +1199,176 @@ class CustomDataHandler:
                 self.idx_x_other_countries = time_series_other_countries["idx_x"]
                 self.idx_y_other_countries = time_series_other_countries["idx_y"]
 
-        if self.config.get("standardize", True):
+        self._finalize_train_test_data()
+
+    @profiled
+    def prepare_incremental_data(self,
+                                 start_date: str,
+                                 mean: Union[pd.Series, None] = None,
+                                 std: Union[pd.Series, None] = None,
+                                 replay_ratio: float = 1.0,
+                                 seed: int = 42,
+                                 variables_needed: bool = None
+                                 ) -> None:
+        """
+        Prepare the rows observed after start_date, for fine-tuning a trained model.
+
+        New rows are split by station (stations_test, stations_val, stations_train of the previous experience in
+        train). Rejected stations and countries stay excluded. The train split is completed with a replay buffer of
+        replay_ratio * (new train rows) older rows of the train stations in the train period of the previous
+        experience, sampled before pre-processing so that only new and replayed rows are processed. mean and std are
+        the normalization of the trained model: they are not recomputed.
+        """
+        time_series = self.loader.load_time_series_pkl()
+        stations = self.loader.load_stations_pkl()
+        self.config["data_end_date"] = str(time_series.index.max())
+
+        is_new = time_series.index > pd.Timestamp(start_date)
+        stations_test = list(self.config["stations_test"]) if self.config["stations_test"] != "random" else []
+        stations_val = list(self.config["stations_val"]) if self.config["stations_val"] != "random" else []
+        is_train_station = self._is_previous_train_station(time_series, stations, stations_test + stations_val)
+        is_held_out = time_series["name"].isin(stations_test + stations_val).values
+        nb_new_train = int(np.sum(is_new & is_train_station))
+        if not np.any(is_new):
+            raise ValueError(f"No observation after {start_date} in {self.config['time_series']}")
+
+        # Replay buffer of older rows, in the train stations and the train period of the previous experience
+        rows_old = np.flatnonzero(~is_new & is_train_station & self._is_previous_train_period(time_series.index))
+        rng = np.random.default_rng(seed)
+        nb_replay = min(len(rows_old), int(replay_ratio * nb_new_train))
+        rows_replay = rng.choice(rows_old, size=nb_replay, replace=False)
+        is_replay = np.zeros(len(time_series), dtype=bool)
+        is_replay[rows_replay] = True
+
+        # Rejected stations and stations of rejected countries are neither fine-tuned on nor evaluated
+        time_series = time_series[(is_new & (is_train_station | is_held_out)) | is_replay]
+        print(f"Incremental data: {int(np.sum(is_new))} new rows after {start_date}, {nb_replay} replayed rows",
+              flush=True)
+
+        variables_needed = variables_needed or copy(self.variables_needed)
+        time_series, stations = self._preprocess_time_series(time_series, stations, variables_needed)
+
+        names = time_series["name"]
+        filters = {"train": ~names.isin(stations_test + stations_val),
+                   "test": names.isin(stations_test),
+                   "val": names.isin(stations_val)}
+        for mode, filter_mode in filters.items():
+            time_series_mode = time_series[filter_mode]
+            if mode == "train" and self.config.get("shuffle", True):
+                time_series_mode = time_series_mode.sample(frac=1, random_state=seed)
+            if mode != "train" and time_series_mode.empty:
+                continue
+            setattr(self, f"inputs_{mode}", time_series_mode[self.config["input_variables"]])
+            setattr(self, f"labels_{mode}", time_series_mode[self.config["labels"]])
+            setattr(self, f"names_{mode}", time_series_mode["name"])
+            setattr(self, f"length_{mode}", len(time_series_mode))
+            if self.config.get("random_idx", False):
+                setattr(self, f"idx_x_{mode}", time_series_mode["idx_x"])
+                setattr(self, f"idx_y_{mode}", time_series_mode["idx_y"])
+        self.config["stations_train"] = self._get_train_stations(pd.DataFrame({"name": self.names_train.values}))
+
+        self.mean_standardize = mean
+        self.std_standardize = std
+        self._finalize_train_test_data(compute_norm=mean is None)
+
+    def _is_previous_train_station(self,
+                                   time_series: pd.DataFrame,
+                                   stations: pd.DataFrame,
+                                   stations_test_val: List[str]
+                                   ) -> np.ndarray:
+        """Rows of the train stations of the previous experience (stations_train of its config)"""
+        if self.config.get("stations_train"):
+            return time_series["name"].isin(self.config["stations_train"]).values
+        names_rejected = list(self.config.get("stations_to_reject", []))
+        if self.config.get("country_to_reject_during_training", False):
+            countries_to_reject = self.config["country_to_reject_during_training"]
+            names_rejected += list(stations["name"][stations["country"].isin(countries_to_reject)].values)
+        return (~time_series["name"].isin(stations_test_val + names_rejected)).values
+
+    def _is_previous_train_period(self,
+                                  index: pd.DatetimeIndex
+                                  ) -> np.ndarray:
+        """Rows before the test/val periods of the previous experience, for time based splits"""
+        is_train_period = np.ones(len(index), dtype=bool)
+        for mode in ["test", "val"]:
+            if "time" in self.config.get(f"split_strategy_{mode}", ""):
+                is_train_period &= index < pd.Timestamp(self.config[f"date_split_train_{mode}"])
+        return is_train_period
+
+    @profiled
+    def _finalize_train_test_data(self,
+                                  compute_norm: bool = True
+                                  ) -> None:
+        if self.config.get("standardize", True) and compute_norm:
             self.mean_standardize = self.inputs_train.mean()
             self.std_standardize = self.inputs_train.std()
 
         if self.config.get("unbalanced_dataset", False):
             self.unbalance_training_dataset()
 
+        for mode in ["train", "test", "val"]:
+            if getattr(self, f"inputs_{mode}") is not None:
+                profiler.count(f"rows_{mode}", len(getattr(self, f"inputs_{mode}")))
+
         self._set_is_prepared()
 
+    @profiled
+    def _set_data_from_index_split(self,
+                                   time_series: pd.DataFrame,
+                                   stations: pd.DataFrame
+                                   ) -> None:
+        rows = np.arange(len(time_series))
+
+        # Shuffle
+        if self.config.get("shuffle", True):
+            from sklearn.utils import shuffle
+            rows = shuffle(rows)
+
+        # Split time_series with countries
+        if self.config.get("country_to_reject_during_training", False):
+            rows, rows_other_countries = self.splitter.index_split_wrapper(time_series,
+                                                                           rows,
+                                                                           stations=stations,
+                                                                           split_strategy="country")
+
+        # Stations train
+        self.config[f"stations_train"] = self._get_train_stations(pd.DataFrame({"name": time_series["name"].values[rows]}))
+
+        # train/test split
+        split_strategy = "random" if self.config[f"quick_test"] else None
+        rows_train, rows_test, rows_val = self.splitter.index_split_train_test_val(time_series,
+                                                                                   rows,
+                                                                                   split_strategy=split_strategy)
+        rows_by_mode = {"train": rows_train, "test": rows_test}
+        if self.config["stations_val"]:
+            rows_by_mode["val"] = rows_val
+
+        # Other countries
+        if self.config.get("country_to_reject_during_training", False):
+            _, rows_by_mode["other_countries"] = self.splitter.index_split_wrapper(time_series,
+                                                                                   rows_other_countries,
+                                                                                   mode="test",
+                                                                                   split_strategy="time")
+
+        # Each mode is materialized once, from columns selected once
+        inputs = time_series[self.config["input_variables"]]
+        labels = time_series[self.config["labels"]]
+        for mode, rows_mode in rows_by_mode.items():
+            setattr(self, f"rows_{mode}", rows_mode)
+            setattr(self, f"inputs_{mode}", inputs.iloc[rows_mode])
+            setattr(self, f"labels_{mode}", labels.iloc[rows_mode])
+            setattr(self, f"names_{mode}", time_series["name"].iloc[rows_mode])
+            setattr(self, f"length_{mode}", len(rows_mode))
+            if self.config.get("random_idx", False):
+                setattr(self, f"idx_x_{mode}", time_series["idx_x"].iloc[rows_mode])
+                setattr(self, f"idx_y_{mode}", time_series["idx_y"].iloc[rows_mode])
+
+    def get_rows(self,
+                 mode: str
+                 ) -> np.ndarray:
+        """Row positions of a mode in the prepared time_series (only with config["index_split"])"""
+        return getattr(self, f"rows_{mode}")
+
     def get_inputs(self,
                    mode: str
                    ) -> Union[pd.Series, pd.DataFrame]:
@@ -962,19 +1404,28 @@ class CustomDataHandler:
     def get_std(self) -> MutableSequence[float]:
         return self.std_standardize
 
+    def get_uncentered_topos(self) -> UncenteredTopos:
+        """Resident 280 x 280 topographies of all the stations, loaded once"""
+        if self.uncentered_topos is None:
+            stations = self.get_stations()
+            self.uncentered_topos = UncenteredTopos(stations["name"].unique(), self.config)
+        return self.uncentered_topos
+
     def get_tf_uncentered_topos(self,
                                 mode: Union[str, None] = None,
                                 names: Union[MutableSequence[str], None] = None,
                                 idx_x: Union[MutableSequence[str], None] = None,
                                 idx_y: Union[MutableSequence[str], None] = None,
-                                ) -> tf.data.Dataset:
-
-        output_shapes = (140, 140, 1)
-
+                                ) -> 'tf.data.Dataset':
+        """
+        Training maps get new random offsets at each epoch if config["random_idx_per_epoch"].
+        Other modes, and explicit idx_x/idx_y, use the offsets drawn by generate_random_idx.
+        """
         if names is None:
             names = self.get_names(mode)
 
-        if (idx_x is None) and (idx_y is None):
+        random_per_epoch = mode == "train" and self.config.get("random_idx_per_epoch", True)
+        if (idx_x is None) and (idx_y is None) and not random_per_epoch:
             idx_x, idx_y = self.get_idx(mode)
 
         if hasattr(names, "values"):
@@ -986,16 +1437,15 @@ class CustomDataHandler:
         if hasattr(idx_y, "values"):
             idx_y = idx_y.values
 
-        topos_generator = MapGeneratorUncentered(names, idx_x=idx_x, idx_y=idx_y, config=self.config)
-
-        return tf.data.Dataset.from_generator(topos_generator, output_types=tf.float32, output_shapes=output_shapes)
+        return self.get_uncentered_topos().get_dataset(names, idx_x=idx_x, idx_y=idx_y)
 
     def get_tf_map(self,
                    names_map: MutableSequence,
                    mode: str,
                    names: Union[MutableSequence[str], None] = None,
                    output_shapes: MutableSequence = [140, 140, 1],
-                   ) -> tf.data.Dataset:
+                   ) -> 'tf.data.Dataset':
+        import tensorflow as tf
 
         output_shapes[2] = len(self.config["map_variables"])
 
@@ -1011,7 +1461,8 @@ class CustomDataHandler:
 
     def get_tf_mean_std(self,
                         mode: str
-                        ) -> Tuple[tf.data.Dataset, tf.data.Dataset]:
+                        ) -> Tuple['tf.data.Dataset', 'tf.data.Dataset']:
+        import tensorflow as tf
         length = self.get_length(mode)
         mean = self.get_mean()
         std = self.get_std()
@@ -1050,8 +1501,11 @@ class CustomDataHandler:
                              mode: str = "test",
                              inputs: Union[pd.Series, pd.DataFrame, None] = None,
                              names: MutableSequence["str"] = None,
-                             output_shapes: MutableSequence = [140, 140, 1]
-                             ) -> tf.data.Dataset:
+                             output_shapes: MutableSequence = [140, 140, 1],
+                             idx_x: MutableSequence[float] = None,
+                             idx_y: MutableSequence[float] = None
+                             ) -> 'tf.data.Dataset':
+        import tensorflow as tf
 
         output_shapes[2] = len(self.config["map_variables"])
 
@@ -1073,7 +1527,9 @@ class CustomDataHandler:
             return tf.data.Dataset.zip((self.get_tf_map_inputs(mode=mode,
                                                                names=names,
                                                                output_shapes=output_shapes,
-                                                               uncentered=uncentered),
+                                                               uncentered=uncentered,
+                                                               idx_x=idx_x,
+                                                               idx_y=idx_y),
                                         inputs,
                                         mean,
                                         std))
@@ -1081,12 +1537,15 @@ class CustomDataHandler:
             return tf.data.Dataset.zip((self.get_tf_map_inputs(mode=mode,
                                                                names=names,
                                                                output_shapes=output_shapes,
-                                                               uncentered=uncentered),
+                                                               uncentered=uncentered,
+                                                               idx_x=idx_x,
+                                                               idx_y=idx_y),
                                         inputs))
 
     def _get_all_zipped(self,
                         mode: str
-                        ) -> tf.data.Dataset:
+                        ) -> 'tf.data.Dataset':
+        import tensorflow as tf
         labels = self.get_labels(mode)
 
         if hasattr(labels, "values"):
@@ -1119,7 +1578,8 @@ class CustomDataHandler:
                                     names: MutableSequence["str"] = None,
                                     output_shapes: MutableSequence = [140, 140, 1],
                                     labels: Union[pd.Series, pd.DataFrame] = None
-                                    ) -> tf.data.Dataset:
+                                    ) -> 'tf.data.Dataset':
+        import tensorflow as tf
         if labels is None:
             labels = self.get_labels(mode)
 
@@ -1132,6 +1592,36 @@ class CustomDataHandler:
         inputs = self.get_tf_zipped_inputs(mode=mode, inputs=inputs, names=names, output_shapes=output_shapes)
         return tf.data.Dataset.zip((inputs, labels))
 
+    @profiled
+    def export_tfrecords(self,
+                         modes: MutableSequence[str] = ("train", "val", "test")
+                         ) -> None:
+        """Export the prepared splits to sharded TFRecord files (see TFRecordStore)"""
+        assert self.is_prepared
+        for mode in modes:
+            self.tfrecord_store.export(self, mode)
+
+    def get_tfrecord_dataset(self,
+                             mode: str,
+                             nb_workers: int = 1,
+                             worker_index: int = 0
+                             ) -> 'tf.data.Dataset':
+        """Unbatched dataset read from the TFRecord files, with the structure of get_tf_zipped_inputs_labels"""
+        if self.config["standardize"]:
+            mean, std = self.get_mean(), self.get_std()
+        else:
+            mean, std = None, None
+        parameters = self.batcher.get_pipeline_parameters(mode)
+        return self.tfrecord_store.read(mode,
+                                        mean=mean,
+                                        std=std,
+                                        nb_workers=nb_workers,
+                                        worker_index=worker_index,
+                                        shuffle_shards=bool(parameters.get("shuffle_buffer")),
+                                        seed=parameters.get("seed"),
+                                        deterministic=parameters.get("deterministic", True) is not False,
+                                        random_crop=mode == "train" and self.config.get("random_idx_per_epoch", True))
+
     def get_time_series(self,
                         prepared: bool = False,
                         mode: bool = True
@@ -1204,20 +1694,55 @@ class CustomDataHandler:
                                   names: MutableSequence["str"] = None,
                                   output_shapes: MutableSequence = [140, 140, 1],
                                   labels: Union[pd.Series, pd.DataFrame] = None
-                                  ) -> DatasetV2:
+                                  ) -> 'DatasetV2':
 
         output_shapes[2] = len(self.config["map_variables"])
-        dataset = self.get_tf_zipped_inputs_labels(mode,
-                                                   inputs=inputs,
-                                                   names=names,
-                                                   output_shapes=output_shapes,
-                                                   labels=labels)
+        use_tfrecords = self.config.get("use_tfrecords", False) and inputs is None and names is None and labels is None
+        if use_tfrecords:
+            if not self.tfrecord_store.is_exported(mode):
+                self.tfrecord_store.export(self, mode)
+            dataset = self.get_tfrecord_dataset(mode)
+        else:
+            dataset = self.get_tf_zipped_inputs_labels(mode,
+                                                       inputs=inputs,
+                                                       names=names,
+                                                       output_shapes=output_shapes,
+                                                       labels=labels)
+        if self.config["type_of_output"] == "output_speed_and_dir":
+            dataset = self.split_speed_and_dir_labels(dataset)
+
         batch_func = {"train": self.batcher.batch_train,
                       "test": self.batcher.batch_test,
                       "val": self.batcher.batch_val}
 
         return batch_func[mode](dataset)
 
+    def split_speed_and_dir_labels(self,
+                                   dataset: 'tf.data.Dataset'
+                                   ) -> 'tf.data.Dataset':
+        """
+        One label and one sample weight per head of the double_ann, to fit speed and direction in one pass.
+
+        Direction is not defined for null speeds: the samples that remove_null_speeds_time_series removes when
+        fitting the direction alone (observed or AROME speed <= threshold_null_speed) get a null weight in the
+        direction loss instead.
+        """
+        import tensorflow as tf
+        idx_speed = self.config["labels"].index("vw10m(m/s)")
+        idx_dir = self.config["labels"].index("winddir(deg)")
+        idx_wind = self.config["input_variables"].index("Wind")
+        threshold = self.config["threshold_null_speed"]
+
+        def split(inputs, labels):
+            speed = labels[idx_speed]
+            direction = labels[idx_dir]
+            # inputs: (maps, nwp_inputs, ...), nwp_inputs are not standardized yet
+            wind_nwp = inputs[1][idx_wind]
+            weight_dir = tf.cast((speed > threshold) & (wind_nwp > threshold), tf.float32)
+            return inputs, (speed, direction), (tf.ones_like(weight_dir), weight_dir)
+
+        return dataset.map(split, num_parallel_calls=tf.data.AUTOTUNE)
+
     def set_predictions(self,
                         results: MutableSequence[float],
                         mode: str = "test",
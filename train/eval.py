@@ -1,25 +1,16 @@
 import numpy as np
 import pandas as pd
-import tensorflow as tf
-import matplotlib
-# matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import cm as cm_plt
 from typing import Union, List, MutableSequence, Tuple
 import uuid
 
-try:
-    import seaborn as sns
-
-    sns_ = True
-except (ImportError, ModuleNotFoundError):
-    sns_ = False
+# Tensorflow, matplotlib and seaborn are imported inside the methods that need them
 
 from bias_correction.train.visu import VizualizationResults, save_figure
-from bias_correction.train.metrics import get_metric
+from bias_correction.train.metrics import get_metric, grouped_metrics, grouped_metrics_available
 from bias_correction.train.dataloader import CustomDataHandler
 from bias_correction.train.experience_manager import ExperienceManager
 import bias_correction.train.dataframe_computer as computer
+from bias_correction.utils_bc.instrumentation import profiled
 
 
 class CustomEvaluation(VizualizationResults):
@@ -169,10 +160,17 @@ class CustomEvaluation(VizualizationResults):
                    keys: MutableSequence[str],
                    print_: bool = False
                    ) -> list:
-        metric_func = get_metric(metric_name)
+        if metric_name in grouped_metrics_available:
+            # Aggregated metrics of all models are computed in one pass
+            df_metrics = grouped_metrics(df, key_obs, keys, metrics=(metric_name,))
+            metric_by_key = dict(zip(df_metrics["model"], df_metrics[metric_name]))
+        else:
+            metric_func = get_metric(metric_name)
+            metric_by_key = {key: metric_func(df[key_obs].values, df[key].values) for key in keys}
         results = []
         for key in keys:
-            metric = metric_func(df[key_obs].values, df[key].values)
+            # No row (e.g. empty df): no metric
+            metric = metric_by_key.get(key, np.nan)
             if print_:
                 print(f"\n{metric_name} {key}", flush=True)
                 print(metric, flush=True)
@@ -180,6 +178,7 @@ class CustomEvaluation(VizualizationResults):
             results.append(metric)
         return results
 
+    @profiled
     def df2metric(self,
                   metric_name: str,
                   print_: bool = False
@@ -241,10 +240,6 @@ class CustomEvaluation(VizualizationResults):
     def df2correlation(self,
                        print_: bool = False
                        ) -> list:
-        for station in self.df_results["name"].unique():
-            filter_station = self.df_results["name"] == station
-            self.df_results.loc[filter_station, :] = self.df_results.loc[filter_station, :].sort_index()
-
         return self.df2metric("corr", print_=print_)
 
     def df2ae_dir(self,
@@ -252,6 +247,14 @@ class CustomEvaluation(VizualizationResults):
                   ) -> list:
         return self._df2metric(self.df_results, "mean_abs_bias_direction", self.key_obs, self.keys, print_=print_)
 
+    @profiled
+    def df2grouped_metrics(self,
+                           groupby: Union[str, List[str], None] = None,
+                           metrics: Tuple[str, ...] = ("mbe", "mae", "rmse", "corr")
+                           ) -> pd.DataFrame:
+        """Metrics of each model by group (e.g. ["name", "month"], "lead_time" or "class_alti0")"""
+        return grouped_metrics(self.df_results, self.key_obs, self.keys, groupby=groupby, metrics=metrics)
+
     def df2mean(self):
         return
 
@@ -278,11 +281,210 @@ class CustomEvaluation(VizualizationResults):
         return mae, rmse, mbe, corr
 
 
+class StreamingEvaluation(VizualizationResults):
+    """
+    Metrics of a mode computed while predictions come out of the model, without building df_results.
+
+    Each batch of predictions updates one StreamingGroupedMetrics per groupby (None for the whole mode).
+    Group keys are "name", "lead_time", attributes of the time index ("month", "hour"...) and station
+    characteristics ("alti", "country", "class_alti0", "class_mu"...). Memory does not depend on the number of rows.
+    """
+
+    def __init__(self,
+                 exp: ExperienceManager,
+                 data: CustomDataHandler,
+                 custom_model,
+                 mode: str = "test",
+                 groupbys: Tuple[Union[str, List[str], None], ...] = (None, "name", "month", "lead_time", "class_alti0"),
+                 metrics: Tuple[str, ...] = ("mbe", "mae", "rmse", "corr"),
+                 stations_to_remove: Union[List[str], List] = [],
+                 batch_size: int = 1024,
+                 quantile_sketch_k: Union[int, None] = None
+                 ):
+        from bias_correction.train.metrics import StreamingGroupedMetrics
+
+        super().__init__(exp)
+
+        self.exp = exp
+        self.data = data
+        self.cm = custom_model
+        self.mode = mode
+        self.current_variable = self.exp.get_config()["current_variable"]
+        self.key_obs = f"{self.current_variable}_obs"
+        self.key_AROME = f"{self.current_variable}_AROME"
+        self.key_nn = f"{self.current_variable}_nn"
+        self.keys = [self.key_AROME, self.key_nn]
+        self.stations_to_remove = stations_to_remove
+        self.batch_size = batch_size
+        self.stations = None
+        self.accumulators = {self.get_groupby_name(groupby): StreamingGroupedMetrics(self.keys,
+                                                                                      groupby=groupby,
+                                                                                      metrics=metrics,
+                                                                                      quantile_sketch_k=quantile_sketch_k)
+                             for groupby in groupbys}
+
+    @staticmethod
+    def get_groupby_name(groupby: Union[str, List[str], None]) -> str:
+        if groupby is None:
+            return "all"
+        return groupby if isinstance(groupby, str) else "/".join(groupby)
+
+    def _get_station_characteristics(self) -> pd.DataFrame:
+        """Topographic characteristics and classes of each station, computed once"""
+        if self.stations is None:
+            stations = self.data.get_stations()
+            stations = computer.classify_topo_carac(stations, stations.copy(), config=self.exp.config)
+            self.stations = computer.classify_alti(stations).drop_duplicates("name").set_index("name")
+        return self.stations
+
+    def _get_group_values(self,
+                          key: str,
+                          names: np.ndarray,
+                          time: pd.DatetimeIndex
+                          ) -> np.ndarray:
+        if key in ["name", "station"]:
+            return names
+        if key == "lead_time":
+            return (time.hour.values - 6) % 24 + 6
+        if hasattr(time, key):
+            return np.asarray(getattr(time, key))
+        return self._get_station_characteristics()[key].reindex(names).values
+
+    def _get_obs_and_arome(self,
+                           rows: slice
+                           ) -> Tuple[np.ndarray, np.ndarray]:
+        labels = self.data.get_labels(self.mode)
+        inputs = self.data.get_inputs(self.mode)
+        if "component" in self.data.config["type_of_output"]:
+            obs = np.sqrt(labels["U_obs"].values[rows] ** 2 + labels["V_obs"].values[rows] ** 2)
+        else:
+            obs = np.asarray(labels.values)[rows]
+        name_arome = {"UV": "Wind", "UV_DIR": "Wind_DIR", "T2m": "Tair"}[self.current_variable]
+        return np.ravel(obs), inputs[name_arome].values[rows]
+
+    @profiled
+    def run(self) -> 'StreamingEvaluation':
+        from bias_correction.train.batched_predictor import BatchedPredictor
+
+        predictor = BatchedPredictor(self.data, self.cm.model, mode=self.mode, batch_size=self.batch_size)
+        predict_fn = predictor._get_predict_fn()
+        names = np.asarray(self.data.get_names(self.mode))
+        time = pd.DatetimeIndex(self.data.get_inputs(self.mode).index)
+        group_keys = {key for accumulator in self.accumulators.values() for key in accumulator.groupby}
+
+        index = 0
+        for batch in predictor.get_dataset():
+            index_end = index + int(batch[1].shape[0])
+            rows = slice(index, index_end)
+            obs, arome = self._get_obs_and_arome(rows)
+            predictions = {self.key_AROME: arome,
+                           self.key_nn: predictor.output2values(predict_fn(tuple(batch)))}
+            groups = {key: self._get_group_values(key, names[rows], time[rows]) for key in group_keys}
+
+            if self.stations_to_remove:
+                keep = ~np.isin(names[rows], self.stations_to_remove)
+                obs = obs[keep]
+                predictions = {key: values[keep] for key, values in predictions.items()}
+                groups = {key: values[keep] for key, values in groups.items()}
+
+            for accumulator in self.accumulators.values():
+                accumulator.update(obs, predictions, groups)
+            index = index_end
+
+        return self
+
+    @profiled
+    def df2grouped_metrics(self,
+                           groupby: Union[str, List[str], None] = None
+                           ) -> pd.DataFrame:
+        """Same table as CustomEvaluation.df2grouped_metrics, for a groupby given at initialization"""
+        return self.accumulators[self.get_groupby_name(groupby)].result()
+
+    def df2metric(self,
+                  metric_name: str,
+                  print_: bool = False
+                  ) -> list:
+        df_metrics = self.df2grouped_metrics().set_index("model")
+        results = []
+        for key in self.keys:
+            metric = df_metrics.loc[key, metric_name]
+            if print_:
+                print(f"\n{metric_name} {key}", flush=True)
+                print(metric, flush=True)
+                print(f"\n{metric_name}{key} nb of obs: {df_metrics.loc[key, 'nb_obs']}", flush=True)
+            results.append(metric)
+        return results
+
+    def df2quantiles(self,
+                     q: Union[List[float], np.ndarray],
+                     groupby: Union[str, List[str], None] = None
+                     ) -> pd.DataFrame:
+        """Quantiles of observations and models by group (requires quantile_sketch_k)"""
+        return self.accumulators[self.get_groupby_name(groupby)].quantiles(q)
+
+    def get_sketches(self,
+                     groupby: Union[str, List[str], None] = None,
+                     group: Union[tuple, None] = None
+                     ) -> dict:
+        """QuantileSketch of the observations ("obs") and of each model, e.g. for visu.QQplot.qq_sketches"""
+        accumulator = self.accumulators[self.get_groupby_name(groupby)]
+        return {key: accumulator.get_sketch(key, group) for key in ["obs"] + self.keys}
+
+    def df2mae(self,
+               print_: bool = False
+               ) -> list:
+        return self.df2metric("mae", print_=print_)
+
+    def df2rmse(self,
+                print_: bool = False
+                ) -> list:
+        return self.df2metric("rmse", print_=print_)
+
+    def df2mbe(self,
+               print_: bool = False
+               ) -> list:
+        return self.df2metric("mbe", print_=print_)
+
+    def df2correlation(self,
+                       print_: bool = False
+                       ) -> list:
+        return self.df2metric("corr", print_=print_)
+
+    def print_stats(self
+                    ) -> Tuple[list, list, list, list]:
+
+        mae = self.df2mae(print_=True)
+        rmse = self.df2rmse(print_=True)
+        mbe = self.df2mbe(print_=True)
+        corr = self.df2correlation(print_=True)
+
+        return mae, rmse, mbe, corr
+
+
 class StaticEval(VizualizationResults):
 
     def __init__(self, exp=None):
         super().__init__(exp)
 
+    @staticmethod
+    def _print_stats_by_mode(df_metrics: pd.DataFrame
+                             ) -> None:
+        for _, row in df_metrics.iterrows():
+            print(f"Mode: {row['mode']},  "
+                  f"Nb stations: {row['nb_stations']},  "
+                  f"bias: {np.round(row['mbe'], 2): .2f},  "
+                  f"rmse: {np.round(row['rmse'], 2): .2f},  "
+                  f"corr: {np.round(row['corr'], 2): .2f},  "
+                  f"mae: {np.round(row['mae'], 2): .2f}")
+
+    @staticmethod
+    def _grouped_stats(time_series: pd.DataFrame,
+                       groupby: List[str]
+                       ) -> pd.DataFrame:
+        df_metrics = grouped_metrics(time_series, "vw10m(m/s)", ["Wind"], groupby=groupby)
+        nb_stations = time_series.groupby(groupby)["name"].nunique().rename("nb_stations")
+        return df_metrics.merge(nb_stations, left_on=groupby, right_index=True)
+
     @staticmethod
     def print_train_test_val_stats_above_elevation(stations, time_series):
         assert "mode" in time_series
@@ -292,29 +494,9 @@ class StaticEval(VizualizationResults):
 
         for alti in np.linspace(0, 2500, 6):
             print(f"\n Alti >= {np.round(alti)}m")
-            for mode in stations["mode"].unique():
-                filter_mode = time_series["mode"] == mode
-                filter_alti = time_series["alti"] >= alti
-
-                nwp = time_series.loc[filter_mode & filter_alti, "Wind"].values
-                obs = time_series.loc[filter_mode & filter_alti, "vw10m(m/s)"].values
-                nb_stations = len(time_series.loc[filter_mode & filter_alti, "name"].unique())
-
-                try:
-                    results = []
-                    for metric in ["mbe", "rmse", "corr", "mae"]:
-                        metric_func = get_metric(metric)
-                        result = metric_func(obs, nwp)
-                        results.append(result)
-
-                    print(f"Mode: {mode},  "
-                          f"Nb stations, {nb_stations},  "
-                          f"bias: {np.around(results[0], 2): .2f},  "
-                          f"rmse: {np.around(results[1], 2): .2f},  "
-                          f"corr: {np.around(results[2], 2): .2f},  "
-                          f"mae: {np.around(results[3], 2): .2f}")
-                except ValueError:
-                    print(f"ValueError for {mode} and {alti}")
+            filter_alti = time_series["alti"] >= alti
+            df_metrics = StaticEval._grouped_stats(time_series[filter_alti], ["mode"])
+            StaticEval._print_stats_by_mode(df_metrics)
 
     @staticmethod
     def print_train_test_val_stats_by_elevation_category(stations, time_series,
@@ -326,39 +508,23 @@ class StaticEval(VizualizationResults):
         time_series = time_series[["name", "mode", "alti", "Wind", "vw10m(m/s)"]].dropna()
 
         print("\n\nGeneral results")
+        df_metrics = grouped_metrics(time_series, "vw10m(m/s)", ["Wind"], groupby="mode")
         for metric in ["mbe", "rmse", "corr", "mae"]:
-            for mode in stations["mode"].unique():
-                filter_mode = time_series["mode"] == mode
-                nwp = time_series.loc[filter_mode, "Wind"].values
-                obs = time_series.loc[filter_mode, "vw10m(m/s)"].values
-                metric_func = get_metric(metric)
-                result = metric_func(obs, nwp)
+            for mode, result in zip(df_metrics["mode"], df_metrics[metric]):
                 print(f"{mode}_{metric}: {result}")
 
-        for alti_min, alti_max in zip(list_min, list_max):
-            print(f"\n Alti category = {np.int(alti_min), np.int(alti_max)}m")
-            for mode in stations["mode"].unique():
-                filter_mode = time_series["mode"] == mode
-                filter_alti = (time_series["alti"] >= alti_min) & (time_series["alti"] < alti_max)
-                nwp = time_series.loc[filter_mode & filter_alti, "Wind"].values
-                obs = time_series.loc[filter_mode & filter_alti, "vw10m(m/s)"].values
-                nb_stations = len(time_series.loc[filter_mode & filter_alti, "name"].unique())
-
-                try:
-                    results = []
-                    for metric in ["mbe", "rmse", "corr", "mae"]:
-                        metric_func = get_metric(metric)
-                        result = metric_func(obs, nwp)
-                        results.append(result)
-
-                    print(f"Mode: {mode},  "
-                          f"Nb stations: {nb_stations},  "
-                          f"bias: {np.round(results[0], 2): .2f},  "
-                          f"rmse: {np.round(results[1], 2): .2f},  "
-                          f"corr: {np.round(results[2], 2): .2f},  "
-                          f"mae: {np.round(results[3], 2): .2f}")
-                except ValueError:
-                    print(f"ValueError for {mode} and [{alti_min}, {alti_max}]")
+        # Elevation categories are [alti_min, alti_max[ intervals: int8 codes computed in a single pass
+        time_series = time_series.copy()
+        alti = time_series["alti"].values
+        alti_category = (np.digitize(alti, list_min) - 1).astype(np.int8)
+        outside = (alti_category < 0) | ~(alti < np.asarray(list_max)[alti_category.clip(0)])
+        alti_category[outside] = -1
+        time_series["alti_category"] = alti_category
+        df_metrics = StaticEval._grouped_stats(time_series, ["alti_category", "mode"])
+
+        for idx, (alti_min, alti_max) in enumerate(zip(list_min, list_max)):
+            print(f"\n Alti category = {int(alti_min), int(alti_max)}m")
+            StaticEval._print_stats_by_mode(df_metrics[df_metrics["alti_category"] == idx])
 
 
 class Interpretability(VizualizationResults):
@@ -368,86 +534,37 @@ class Interpretability(VizualizationResults):
         self.data = data
         self.cm = custom_model
 
-    def compute_feature_importance(self, mode, epsilon=0.01, cv="UV"):
-
-        # Initialize list results
-        list_results_ae = []
-
-        # Get inputs and length
-        inputs = self.data.get_inputs(mode)
-        length_batch = self.data.get_length(mode)
-
-        # Batch input
-        inputs_tf = self.data.get_tf_zipped_inputs(inputs=inputs).batch(length_batch)
-
-        # Predict
-        with tf.device('/GPU:0'):
-            results = self.cm.predict_single_bath(inputs_tf)
-
-        # Calculate the new RMSE
-        self.data.set_predictions(results, mode=mode)
-        c_eval = CustomEvaluation(self.exp, self.data, mode="test", keys=("_nn",), other_models=None, quick=True)
-
-        # Initial absolute error
-        if cv == "UV":
-            ae = np.array(c_eval.df2ae()[0])  # Vector
-        else:
-            ae = np.array(c_eval.df2ae_dir()[0])  # Vector
-
-        for idx_pred, predictor in enumerate(inputs):
-
-            print("\nFeature importance:")
-            print(predictor)
-
-            # Create a copy of X_test
-            inputs_copy = inputs.copy()
-
-            # Scramble the values of the given predictor
-            inputs_copy[predictor] = inputs[predictor].sample(frac=1).values
-
-            # Prepare dataset
-            inputs_tf = self.data.get_tf_zipped_inputs(inputs=inputs_copy).batch(length_batch)
-
-            # Predict
-            with tf.device('/GPU:0'):
-                results_permutation = self.cm.predict_single_bath(inputs_tf)
-
-            # Calculate the new metrics
-            self.data.set_predictions(results_permutation, mode=mode)
-            c_eval = CustomEvaluation(self.exp, self.data, mode=mode, other_models=None, keys=("_nn",), quick=True)
-            if cv == "UV":
-                ae_permuted = np.array(c_eval.df2ae()[0])  # Vector
-            else:
-                ae_permuted = np.array(c_eval.df2ae_dir()[0])  # Vector
-
-            # Metrics
-            metric_ae = 100 * (ae_permuted - ae) / (ae + epsilon)
+    @profiled
+    def compute_feature_importance(self, mode, epsilon=0.01, cv="UV", n_repeats=1, batch_size=1024, seed=42):
+        from bias_correction.train.feature_importance import PermutationImportance
 
-            # Label names
-            str_ae = r'$\frac{Absolute error_{permuted} - Absolute error_{not \quad permuted}}{Absolute error_{not \quad permuted}}$ [%]'
+        self.cm.select_model(model_version="last", print_=False)
+        engine = PermutationImportance(self.data,
+                                       self.cm.model,
+                                       mode=mode,
+                                       cv=cv,
+                                       n_repeats=n_repeats,
+                                       batch_size=batch_size,
+                                       seed=seed,
+                                       epsilon=epsilon)
+        df_ae = engine.compute()
 
-            list_results_ae.append({'Predictor': predictor,
-                                    str_ae: np.nanmean(metric_ae),
-                                    "std": np.nanstd(ae)})
-
-        # Put the results into a pandas dataframe and rank the predictors by score
-        df_ae = pd.DataFrame(list_results_ae).sort_values(by=str_ae, ascending=False)
-
-        return None, df_ae, None, str_ae
+        return None, df_ae, None, engine.str_ae
 
     def _plot_bar_with_error(self, df, x, y, err, name, width=0.01, figsize=(15, 12)):
         x = df[x].values
         y0 = df[y].values
         yerr = df[err].values
+        import matplotlib.pyplot as plt
         plt.figure(figsize=figsize)
         plt.bar(x, y0, width=width, yerr=yerr)
         plt.ylabel(y)
         save_figure(name)
 
     def plot_feature_importance(self, mode, width=0.8, epsilon=0.01, figsize=(15, 12), name="Feature_importance",
-                                cv="UV"):
+                                cv="UV", n_repeats=1):
 
-        _, df_ae, _, str_ae = self.compute_feature_importance(mode, epsilon=epsilon, cv=cv)
+        _, df_ae, _, str_ae = self.compute_feature_importance(mode, epsilon=epsilon, cv=cv, n_repeats=n_repeats)
 
         # AE
         self._plot_bar_with_error(df_ae,
@@ -460,56 +577,42 @@ class Interpretability(VizualizationResults):
 
         save_figure(f"Feature_Importance/{name}", exp=self.exp, svg=True)
 
-    def plot_partial_dependence(self, mode, features=["mu"], nb_points=5, ylim=None, name="Partial_dependence_plot"):
+    @profiled
+    def plot_partial_dependence(self, mode, features=["mu"], nb_points=5, ylim=None, name="Partial_dependence_plot",
+                                nb_stations=None, nb_time_steps=None, nb_ice_curves=0, batch_size=1024):
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+        from bias_correction.train.feature_importance import PartialDependence
+
         inputs = self.data.get_inputs(mode)
-        c = cm_plt.viridis(np.linspace(0, 1, len(features)))
 
         sns.set_style("ticks", {'axes.grid': True})
 
         if features is None:
             features = list(inputs.columns)
 
-        for idx_pred, predictor in enumerate(features):
-
-            print(predictor)
-            min_pred = np.nanmin(inputs[predictor])
-            max_pred = np.nanmax(inputs[predictor])
-
-            # min_pred = min_pred - 0.1 * np.abs(mean_pred)
-            # max_pred = max_pred + 0.1 * np.abs(max_pred)
-            # print(min_pred, max_pred)
+        c = plt.cm.viridis(np.linspace(0, 1, len(features)))
 
-            list_results = []
-            inputs = self.data.get_inputs(mode)
-            for fixed_value in np.linspace(min_pred, max_pred, nb_points, endpoint=True):
-                print(fixed_value)
+        # All features and fixed values are predicted in one pass
+        self.cm.select_model(model_version="last", print_=False)
+        engine = PartialDependence(self.data,
+                                   self.cm.model,
+                                   mode=mode,
+                                   batch_size=batch_size,
+                                   nb_stations=nb_stations,
+                                   nb_time_steps=nb_time_steps)
+        df_pdp, ice = engine.compute(features, nb_points=nb_points)
 
-                # Create a copy of X_test
-                inputs_copy = inputs.copy()
-
-                # Replace predictor by fixed value
-                inputs_copy[predictor] = fixed_value
-
-                # Prepare dataset
-                length_batch = self.data.get_length(mode=mode)
-                inputs_tf = self.data.get_tf_zipped_inputs(inputs=inputs_copy).batch(128)
-
-                # Predict
-                with tf.device('/GPU:0'):
-                    results_fixed_value = self.cm.predict_multiple_batches(inputs_tf,
-                                                                           model_version="last",
-                                                                           batch_size=128,
-                                                                           index_max=len(inputs),
-                                                                           output_shape=(len(inputs),),
-                                                                           force_build=False)
-
-                mean = np.nanmean(results_fixed_value)
-                std = np.nanstd(results_fixed_value)
-                list_results.append({'Fixed value': fixed_value, "mean": mean, "std": std})
+        for idx_pred, predictor in enumerate(features):
 
-            df = pd.DataFrame(list_results)
+            print(predictor)
+            df = df_pdp[df_pdp["feature"] == predictor]
 
             plt.figure()
+            if nb_ice_curves:
+                nb_rows = ice[predictor].shape[1]
+                idx_ice = np.random.default_rng(42).choice(nb_rows, size=min(nb_ice_curves, nb_rows), replace=False)
+                plt.plot(df["Fixed value"].values, ice[predictor][:, idx_ice], color=c[idx_pred], alpha=0.05)
             plt.plot(df["Fixed value"], df["mean"], label='mean_1', marker='x', color=c[idx_pred])
             plt.fill_between(df["Fixed value"], df["mean"] - df["std"], df["mean"] + df["std"],
                              color=c[idx_pred],
@@ -1,15 +1,19 @@
 import numpy as np
 import pandas as pd
-import tensorflow as tf
 
 from datetime import date
 import os
 import json
+import atexit
+import shutil
+import tempfile
 from typing import Union, MutableSequence, Tuple, List
 from copy import copy
 
 from bias_correction.utils_bc.network import detect_network
+from bias_correction.utils_bc.local_launcher import is_chief, get_task_index
 from bias_correction.train.utils import create_folder_if_doesnt_exist
+from bias_correction.train.experiment_registry import ExperimentRegistry
 from bias_correction.utils_bc.utils_config import assert_input_for_skip_connection, \
     sort_input_variables,\
     adapt_distribution_strategy_to_available_devices,\
@@ -65,31 +69,26 @@ class AllExperiences:
         self.config = config
         self.path_experiences = config["path_experiences"]
 
-        if create:
-            self.create_csv_file_if_doesnt_exists("experiences",
-                                                  ["exp", "finished", "details"],
-                                                  override=override)
-            self.create_csv_file_if_doesnt_exists("metrics",
-                                                  ["exp", "finished", "details", "MAE_nn",
-                                                   "MAE_a", "RMSE_nn", "RMSE_a", "MB_n", "MB_a"],
-                                                  override=override)
-            self.create_csv_file_if_doesnt_exists("hyperparameters",
-                                                  ["exp", "finished", "hyperparameter1", "hyperparameter2", "details"],
-                                                  override=override)
-
-    def check_csv_file_exists(self, name: str) -> bool:
-        return f"{name}.csv" in os.listdir(self.path_experiences)
-
-    def create_csv_file_if_doesnt_exists(self,
-                                         name: str,
-                                         columns: List[str],
-                                         override: bool = False
-                                         ) -> None:
-        df = pd.DataFrame(columns=columns)
-        df.index.name = "index"
-        file_doesnt_exists = not self.check_csv_file_exists(name)
-        if file_doesnt_exists or override:
-            df.to_csv(self.path_experiences + f"{name}.csv", index=False)
+        # Multi-worker training: the workers other than the chief write to a temporary directory, deleted at exit
+        if not is_chief(config):
+            self.path_experiences = tempfile.mkdtemp(prefix=f"worker_{get_task_index()}_") + "/"
+            atexit.register(shutil.rmtree, self.path_experiences, ignore_errors=True)
+            print(f"Worker {get_task_index()} is not the chief: experience written to {self.path_experiences}",
+                  flush=True)
+
+        # Experiences, metrics, hyperparameters and timings are recorded in a SQLite registry.
+        # Restored experiences (create=False) use the registry as it is: no reset and no import.
+        path_registry = self.path_experiences + "experiences.db"
+        if create and override:
+            for path in [path_registry, path_registry + "-wal", path_registry + "-shm"]:
+                if os.path.exists(path):
+                    os.remove(path)
+        registry_is_new = not os.path.exists(path_registry)
+        self.registry = ExperimentRegistry(path_registry)
+
+        # Results written before the registry existed, unless the registry is reset on purpose
+        if create and registry_is_new and not override:
+            self.registry.import_csv(self.path_experiences)
 
 
 class ExperienceManager(AllExperiences):
@@ -127,6 +126,7 @@ class ExperienceManager(AllExperiences):
             self.path_to_figures = None
             self.path_to_feature_importance = None
             self.path_to_predictions = None
+            self.path_to_checkpoints = None
             self.path_debug = None
 
             # Paths
@@ -141,6 +141,7 @@ class ExperienceManager(AllExperiences):
                                "path_to_figures": path_to_current_experience + "figures/",
                                "path_to_feature_importance": path_to_current_experience + "feature_importance/",
                                "path_to_predictions": path_to_current_experience + "predictions/",
+                               "path_to_checkpoints": path_to_current_experience + "checkpoints/",
                                "path_debug": path_to_current_experience + "debug/"
                                }
 
@@ -149,9 +150,8 @@ class ExperienceManager(AllExperiences):
                 setattr(self, key, self.dict_paths[key])
                 create_folder_if_doesnt_exist(self.dict_paths[key])
 
-            # Update csv files
-            for name in ["experiences", "metrics", "hyperparameters"]:
-                self._update_experience_to_csv_file(name)
+            # Register experience
+            self._register_experience()
             self.save_config_json()
 
     def get_config(self):
@@ -159,6 +159,7 @@ class ExperienceManager(AllExperiences):
 
     @staticmethod
     def list_physical_devices() -> None:
+        import tensorflow as tf
         gpus = tf.config.list_physical_devices('GPU')
         cpus = tf.config.list_physical_devices('CPU')
         print("\nPhysical devices available:")
@@ -193,48 +194,39 @@ class ExperienceManager(AllExperiences):
     def _get_path_to_current_experience(self) -> str:
         return self.path_experiences + self.name_current_experience
 
-    def _update_experience_to_csv_file(self, name: str
-                                       ) -> None:
-        df = pd.read_csv(self.path_experiences + f"{name}.csv")
-
-        keys = ["exp", "finished", "details"]
-        values = [self.name_current_experience, self.is_finished, self.config["details"]]
-        dict_to_append = {key: value for key, value in zip(keys, values)}
-        df = df.append(dict_to_append, ignore_index=True)
-        df.to_csv(self.path_experiences + f"{name}.csv", index=False)
-
-    def _update_finished_csv_file(self) -> None:
-        for name in ["experiences", "metrics", "hyperparameters"]:
-            df = pd.read_csv(self.path_experiences + f"{name}.csv")
-            filter_exp = df["exp"] == self.name_current_experience
-            df.loc[filter_exp, "finished"] = 1
-            df.to_csv(self.path_experiences + f"{name}.csv", index=False)
-            print(f"Save info about experience in: " + self.path_experiences + f"{name}.csv")
-
-    def _update_single_metrics_csv(self,
-                                   metric_value: float,
-                                   metric_name: str,
-                                   precision: int = 3,
-                                   no_value: float = -9999
-                                   ) -> None:
-        df = pd.read_csv(self.path_experiences + "metrics.csv")
-        filter_exp = df["exp"] == self.name_current_experience
-
-        if metric_name not in df:
-            df[metric_name] = no_value
-
-        df.loc[filter_exp, metric_name] = np.round(metric_value, precision)
-        df.to_csv(self.path_experiences + "metrics.csv", index=False, float_format=f"%.{precision}f")
-        print("Updated: " + self.path_experiences + "metrics.csv")
-
-    def _update_metrics_csv(self,
-                            list_metric_values: list,
-                            metric_name: Union[str, None] = None,
-                            precision: int = 3,
-                            keys: Tuple[str, ...] = ("_a", "_nn", "_int")
-                            ) -> None:
+    def _get_hyperparameters(self) -> dict:
+        """Scalar values of the config"""
+        return {key: value for key, value in self.config.items()
+                if isinstance(value, (str, int, float, bool, np.number)) or value is None}
+
+    def _register_experience(self) -> None:
+        self.registry.add_experience(self.name_current_experience,
+                                     details=self.config.get("details"),
+                                     finished=self.is_finished)
+        self.registry.set_hyperparameters(self.name_current_experience, self._get_hyperparameters())
+
+    def mark_finished(self) -> None:
+        """The experience is finished, in this instance and in the registry"""
+        self.finished()
+        self.registry.set_finished(self.name_current_experience)
+        print(f"Save info about experience in: {self.registry.path}")
+
+    def _record_metric(self,
+                       metric_value: float,
+                       metric_name: str,
+                       precision: int = 3
+                       ) -> None:
+        self.registry.set_metric(self.name_current_experience, metric_name, np.round(metric_value, precision))
+        print(f"Updated: {metric_name} in {self.registry.path}")
+
+    def _record_metrics(self,
+                        list_metric_values: list,
+                        metric_name: Union[str, None] = None,
+                        precision: int = 3,
+                        keys: Tuple[str, ...] = ("_a", "_nn", "_int")
+                        ) -> None:
         for metric_value, model in zip(list_metric_values, keys):
-            self._update_single_metrics_csv(metric_value, metric_name + model, precision=precision)
+            self._record_metric(metric_value, metric_name + model, precision=precision)
 
     def save_metrics_current_experience(self,
                                         metric_values: Tuple[list, ...],
@@ -248,16 +240,16 @@ class ExperienceManager(AllExperiences):
             df.to_csv(self.path_to_current_experience + f"{name}.csv", index=False, float_format=f"%.{precision}f")
             print("Updated: " + self.path_to_current_experience + f"{name}.csv")
 
-    def _update_csv_files_with_results(self,
-                                       c_eval,
-                                       mae: list = None,
-                                       rmse: list = None,
-                                       bias: list = None,
-                                       corr: list = None,
-                                       keys: List[str] = None
-                                       ) -> None:
+    def _record_results(self,
+                        c_eval,
+                        mae: list = None,
+                        rmse: list = None,
+                        bias: list = None,
+                        corr: list = None,
+                        keys: List[str] = None
+                        ) -> None:
 
-        assert hasattr(c_eval, "df_results")
+        assert hasattr(c_eval, "df_results") or hasattr(c_eval, "accumulators")
 
         if mae is None:
             mae = c_eval.df2mae()
@@ -270,10 +262,10 @@ class ExperienceManager(AllExperiences):
         if keys is None:
             keys = tuple(['_' + key.split('_')[-1] for key in c_eval.keys])
 
-        self._update_metrics_csv(mae, metric_name="MAE", keys=keys)
-        self._update_metrics_csv(rmse, metric_name="RMSE", keys=keys)
-        self._update_metrics_csv(bias, metric_name="MB", keys=keys)
-        self._update_metrics_csv(corr, metric_name="corr", keys=keys)
+        self._record_metrics(mae, metric_name="MAE", keys=keys)
+        self._record_metrics(rmse, metric_name="RMSE", keys=keys)
+        self._record_metrics(bias, metric_name="MB", keys=keys)
+        self._record_metrics(corr, metric_name="corr", keys=keys)
 
     def finished(self) -> None:
         self.is_finished = 1
@@ -281,6 +273,7 @@ class ExperienceManager(AllExperiences):
     def save_model(self,
                    custom_model
                    ) -> None:
+        import tensorflow as tf
         tf.keras.models.save_model(custom_model.model, self.path_to_last_model)
         custom_model.model.save_weights(self.path_to_last_weights + 'model_weights.h5')
 
@@ -299,6 +292,13 @@ class ExperienceManager(AllExperiences):
         np.save(self.path_to_current_experience + "mean.npy", mean)
         np.save(self.path_to_current_experience + "std.npy", std)
 
+    def load_norm_param(self) -> Tuple[pd.Series, pd.Series]:
+        """Normalization saved by save_norm_param"""
+        mean = np.load(self.path_to_current_experience + "mean.npy")
+        std = np.load(self.path_to_current_experience + "std.npy")
+        index = self.config["input_variables"] if len(self.config["input_variables"]) == len(mean) else None
+        return pd.Series(mean, index=index), pd.Series(std, index=index)
+
     def save_experience_json(self) -> None:
 
         if hasattr(self, "is_finished"):
@@ -310,7 +310,7 @@ class ExperienceManager(AllExperiences):
         dict_exp = self.__dict__
 
         # Remove dict, list... etc that are can not be (easily) transformed into a json file
-        keys_to_remove = ["dict_paths", "other_experiences_created_today", "config"]
+        keys_to_remove = ["dict_paths", "other_experiences_created_today", "config", "registry"]
         dict_to_save = {k: v for k, v in dict_exp.items() if k not in keys_to_remove}
 
         # Numbers are converted to str
@@ -322,6 +322,12 @@ class ExperienceManager(AllExperiences):
         with open(self.path_to_current_experience + 'exp.json', 'w') as fp:
             json.dump(dict_to_save, fp, sort_keys=True, indent=4)
 
+    def save_profiling(self) -> None:
+        """Timers, counters and memory high-water marks of the process: profiling.json and profiling.csv"""
+        from bias_correction.utils_bc.instrumentation import profiler
+        profiler.save(self.path_to_current_experience)
+        self.registry.set_timings(self.name_current_experience, profiler.summary())
+
     def save_all(self,
                  data,
                  custom_model
@@ -332,6 +338,7 @@ class ExperienceManager(AllExperiences):
         if self.config["standardize"]:
             self.save_norm_param(data.mean_standardize, data.std_standardize)
         self.save_experience_json()
+        self.save_profiling()
 
     def save_results(self,
                      c_eval,
@@ -340,9 +347,8 @@ class ExperienceManager(AllExperiences):
                      mbe: list = None,
                      corr: list = None
                      ) -> None:
-        self.finished()
-        self._update_finished_csv_file()
-        self._update_csv_files_with_results(c_eval, mae, rmse, mbe, corr)
+        self.mark_finished()
+        self._record_results(c_eval, mae, rmse, mbe, corr)
 
     @classmethod
     def from_previous_experience(cls, path_to_previous_exp):
@@ -0,0 +1,235 @@
+import numpy as np
+import pandas as pd
+
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Union
+
+_schema = """
+CREATE TABLE IF NOT EXISTS experiences (
+    exp TEXT PRIMARY KEY,
+    finished INTEGER NOT NULL DEFAULT 0,
+    details TEXT,
+    created TEXT
+);
+CREATE TABLE IF NOT EXISTS hyperparameters (
+    exp TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (exp, name)
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    exp TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (exp, name)
+);
+CREATE TABLE IF NOT EXISTS timings (
+    exp TEXT NOT NULL,
+    path TEXT NOT NULL,
+    calls INTEGER,
+    total_s REAL,
+    mean_s REAL,
+    max_s REAL,
+    memory_high_water_mb REAL,
+    PRIMARY KEY (exp, path)
+);
+CREATE INDEX IF NOT EXISTS idx_metrics_name ON metrics (name, value);
+CREATE INDEX IF NOT EXISTS idx_hyperparameters_name ON hyperparameters (name, value);
+CREATE INDEX IF NOT EXISTS idx_timings_path ON timings (path);
+"""
+
+
+class ExperimentRegistry:
+    """
+    Registry of experiences backed by a local SQLite database in WAL mode.
+
+    Each write is a single atomic upsert: parallel experiences can record their results in the same registry
+    without re-reading and rewriting files, and without losing updates.
+    Results from the former experiences.csv, metrics.csv and hyperparameters.csv files can be imported.
+    """
+
+    def __init__(self,
+                 path: str,
+                 timeout: float = 60
+                 ) -> None:
+        self.path = path
+        self.timeout = timeout
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_schema)
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def add_experience(self,
+                       exp: str,
+                       details: Union[str, None] = None,
+                       finished: int = 0
+                       ) -> None:
+        with self._connect() as connection:
+            connection.execute("INSERT INTO experiences (exp, finished, details, created) VALUES (?, ?, ?, ?) "
+                               "ON CONFLICT (exp) DO UPDATE SET details = excluded.details",
+                               (exp, int(finished), details, datetime.now().isoformat(timespec="seconds")))
+
+    def set_finished(self,
+                     exp: str,
+                     finished: int = 1
+                     ) -> None:
+        with self._connect() as connection:
+            connection.execute("UPDATE experiences SET finished = ? WHERE exp = ?", (int(finished), exp))
+
+    def set_metrics(self,
+                    exp: str,
+                    metrics: Dict[str, float]
+                    ) -> None:
+        rows = [(exp, name, None if value is None or np.isnan(value) else float(value))
+                for name, value in metrics.items()]
+        with self._connect() as connection:
+            connection.executemany("INSERT INTO metrics (exp, name, value) VALUES (?, ?, ?) "
+                                   "ON CONFLICT (exp, name) DO UPDATE SET value = excluded.value",
+                                   rows)
+
+    def set_metric(self,
+                   exp: str,
+                   name: str,
+                   value: float
+                   ) -> None:
+        self.set_metrics(exp, {name: value})
+
+    def set_hyperparameters(self,
+                            exp: str,
+                            hyperparameters: Dict
+                            ) -> None:
+        rows = [(exp, str(name), None if value is None else str(value)) for name, value in hyperparameters.items()]
+        with self._connect() as connection:
+            connection.executemany("INSERT INTO hyperparameters (exp, name, value) VALUES (?, ?, ?) "
+                                   "ON CONFLICT (exp, name) DO UPDATE SET value = excluded.value",
+                                   rows)
+
+    def set_timings(self,
+                    exp: str,
+                    timings: pd.DataFrame
+                    ) -> None:
+        """:param timings: summary of utils_bc.instrumentation.Profiler"""
+        columns = ["path", "calls", "total_s", "mean_s", "max_s", "memory_high_water_mb"]
+        rows = [(exp, *row) for row in timings[columns].itertuples(index=False, name=None)]
+        with self._connect() as connection:
+            connection.executemany("INSERT INTO timings (exp, path, calls, total_s, mean_s, max_s, memory_high_water_mb) "
+                                   "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                                   "ON CONFLICT (exp, path) DO UPDATE SET calls = excluded.calls, "
+                                   "total_s = excluded.total_s, mean_s = excluded.mean_s, max_s = excluded.max_s, "
+                                   "memory_high_water_mb = excluded.memory_high_water_mb",
+                                   rows)
+
+    def query(self,
+              sql: str,
+              parameters: tuple = ()
+              ) -> pd.DataFrame:
+        with self._connect() as connection:
+            return pd.read_sql_query(sql, connection, params=parameters)
+
+    def get_metric_values(self,
+                          name: str,
+                          hyperparameter: str,
+                          value: str
+                          ) -> np.ndarray:
+        """Values of a metric for the experiences with a given hyperparameter value (e.g. all trials of a sweep)"""
+        df = self.query("SELECT m.value FROM metrics m JOIN hyperparameters h ON m.exp = h.exp "
+                        "WHERE m.name = ? AND h.name = ? AND h.value = ?",
+                        (name, hyperparameter, str(value)))
+        return df["value"].dropna().values
+
+    def get_experiences(self) -> pd.DataFrame:
+        return self.query("SELECT * FROM experiences ORDER BY created, exp")
+
+    def _get_wide_table(self,
+                        table: str,
+                        exp: Union[str, None] = None
+                        ) -> pd.DataFrame:
+        """One row per experience, one column per name (same layout as the former csv files)"""
+        if exp is None:
+            df = self.query(f"SELECT exp, name, value FROM {table}")
+        else:
+            df = self.query(f"SELECT exp, name, value FROM {table} WHERE exp = ?", (exp,))
+        df = df.pivot(index="exp", columns="name", values="value")
+        df.columns.name = None
+        experiences = self.get_experiences()[["exp", "finished", "details"]]
+        df = experiences.merge(df, left_on="exp", right_index=True, how="inner" if exp else "left")
+        return df.reset_index(drop=True)
+
+    def get_metrics(self,
+                    exp: Union[str, None] = None
+                    ) -> pd.DataFrame:
+        return self._get_wide_table("metrics", exp=exp)
+
+    def get_hyperparameters(self,
+                            exp: Union[str, None] = None
+                            ) -> pd.DataFrame:
+        return self._get_wide_table("hyperparameters", exp=exp)
+
+    def get_timings(self,
+                    exp: Union[str, None] = None
+                    ) -> pd.DataFrame:
+        if exp is None:
+            return self.query("SELECT * FROM timings")
+        return self.query("SELECT * FROM timings WHERE exp = ?", (exp,))
+
+    def import_csv(self,
+                   path_experiences: str,
+                   no_value: float = -9999
+                   ) -> None:
+        """Import experiences.csv, metrics.csv and hyperparameters.csv. Existing entries are not overwritten."""
+        list_df = [pd.read_csv(os.path.join(path_experiences, f"{name}.csv"))
+                   for name in ["experiences", "metrics", "hyperparameters"]
+                   if os.path.exists(os.path.join(path_experiences, f"{name}.csv"))]
+        if not list_df:
+            return
+
+        with self._connect() as connection:
+            for df in list_df:
+                for row in df[["exp", "finished", "details"]].itertuples(index=False):
+                    connection.execute("INSERT INTO experiences (exp, finished, details) VALUES (?, ?, ?) "
+                                       "ON CONFLICT (exp) DO UPDATE SET finished = MAX(finished, excluded.finished)",
+                                       (row.exp,
+                                        0 if pd.isna(row.finished) else int(row.finished),
+                                        None if pd.isna(row.details) else str(row.details)))
+
+            if os.path.exists(os.path.join(path_experiences, "metrics.csv")):
+                df = pd.read_csv(os.path.join(path_experiences, "metrics.csv"))
+                df = df.melt(id_vars=["exp"],
+                             value_vars=[column for column in df.columns if column not in ["exp", "finished", "details"]],
+                             var_name="name")
+                df = df[df["value"].notna() & (df["value"] != no_value)]
+                connection.executemany("INSERT OR IGNORE INTO metrics (exp, name, value) VALUES (?, ?, ?)",
+                                       [(exp, name, float(value)) for exp, name, value in df.itertuples(index=False)])
+
+            if os.path.exists(os.path.join(path_experiences, "hyperparameters.csv")):
+                df = pd.read_csv(os.path.join(path_experiences, "hyperparameters.csv"))
+                df = df.melt(id_vars=["exp"],
+                             value_vars=[column for column in df.columns if column not in ["exp", "finished", "details"]],
+                             var_name="name")
+                df = df[df["value"].notna()]
+                connection.executemany("INSERT OR IGNORE INTO hyperparameters (exp, name, value) VALUES (?, ?, ?)",
+                                       [(exp, name, str(value)) for exp, name, value in df.itertuples(index=False)])
+
+        print(f"Imported csv files of {path_experiences} in {self.path}", flush=True)
+
+    def export_csv(self,
+                   path_experiences: str
+                   ) -> None:
+        """Write the registry as csv files, for tools that read the former csv files"""
+        self.get_experiences()[["exp", "finished", "details"]].to_csv(os.path.join(path_experiences,
+                                                                                   "experiences.csv"),
+                                                                      index=False)
+        self.get_metrics().to_csv(os.path.join(path_experiences, "metrics.csv"), index=False)
+        self.get_hyperparameters().to_csv(os.path.join(path_experiences, "hyperparameters.csv"), index=False)
@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+
+from typing import List, Tuple, Union, TYPE_CHECKING
+
+from bias_correction.train.batched_predictor import BatchedPredictor
+from bias_correction.train.metrics import get_metric
+
+if TYPE_CHECKING:
+    import tensorflow as tf
+    from bias_correction.train.dataloader import CustomDataHandler
+
+
+class PermutationImportance:
+    """
+    Permutation feature importance computed in a single pass over the dataset.
+
+    The baseline and all the permuted copies (one per feature and per repeat) are predicted by a BatchedPredictor.
+    Permutations are global: row i of a permuted feature takes the value of row permutation[i] of the whole mode.
+    """
+
+    def __init__(self,
+                 data: 'CustomDataHandler',
+                 model: 'tf.keras.Model',
+                 mode: str = "test",
+                 cv: str = "UV",
+                 n_repeats: int = 1,
+                 batch_size: int = 1024,
+                 seed: int = 42,
+                 epsilon: float = 0.01
+                 ) -> None:
+        self.data = data
+        self.model = model
+        self.mode = mode
+        self.cv = cv
+        self.n_repeats = n_repeats
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epsilon = epsilon
+        self.predictor = BatchedPredictor(data, model, mode=mode, batch_size=batch_size)
+        self.str_ae = r'$\frac{Absolute error_{permuted} - Absolute error_{not \quad permuted}}{Absolute error_{not \quad permuted}}$ [%]'
+
+    def _get_observations(self) -> np.ndarray:
+        labels = self.data.get_labels(self.mode)
+        if "component" in self.data.config["type_of_output"]:
+            return np.sqrt(labels["U_obs"].values ** 2 + labels["V_obs"].values ** 2)
+        else:
+            return np.squeeze(labels.values)
+
+    def _absolute_error(self,
+                        obs: np.ndarray,
+                        pred: np.ndarray
+                        ) -> np.ndarray:
+        metric = "ae" if self.cv == "UV" else "abs_bias_direction"
+        return get_metric(metric)(obs, pred)
+
+    def get_permutations(self,
+                         inputs: pd.DataFrame
+                         ) -> np.ndarray:
+        """Permuted row indexes, shape (n_repeats, n_features, n_rows)"""
+        rng = np.random.default_rng(self.seed)
+        length = len(inputs)
+        nb_features = inputs.shape[1]
+        return np.array([[rng.permutation(length) for _ in range(nb_features)] for _ in range(self.n_repeats)])
+
+    def predict_permuted(self,
+                         features: Union[List[str], None] = None,
+                         compute_baseline: bool = True
+                         ) -> Tuple[Union[np.ndarray, None], np.ndarray]:
+        """
+        Predictions without permutation and with each feature permuted.
+
+        :return: baseline predictions (n_rows,) or None and permuted predictions (n_repeats, n_features, n_rows)
+        """
+        inputs = self.data.get_inputs(self.mode)
+        columns = list(inputs.columns)
+        features = columns if features is None else list(features)
+        idx_features = [columns.index(feature) for feature in features]
+        values = inputs.values.astype(np.float32)
+        permutations = self.get_permutations(inputs[features])
+
+        modifications = [({}, None)] if compute_baseline else []
+        for idx_repeat in range(self.n_repeats):
+            for idx, idx_feature in enumerate(idx_features):
+                modifications.append(({idx_feature: values[permutations[idx_repeat, idx], idx_feature]}, None))
+
+        predictions = self.predictor.predict(modifications)
+
+        if compute_baseline:
+            baseline, predictions = predictions[0], predictions[1:]
+        else:
+            baseline = None
+        permuted = predictions.reshape((self.n_repeats, len(features), -1))
+
+        return baseline, permuted
+
+    def compute(self,
+                features: Union[List[str], None] = None,
+                baseline: Union[np.ndarray, None] = None
+                ) -> pd.DataFrame:
+        """
+        Relative increase of the absolute error when each feature is permuted.
+
+        :param features: features to permute. All inputs if None.
+        :param baseline: predictions without permutation (e.g. already computed for the evaluation).
+        Computed in the same pass if None.
+        :return: DataFrame sorted by importance, with the mean over repeats, the std and a 95% confidence interval
+        """
+        inputs = self.data.get_inputs(self.mode)
+        features = list(inputs.columns) if features is None else list(features)
+
+        baseline_computed, permuted = self.predict_permuted(features, compute_baseline=baseline is None)
+        if baseline is None:
+            baseline = baseline_computed
+
+        obs = self._get_observations()
+        ae = self._absolute_error(obs, baseline)
+
+        # Shape (n_repeats, n_features)
+        with np.errstate(invalid="ignore"):
+            scores = np.array([[np.nanmean(100 * (self._absolute_error(obs, pred) - ae) / (ae + self.epsilon))
+                                for pred in permuted_repeat]
+                               for permuted_repeat in permuted])
+
+        mean = np.nanmean(scores, axis=0)
+        std = np.nanstd(scores, axis=0)
+        half_width = 1.96 * std / np.sqrt(self.n_repeats)
+        df = pd.DataFrame({"Predictor": features,
+                           self.str_ae: mean,
+                           "std": std,
+                           "ci_low": mean - half_width,
+                           "ci_high": mean + half_width})
+        return df.sort_values(by=self.str_ae, ascending=False)
+
+
+class PartialDependence:
+    """
+    Partial dependence (PDP) and individual conditional expectation (ICE) curves.
+
+    All the grid values of all the features are predicted in a single pass over the dataset by a BatchedPredictor:
+    topography maps and standardization tensors of each batch are loaded once. Stations and time steps can be
+    sampled to keep PDP interactive on the full test set.
+    """
+
+    def __init__(self,
+                 data: 'CustomDataHandler',
+                 model: 'tf.keras.Model',
+                 mode: str = "test",
+                 batch_size: int = 1024,
+                 nb_stations: Union[int, None] = None,
+                 nb_time_steps: Union[int, None] = None,
+                 seed: int = 42
+                 ) -> None:
+        self.data = data
+        self.mode = mode
+        self.nb_stations = nb_stations
+        self.nb_time_steps = nb_time_steps
+        self.seed = seed
+        self.predictor = BatchedPredictor(data, model, mode=mode, batch_size=batch_size)
+
+    def get_rows(self) -> Union[np.ndarray, None]:
+        """Positions of the sampled rows. None if no sampling is required."""
+        if self.nb_stations is None and self.nb_time_steps is None:
+            return None
+
+        rng = np.random.default_rng(self.seed)
+        inputs = self.data.get_inputs(self.mode)
+        names = np.asarray(self.data.get_names(self.mode))
+        filter_rows = np.ones(len(inputs), dtype=bool)
+
+        if self.nb_stations is not None:
+            stations = np.unique(names)
+            stations = rng.choice(stations, size=min(self.nb_stations, len(stations)), replace=False)
+            filter_rows &= np.isin(names, stations)
+
+        if self.nb_time_steps is not None:
+            times = np.unique(inputs.index)
+            times = rng.choice(times, size=min(self.nb_time_steps, len(times)), replace=False)
+            filter_rows &= np.isin(inputs.index, times)
+
+        return np.flatnonzero(filter_rows)
+
+    def get_grid(self,
+                 feature: str,
+                 nb_points: int = 5
+                 ) -> np.ndarray:
+        inputs = self.data.get_inputs(self.mode)
+        return np.linspace(np.nanmin(inputs[feature]), np.nanmax(inputs[feature]), nb_points, endpoint=True)
+
+    def compute(self,
+                features: List[str],
+                nb_points: int = 5
+                ) -> Tuple[pd.DataFrame, dict]:
+        """
+        :return: PDP in long format (feature, Fixed value, mean, std) and ICE curves
+        (feature -> array of shape (nb_points, nb_rows))
+        """
+        columns = list(self.data.get_inputs(self.mode).columns)
+        rows = self.get_rows()
+
+        grids = {feature: self.get_grid(feature, nb_points=nb_points) for feature in features}
+        modifications = [({columns.index(feature): fixed_value}, None)
+                         for feature in features
+                         for fixed_value in grids[feature]]
+
+        predictions = self.predictor.predict(modifications, rows=rows)
+
+        ice = {}
+        list_results = []
+        for idx, feature in enumerate(features):
+            ice[feature] = predictions[idx * nb_points: (idx + 1) * nb_points]
+            for fixed_value, ice_curve in zip(grids[feature], ice[feature]):
+                list_results.append({"feature": feature,
+                                     "Fixed value": fixed_value,
+                                     "mean": np.nanmean(ice_curve),
+                                     "std": np.nanstd(ice_curve)})
+
+        return pd.DataFrame(list_results), ice
@@ -0,0 +1,199 @@
+import numpy as np
+import pandas as pd
+
+import os
+import json
+import time
+import hashlib
+from typing import Dict, List, Sequence, Union, TYPE_CHECKING
+
+from bias_correction.train.utils import create_folder_if_doesnt_exist
+
+if TYPE_CHECKING:
+    from bias_correction.train.experience_manager import ExperienceManager
+
+
+def get_figure_columns(df: pd.DataFrame,
+                       metrics: Sequence[str],
+                       keys: Sequence[str],
+                       extra_columns: Sequence[str] = ("name", "lead_time")
+                       ) -> List[str]:
+    """Columns of df needed by the plots of metrics and keys (e.g. "bias_nn" for "bias" and "UV_nn")"""
+    keys = ['_' + key.split('_')[-1] for key in keys]
+    columns = list(extra_columns) + [f"{metric}{key}" for metric in metrics for key in keys]
+    return [column for column in columns if column in df]
+
+
+def _hash_job(method: str,
+              df: pd.DataFrame,
+              kwargs: dict
+              ) -> str:
+    """Content hash of a figure: plotting method, data (values, index and columns) and arguments"""
+    sha = hashlib.sha1()
+    sha.update(method.encode())
+    sha.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    sha.update(json.dumps([str(column) for column in df.columns]).encode())
+    # Colormaps and other objects are identified by their name, not by their address
+    sha.update(json.dumps(kwargs, sort_keys=True, default=lambda value: getattr(value, "name", str(value))).encode())
+    return sha.hexdigest()
+
+
+class _FigureDestination:
+    """Paths used by save_figure in the workers, instead of the ExperienceManager"""
+
+    def __init__(self,
+                 path_to_figures: str,
+                 path_to_current_experience: str,
+                 config: dict
+                 ) -> None:
+        self.path_to_figures = path_to_figures
+        self.path_to_current_experience = path_to_current_experience
+        self.config = config
+
+
+def _init_figure_worker() -> None:
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def _render_figure_job(job: dict) -> dict:
+    """Render one figure job in a worker and return its timing"""
+    import matplotlib.pyplot as plt
+    from bias_correction.train.visu import VizualizationResults
+
+    start = time.perf_counter()
+    try:
+        df = pd.read_pickle(job["path_data"])
+        viz = VizualizationResults(_FigureDestination(job["path_to_figures"],
+                                                      job["path_to_current_experience"],
+                                                      job["config"]))
+        getattr(viz, job["method"])(df, **job["kwargs"])
+        status, error = "done", None
+        os.remove(job["path_data"])
+    except Exception as e:
+        status, error = "failed", f"{type(e).__name__}: {e}"
+    finally:
+        plt.close("all")
+    return {"name": job["name"], "method": job["method"], "status": status,
+            "seconds": time.perf_counter() - start, "error": error}
+
+
+class FigureJobPool:
+    """
+    Figures of VizualizationResults rendered headless (Agg backend) in a process pool.
+
+    Each job stores only the columns its plot needs. Jobs whose method, data and arguments did not change since
+    the last successful rendering (content hash in {path_to_figures}/figure_jobs.json) are skipped.
+    Plots that need a model (ALE, partial dependence) can not be serialized and stay in the main process.
+
+    Example:
+        pool = FigureJobPool(exp, nb_workers=8)
+        pool.add("Lead_time", "plot_lead_time", df, columns=["name", "lead_time", "bias_nn"], keys=("UV_nn",))
+        timings = pool.run()
+    """
+
+    def __init__(self,
+                 exp: 'ExperienceManager',
+                 nb_workers: Union[int, None] = None,
+                 force: bool = False
+                 ) -> None:
+        from bias_correction.train.sweep import get_nb_available_cores
+
+        self.exp = exp
+        self.nb_workers = nb_workers or get_nb_available_cores()
+        self.force = force
+        self.path_jobs = os.path.join(exp.path_to_figures, ".figure_jobs")
+        self.path_manifest = os.path.join(exp.path_to_figures, "figure_jobs.json")
+        self.jobs: List[dict] = []
+        self.skipped: List[dict] = []
+
+    def _load_manifest(self) -> Dict[str, dict]:
+        if not os.path.exists(self.path_manifest):
+            return {}
+        with open(self.path_manifest, "r") as f:
+            return json.load(f)
+
+    def add(self,
+            job_name: str,
+            method: str,
+            df: pd.DataFrame,
+            columns: Union[Sequence[str], None] = None,
+            **kwargs
+            ) -> bool:
+        """
+        Add the job job_name: VizualizationResults.{method}(df[columns], **kwargs).
+
+        kwargs are passed to the plotting method, including its name argument (name of the saved figure).
+
+        Returns False if the job is skipped because it was already rendered with the same inputs.
+        """
+        if any(job["name"] == job_name for job in self.jobs):
+            raise ValueError(f"Figure job {job_name} already added")
+        df = df[list(columns)] if columns is not None else df
+        content_hash = _hash_job(method, df, kwargs)
+
+        if not self.force and self._load_manifest().get(job_name, {}).get("hash") == content_hash:
+            print(f"Figure job {job_name} skipped: inputs unchanged", flush=True)
+            self.skipped.append({"name": job_name, "method": method})
+            return False
+
+        create_folder_if_doesnt_exist(self.path_jobs, _raise=False)
+        # Jobs with the same data (e.g. two plots of the same columns) do not share their file
+        path_data = os.path.join(self.path_jobs, f"{hashlib.sha1(job_name.encode()).hexdigest()[:8]}_{content_hash}.pkl")
+        df.to_pickle(path_data)
+        self.jobs.append({"name": job_name,
+                          "method": method,
+                          "kwargs": kwargs,
+                          "hash": content_hash,
+                          "path_data": path_data,
+                          "path_to_figures": self.exp.path_to_figures,
+                          "path_to_current_experience": self.exp.path_to_current_experience,
+                          "config": {"current_variable": self.exp.config.get("current_variable")}})
+        return True
+
+    def run(self) -> pd.DataFrame:
+        """Render the jobs and return the timing of each job (failed jobs are reported, not raised)"""
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        results = [{**job, "status": "skipped", "seconds": 0., "error": None} for job in self.skipped]
+        if self.jobs:
+            nb_workers = min(self.nb_workers, len(self.jobs))
+            print(f"Render {len(self.jobs)} figure jobs on {nb_workers} workers", flush=True)
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=nb_workers,
+                                     mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_figure_worker) as executor:
+                futures = {executor.submit(_render_figure_job, job): job for job in self.jobs}
+                for future in as_completed(futures):
+                    job = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # e.g. a worker killed by the OOM killer
+                        result = {"name": job["name"], "method": job["method"], "status": "failed",
+                                  "seconds": np.nan, "error": f"{type(e).__name__}: {e}"}
+                    if result["status"] == "done":
+                        print(f"Figure job {result['name']} rendered in {result['seconds']:.1f}s", flush=True)
+                    else:
+                        print(f"\nWARNING Figure job {result['name']} failed: {result['error']}", flush=True)
+                    results.append(result)
+            print(f"Figure jobs rendered in {time.perf_counter() - start:.1f}s", flush=True)
+
+        self._update_manifest(results)
+        self.jobs, self.skipped = [], []
+        return pd.DataFrame(results, columns=["name", "method", "status", "seconds", "error"])
+
+    def _update_manifest(self,
+                         results: List[dict]
+                         ) -> None:
+        """Only successful jobs are recorded, so that failed jobs are rendered again at the next run"""
+        manifest = self._load_manifest()
+        hashes = {job["name"]: job["hash"] for job in self.jobs}
+        for result in results:
+            if result["status"] == "done":
+                manifest[result["name"]] = {"hash": hashes[result["name"]],
+                                            "method": result["method"],
+                                            "seconds": round(result["seconds"], 3)}
+        with open(self.path_manifest, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
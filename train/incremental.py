@@ -0,0 +1,102 @@
+from copy import deepcopy
+from typing import Dict, List, Tuple, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bias_correction.train.model import CustomModel
+    from bias_correction.train.dataloader import CustomDataHandler
+    from bias_correction.train.experience_manager import ExperienceManager
+
+
+class IncrementalTrainer:
+    """
+    Fine-tune the model of a previous experience on newly arrived observations.
+
+    The weights and the normalization of the previous experience are loaded, only the rows observed after
+    incremental_start_date (by default, the last date seen by the previous experience) are prepared, mixed with
+    a replay buffer of older rows, and the fine-tuned model is written in a new experience whose
+    parent_experience is the previous one. Fits follow pipeline/7_double_v1.py: a single joint fit, or direction
+    then speed with the other head frozen.
+    """
+
+    def __init__(self,
+                 previous_experience: str,
+                 config_updates: Union[Dict, None] = None
+                 ) -> None:
+        from bias_correction.train.experience_manager import ExperienceManager
+
+        self.previous_exp, config = ExperienceManager.from_previous_experience(previous_experience)
+        config_updates = config_updates or {}
+        config.update(config_updates)
+        config["restore_experience"] = False
+        config["parent_experience"] = self.previous_exp.name_current_experience
+        config["incremental_start_date"] = self._get_start_date(config_updates.get("incremental_start_date"),
+                                                                config.get("data_end_date"))
+
+        # Short fine-tuning with a smaller learning rate. The factor is applied to the learning rates of the root
+        # experience (base_learning_rate*), not to the already reduced ones of a previous fine-tuning
+        epochs = config.get("incremental_epochs", 2)
+        factor = config.get("incremental_learning_rate_factor", 0.1)
+        config["epochs"], config["epochs_dir"], config["epochs_speed"] = epochs, epochs, epochs
+        for key in ["learning_rate", "learning_rate_dir", "learning_rate_speed"]:
+            if key not in config_updates:
+                config[f"base_{key}"] = config.get(f"base_{key}", config[key])
+            else:
+                config[f"base_{key}"] = config_updates[key]
+            config[key] = config[f"base_{key}"] * factor
+        self.config = config
+
+    @staticmethod
+    def _get_start_date(start_date: Union[str, None],
+                        data_end_date: Union[str, None]
+                        ) -> str:
+        start_date = start_date or data_end_date
+        if not start_date:
+            raise ValueError("The previous experience does not record the last date it was trained on: "
+                             "set incremental_start_date")
+        return str(start_date)
+
+    def _get_fit_configs(self) -> List[Dict]:
+        from bias_correction.train.config_handler import PersistentConfig
+        persistent_config = PersistentConfig(self.config)
+        if self.config.get("joint_training_speed_dir", False):
+            return [persistent_config.config_fit_speed_and_dir(deepcopy(self.config))]
+        return [persistent_config.config_fit_dir(deepcopy(self.config)),
+                persistent_config.config_fit_speed(deepcopy(self.config))]
+
+    def fit(self) -> Tuple['ExperienceManager', 'CustomModel', 'CustomDataHandler']:
+        from bias_correction.train.model import CustomModel
+        from bias_correction.train.dataloader import CustomDataHandler
+        from bias_correction.train.experience_manager import ExperienceManager
+
+        exp = ExperienceManager(self.config)
+        mean, std = self.previous_exp.load_norm_param() if self.config.get("standardize", True) else (None, None)
+        path_weights = self.previous_exp.path_to_last_weights
+
+        for config_fit in self._get_fit_configs():
+            cm = CustomModel(exp, config_fit)
+            cm.build_model_with_strategy()
+            cm.load_weights(path_weights)
+            if config_fit["type_of_output"] == "output_direction":
+                cm.freeze_layers_speed()
+            elif config_fit["type_of_output"] == "output_speed":
+                cm.freeze_layers_direction()
+
+            data_loader = CustomDataHandler(config_fit)
+            data_loader.prepare_incremental_data(self.config["incremental_start_date"],
+                                                 mean=mean,
+                                                 std=std,
+                                                 replay_ratio=self.config.get("incremental_replay_ratio", 1.0),
+                                                 seed=self.config.get("incremental_seed", 42))
+            has_val = data_loader.get_inputs("val") is not None
+            cm.fit_with_strategy(data_loader.get_batched_inputs_labels(mode="train"),
+                                 validation_data=data_loader.get_batched_inputs_labels(mode="val") if has_val else None,
+                                 dataloader=data_loader,
+                                 mode_callback="train")
+            exp.save_model(cm)
+            path_weights = exp.path_to_last_weights
+
+        self.config["data_end_date"] = data_loader.config["data_end_date"]
+        exp.config = self.config
+        exp.save_all(data_loader, cm)
+        exp.mark_finished()
+        return exp, cm, data_loader
@@ -1,7 +1,6 @@
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras.layers import *
-import tensorflow_addons as tfa
 
 
 class RotationLayer(Layer):
@@ -42,6 +41,9 @@ class RotationLayer(Layer):
         return angle * tf.convert_to_tensor(0.01745329)
 
     def call(self, inputs, wind_dir):
+        # tensorflow_addons is only needed when DEVINE rotations are traced
+        import tensorflow_addons as tfa
+
         # Convert to degrees
         if self.unit_input == "degree":
             wind_dir = self.tf_deg2rad(wind_dir)
@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
-import tensorflow as tf
+
+from typing import List, Tuple, Union
 
 
 def bias(y_true, y_pred):
@@ -56,6 +57,7 @@ def mae(y_true, y_pred):
 
 def tf_mbe(y_true, y_pred):
     """Mean biad error written in Tensorflow"""
+    import tensorflow as tf
     from tensorflow.python.framework import ops
     from tensorflow.python.ops import math_ops
 
@@ -96,8 +98,6 @@ dict_metrics = {"bias": bias,
                 "corr": corr,
                 "rmse": rmse,
                 "mae": mae,
-                "tf_rmse": tf.keras.metrics.RootMeanSquaredError(),
-                "tf_mae": tf.keras.metrics.MeanAbsoluteError(),
                 "tf_mbe": tf_mbe,
                 "bias_direction": bias_direction,
                 "abs_bias_direction": abs_bias_direction,
@@ -105,5 +105,442 @@ dict_metrics = {"bias": bias,
                 }
 
 
+# Keras metrics are stateful objects: they are instantiated on demand so that importing this module
+# does not import Tensorflow.
+dict_keras_metrics = {"tf_rmse": "RootMeanSquaredError",
+                      "tf_mae": "MeanAbsoluteError"}
+
+
 def get_metric(metric_name):
+    if metric_name in dict_keras_metrics:
+        import tensorflow as tf
+        return getattr(tf.keras.metrics, dict_keras_metrics[metric_name])()
     return dict_metrics[metric_name]
+
+
+# Aggregated metrics that grouped_metrics computes from per-group sums
+grouped_metrics_available = ("mbe", "mae", "rmse", "corr", "m_n_be", "m_n_ae",
+                             "mean_bias_direction", "mean_abs_bias_direction", "rmse_direction")
+
+
+def _get_group_values(df: pd.DataFrame,
+                      key: str
+                      ) -> np.ndarray:
+    """Group key can be a column (e.g. "name", "mode", "class_alti0") or an attribute of the index (e.g. "month")"""
+    if key == "station":
+        key = "name"
+    if key in df:
+        return df[key].values
+    elif hasattr(df.index, key):
+        return np.asarray(getattr(df.index, key))
+    else:
+        raise KeyError(f"{key} is neither a column nor an attribute of the index")
+
+
+def _sum_by_group(values: np.ndarray,
+                  order: np.ndarray,
+                  starts: np.ndarray
+                  ) -> np.ndarray:
+    return np.add.reduceat(values[order], starts)
+
+
+def grouped_metrics(df: pd.DataFrame,
+                    key_obs: str,
+                    keys: Union[List[str], Tuple[str, ...]],
+                    groupby: Union[str, List[str], Tuple[str, ...], None] = None,
+                    metrics: Tuple[str, ...] = ("mbe", "mae", "rmse", "corr"),
+                    epsilon: float = 0.01
+                    ) -> pd.DataFrame:
+    """
+    Compute aggregated metrics for each model and each group in one pass.
+
+    Rows are sorted once by group and metrics are computed from sums accumulated with np.add.reduceat.
+    NaNs are ignored pair by pair, as in the metrics above.
+
+    :param df: DataFrame with observations and predictions
+    :param key_obs: column of the observations (e.g. "UV_obs")
+    :param keys: columns of the models (e.g. ["UV_AROME", "UV_nn"])
+    :param groupby: group keys. Columns ("station", "name", "mode", "lead_time", "class_alti0"...)
+    or attributes of the index ("month", "hour"...). None computes the metrics on the whole DataFrame.
+    :param metrics: metrics to compute, see grouped_metrics_available
+    :param epsilon: regularization of normalized errors
+    :return: Long format DataFrame with one row per group and model and one column per metric
+    """
+    for metric in metrics:
+        if metric not in grouped_metrics_available:
+            raise NotImplementedError(f"{metric} is not available in grouped_metrics")
+
+    if groupby is None:
+        groupby = []
+    elif isinstance(groupby, str):
+        groupby = [groupby]
+    groupby = list(groupby)
+
+    # Integer group index obtained by combining the codes of each group key
+    codes = []
+    uniques = []
+    for key in groupby:
+        code, unique = pd.factorize(_get_group_values(df, key), sort=True)
+        codes.append(code)
+        uniques.append(unique)
+
+    if groupby:
+        # Rows with a missing group key have a code equal to -1 and are discarded
+        filter_group = np.all(np.array(codes) >= 0, axis=0)
+        shape = tuple(max(len(unique), 1) for unique in uniques)
+        group = np.ravel_multi_index(tuple(code[filter_group] for code in codes), shape)
+    else:
+        filter_group = np.ones(len(df), dtype=bool)
+        group = np.zeros(len(df), dtype=np.int64)
+
+    order = np.argsort(group, kind="stable")
+    sorted_group = group[order]
+    if len(sorted_group) == 0:
+        return pd.DataFrame(columns=groupby + ["model", "nb_obs"] + list(metrics))
+    starts = np.flatnonzero(np.r_[True, sorted_group[1:] != sorted_group[:-1]])
+    group_ids = sorted_group[starts]
+    # Position of the group of each row in the results
+    position_group = np.empty(len(order), dtype=np.int64)
+    position_group[order] = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(order)]))
+
+    obs = np.asarray(df[key_obs].values, dtype=np.float64)[filter_group]
+    direction = any("direction" in metric for metric in metrics)
+
+    results = []
+    for key in keys:
+        pred = np.asarray(df[key].values, dtype=np.float64)[filter_group]
+        result = {"model": key}
+
+        valid = ~(np.isnan(obs) | np.isnan(pred))
+        true = np.where(valid, obs, 0)
+        model = np.where(valid, pred, 0)
+        error = model - true
+        nb_obs = _sum_by_group(valid.astype(np.float64), order, starts)
+        result["nb_obs"] = nb_obs.astype(np.int64)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+
+            if "mbe" in metrics:
+                result["mbe"] = _sum_by_group(error, order, starts) / nb_obs
+
+            if "mae" in metrics:
+                result["mae"] = _sum_by_group(np.abs(error), order, starts) / nb_obs
+
+            if "rmse" in metrics:
+                result["rmse"] = np.sqrt(_sum_by_group(error ** 2, order, starts) / nb_obs)
+
+            if "m_n_be" in metrics or "m_n_ae" in metrics:
+                n_error = error / (true + epsilon)
+                if "m_n_be" in metrics:
+                    result["m_n_be"] = _sum_by_group(n_error, order, starts) / nb_obs
+                if "m_n_ae" in metrics:
+                    result["m_n_ae"] = _sum_by_group(np.abs(n_error), order, starts) / nb_obs
+
+            if "corr" in metrics:
+                # Centered moments, as in StreamingGroupedMetrics: raw sums of squares lose precision
+                mean_true = _sum_by_group(true, order, starts) / nb_obs
+                mean_model = _sum_by_group(model, order, starts) / nb_obs
+                true_centered = np.where(valid, true - mean_true[position_group], 0)
+                model_centered = np.where(valid, model - mean_model[position_group], 0)
+                cov = _sum_by_group(true_centered * model_centered, order, starts)
+                var_true = _sum_by_group(true_centered ** 2, order, starts)
+                var_model = _sum_by_group(model_centered ** 2, order, starts)
+                result["corr"] = cov / np.sqrt(var_true * var_model)
+
+            if direction:
+                # bias_direction returns NaN when the wind direction is not specified
+                error_dir = bias_direction(obs, pred)
+                valid_dir = ~np.isnan(error_dir)
+                error_dir = np.where(valid_dir, error_dir, 0)
+                nb_obs_dir = _sum_by_group(valid_dir.astype(np.float64), order, starts)
+                if "mean_bias_direction" in metrics:
+                    result["mean_bias_direction"] = _sum_by_group(error_dir, order, starts) / nb_obs_dir
+                if "mean_abs_bias_direction" in metrics:
+                    result["mean_abs_bias_direction"] = _sum_by_group(np.abs(error_dir), order, starts) / nb_obs_dir
+                if "rmse_direction" in metrics:
+                    result["rmse_direction"] = np.sqrt(_sum_by_group(error_dir ** 2, order, starts) / nb_obs_dir)
+
+        df_key = pd.DataFrame(result)
+        if groupby:
+            idx_groups = np.unravel_index(group_ids, shape)
+            for key_group, unique, idx_group in zip(groupby, uniques, idx_groups):
+                df_key[key_group] = np.asarray(unique)[idx_group]
+        results.append(df_key)
+
+    return pd.concat(results, ignore_index=True)[groupby + ["model", "nb_obs"] + list(metrics)]
+
+
+def _merge_means(n_a, mean_a, n_b, mean_b):
+    """Mean of the union of two sets (Chan et al.), and the difference between their means"""
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(n > 0, mean_a + delta * n_b / n, 0)
+        weight = np.where(n > 0, n_a * n_b / n, 0)
+    return mean, delta, weight
+
+
+class StreamingGroupedMetrics:
+    """
+    Metrics of grouped_metrics accumulated batch by batch, in memory proportional to the number of groups.
+
+    Each batch is reduced per group with np.bincount, then merged into running moments (Welford / Chan et al.):
+    mean and second moment of the error (mbe, rmse), means, second moments and co-moment of observations and
+    predictions (corr), and sums for the other metrics. States of several streams (e.g. shards) can be merged.
+    With quantile_sketch_k, a GroupedQuantileSketch of the observations ("obs") and of each model is also kept
+    (one sketch per group), e.g. for QQ plots.
+    """
+
+    def __init__(self,
+                 keys: Union[List[str], Tuple[str, ...]],
+                 groupby: Union[str, List[str], Tuple[str, ...], None] = None,
+                 metrics: Tuple[str, ...] = ("mbe", "mae", "rmse", "corr"),
+                 epsilon: float = 0.01,
+                 quantile_sketch_k: Union[int, None] = None
+                 ) -> None:
+        for metric in metrics:
+            if metric not in grouped_metrics_available:
+                raise NotImplementedError(f"{metric} is not available in grouped_metrics")
+
+        if groupby is None:
+            groupby = []
+        elif isinstance(groupby, str):
+            groupby = [groupby]
+        self.groupby = list(groupby)
+        self.keys = list(keys)
+        self.metrics = tuple(metrics)
+        self.epsilon = epsilon
+        self.quantile_sketch_k = quantile_sketch_k
+
+        self.groups = []
+        self.group_ids = {}
+        self.states = {key: {} for key in self.keys}
+        self.sketches = None
+        if quantile_sketch_k is not None:
+            from bias_correction.train.sketches import GroupedQuantileSketch
+            self.sketches = {key: GroupedQuantileSketch(k=quantile_sketch_k) for key in ["obs"] + self.keys}
+
+    def _get_batch_group_ids(self,
+                             groups: Union[dict, None],
+                             length: int
+                             ) -> np.ndarray:
+        """Global group id of each row of the batch (new groups are added)"""
+        if not self.groupby:
+            codes, uniques = np.zeros(length, dtype=np.int64), [()]
+        else:
+            values = [np.asarray(groups[key]) for key in self.groupby]
+            codes, uniques = pd.MultiIndex.from_arrays(values).factorize()
+            codes = np.where(np.any([pd.isna(value) for value in values], axis=0), -1, codes)
+            uniques = list(uniques)
+        ids = np.empty(len(uniques), dtype=np.int64)
+        for idx, group in enumerate(uniques):
+            group = tuple(group) if isinstance(group, tuple) else (group,)
+            if any(pd.isna(value) for value in group):
+                ids[idx] = -1
+                continue
+            if group not in self.group_ids:
+                self.group_ids[group] = len(self.groups)
+                self.groups.append(group)
+            ids[idx] = self.group_ids[group]
+        # Rows with a missing group key have a code equal to -1 and are discarded
+        return np.where(codes >= 0, ids[codes], -1)
+
+    def _get_state(self,
+                   key: str,
+                   name: str
+                   ) -> np.ndarray:
+        state = self.states[key].get(name, np.zeros(0))
+        if len(state) < len(self.groups):
+            state = np.concatenate([state, np.zeros(len(self.groups) - len(state))])
+            self.states[key][name] = state
+        return state
+
+    def _merge_moments(self,
+                       key: str,
+                       n_b: np.ndarray,
+                       means_b: dict,
+                       m2_b: dict,
+                       comoments_b: dict
+                       ) -> None:
+        """Merge batch moments into the running state of a model (same groups, aligned arrays)"""
+        n_a = self._get_state(key, "n")
+        deltas = {}
+        for name in means_b:
+            mean, deltas[name], weight = _merge_means(n_a, self._get_state(key, f"mean_{name}"), n_b, means_b[name])
+            self.states[key][f"mean_{name}"] = mean
+        for name in m2_b:
+            self.states[key][f"m2_{name}"] = self._get_state(key, f"m2_{name}") + m2_b[name] + deltas[name] ** 2 * weight
+        for (name_x, name_y), comoment in comoments_b.items():
+            state_name = f"c_{name_x}_{name_y}"
+            self.states[key][state_name] = (self._get_state(key, state_name) + comoment
+                                            + deltas[name_x] * deltas[name_y] * weight)
+        self.states[key]["n"] = n_a + n_b
+
+    def _add_sums(self,
+                  key: str,
+                  sums: dict
+                  ) -> None:
+        for name, values in sums.items():
+            self.states[key][name] = self._get_state(key, name) + values
+
+    def update(self,
+               obs: np.ndarray,
+               predictions: dict,
+               groups: Union[dict, None] = None
+               ) -> None:
+        """
+        :param obs: observations of the batch
+        :param predictions: model key -> predictions of the batch
+        :param groups: group key -> values of the batch (one array per key of groupby)
+        """
+        obs = np.asarray(obs, dtype=np.float64).ravel()
+        group = self._get_batch_group_ids(groups, len(obs))
+        keep = group >= 0
+        if not np.all(keep):
+            obs, group = obs[keep], group[keep]
+            predictions = {key: np.asarray(predictions[key]).ravel()[keep] for key in self.keys}
+        nb_groups = len(self.groups)
+
+        def sum_by_group(values):
+            return np.bincount(group, weights=values, minlength=nb_groups)
+
+        for key in self.keys:
+            pred = np.asarray(predictions[key], dtype=np.float64).ravel()
+            valid = ~(np.isnan(obs) | np.isnan(pred))
+            true = np.where(valid, obs, 0)
+            model = np.where(valid, pred, 0)
+            error = model - true
+            n_b = sum_by_group(valid.astype(np.float64))
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                means = {name: np.where(n_b > 0, sum_by_group(values) / n_b, 0)
+                         for name, values in [("error", error), ("true", true), ("model", model)]}
+            centered = {name: np.where(valid, values - means[name][group], 0)
+                        for name, values in [("error", error), ("true", true), ("model", model)]}
+            m2 = {name: sum_by_group(values ** 2) for name, values in centered.items()}
+            comoments = {("true", "model"): sum_by_group(centered["true"] * centered["model"])}
+            self._merge_moments(key, n_b, means, m2, comoments)
+
+            sums = {"sum_abs_error": sum_by_group(np.abs(error))}
+            if "m_n_be" in self.metrics or "m_n_ae" in self.metrics:
+                n_error = error / (true + self.epsilon)
+                sums["sum_n_error"] = sum_by_group(n_error)
+                sums["sum_abs_n_error"] = sum_by_group(np.abs(n_error))
+            if any("direction" in metric for metric in self.metrics):
+                error_dir = bias_direction(obs, pred)
+                valid_dir = ~np.isnan(error_dir)
+                error_dir = np.where(valid_dir, error_dir, 0)
+                sums["n_dir"] = sum_by_group(valid_dir.astype(np.float64))
+                sums["sum_error_dir"] = sum_by_group(error_dir)
+                sums["sum_abs_error_dir"] = sum_by_group(np.abs(error_dir))
+                sums["sum_sq_error_dir"] = sum_by_group(error_dir ** 2)
+            self._add_sums(key, sums)
+
+        if self.sketches is not None:
+            self.sketches["obs"].update(obs, group)
+            for key in self.keys:
+                self.sketches[key].update(predictions[key], group)
+
+    def merge(self,
+              other: 'StreamingGroupedMetrics'
+              ) -> 'StreamingGroupedMetrics':
+        """Add the state of another stream with the same keys, groupby and metrics"""
+        ids = np.array([self._get_batch_group_ids({key: [value] for key, value in zip(self.groupby, group)}, 1)[0]
+                        for group in other.groups], dtype=np.int64)
+        nb_groups = len(self.groups)
+
+        def align(values):
+            aligned = np.zeros(nb_groups)
+            aligned[ids] = values
+            return aligned
+
+        for key in self.keys:
+            state = {name: align(values) for name, values in other.states[key].items()}
+            if not state:
+                continue
+            means = {name: state[f"mean_{name}"] for name in ["error", "true", "model"]}
+            m2 = {name: state[f"m2_{name}"] for name in ["error", "true", "model"]}
+            comoments = {("true", "model"): state["c_true_model"]}
+            self._merge_moments(key, state["n"], means, m2, comoments)
+            self._add_sums(key, {name: values for name, values in state.items()
+                                 if name.startswith("sum_") or name == "n_dir"})
+
+        if self.sketches is not None:
+            from bias_correction.train.sketches import GroupedQuantileSketch
+            for key, grouped_sketch in other.sketches.items():
+                # Group ids of the other stream are converted to the group ids of this stream
+                aligned = GroupedQuantileSketch(k=grouped_sketch.k)
+                aligned.sketches = {int(ids[group_id]): sketch for group_id, sketch in grouped_sketch.sketches.items()}
+                self.sketches[key].merge(aligned)
+        return self
+
+    def _add_group_columns(self,
+                           df: pd.DataFrame,
+                           group_ids: np.ndarray
+                           ) -> pd.DataFrame:
+        for idx, key_group in enumerate(self.groupby):
+            df[key_group] = [self.groups[group_id][idx] for group_id in group_ids]
+        return df
+
+    def result(self) -> pd.DataFrame:
+        """Same long format as grouped_metrics: one row per group and model, one column per metric"""
+        columns = self.groupby + ["model", "nb_obs"] + list(self.metrics)
+        group_ids = np.arange(len(self.groups))
+        results = []
+        for key in self.keys:
+            state = {name: self._get_state(key, name) for name in list(self.states[key])}
+            if not state:
+                continue
+            n = state["n"]
+            result = {"model": key, "nb_obs": n.astype(np.int64)}
+            with np.errstate(divide="ignore", invalid="ignore"):
+                n_nan = np.where(n > 0, n, np.nan)
+                if "mbe" in self.metrics:
+                    result["mbe"] = np.where(n > 0, state["mean_error"], np.nan)
+                if "mae" in self.metrics:
+                    result["mae"] = state["sum_abs_error"] / n_nan
+                if "rmse" in self.metrics:
+                    result["rmse"] = np.sqrt(state["mean_error"] ** 2 + state["m2_error"] / n_nan)
+                if "corr" in self.metrics:
+                    result["corr"] = state["c_true_model"] / np.sqrt(state["m2_true"] * state["m2_model"])
+                if "m_n_be" in self.metrics:
+                    result["m_n_be"] = state["sum_n_error"] / n_nan
+                if "m_n_ae" in self.metrics:
+                    result["m_n_ae"] = state["sum_abs_n_error"] / n_nan
+                n_dir = state.get("n_dir", np.zeros(len(n)))
+                n_dir = np.where(n_dir > 0, n_dir, np.nan)
+                if "mean_bias_direction" in self.metrics:
+                    result["mean_bias_direction"] = state["sum_error_dir"] / n_dir
+                if "mean_abs_bias_direction" in self.metrics:
+                    result["mean_abs_bias_direction"] = state["sum_abs_error_dir"] / n_dir
+                if "rmse_direction" in self.metrics:
+                    result["rmse_direction"] = np.sqrt(state["sum_sq_error_dir"] / n_dir)
+            df_key = self._add_group_columns(pd.DataFrame(result), group_ids)
+            if self.groupby:
+                df_key = df_key.sort_values(self.groupby, kind="stable")
+            results.append(df_key)
+
+        if not results:
+            return pd.DataFrame(columns=columns)
+        # Same row order as grouped_metrics: by model (in the order of keys), then by group
+        return pd.concat(results, ignore_index=True)[columns]
+
+    def get_sketch(self,
+                   key: str,
+                   group: Union[tuple, None] = None
+                   ):
+        """QuantileSketch of "obs" or of a model, for a group (tuple of the groupby values) or for all groups"""
+        if group is None:
+            return self.sketches[key].get()
+        return self.sketches[key].get(self.group_ids[tuple(group)])
+
+    def quantiles(self,
+                  q: Union[List[float], np.ndarray]
+                  ) -> pd.DataFrame:
+        """Quantiles of the observations ("obs") and of each model, by group (requires quantile_sketch_k)"""
+        list_df = []
+        for key, grouped_sketch in self.sketches.items():
+            df = grouped_sketch.quantiles(q)
+            df["model"] = key
+            list_df.append(self._add_group_columns(df, df["group"].values.astype(np.int64)))
+        return pd.concat(list_df, ignore_index=True)[self.groupby + ["model", "quantile", "value"]]
@@ -6,14 +6,8 @@ from tensorflow.keras.models import Model, \
     load_model
 from tensorflow.keras import backend as K
 
-try:
-    import horovod.tensorflow as hvd
-
-    _horovod = True
-except ModuleNotFoundError:
-    _horovod = False
-
 import os
+import importlib.util
 from functools import partial
 from typing import Callable, Union, Tuple, MutableSequence
 
@@ -44,9 +38,11 @@ from bias_correction.train.activations import load_activation
 from bias_correction.train.experience_manager import ExperienceManager
 from bias_correction.train.unet import create_unet
 from bias_correction.train.metrics import get_metric
+from bias_correction.utils_bc.utils_config import set_cuda_visible_devices
+from bias_correction.utils_bc.instrumentation import profiled, tf_profiler_window
 
-os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"  # see issue #152
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
+# Horovod is imported only when the Horovod distribution strategy is initialized
+_horovod = importlib.util.find_spec("horovod") is not None
 
 
 def tf_deg2rad(angle):
@@ -69,6 +65,7 @@ class StrategyInitializer:
 
     def __init__(self, config):
         self.config = config
+        set_cuda_visible_devices()
 
         # Define later
         self.strategy = None
@@ -100,12 +97,24 @@ class StrategyInitializer:
                 except RuntimeError:
                     pass
 
-    @staticmethod
-    def init_mirrored_strategy():
+    def get_cluster_resolver(self):
+        """
+        "slurm": SlurmClusterResolver (default, e.g. on Jean Zay)
+        "tf_config": TFConfigClusterResolver, reads the TF_CONFIG environment variable (e.g. set by local_launcher)
+        """
+        cluster_resolvers = {"slurm": tf.distribute.cluster_resolver.SlurmClusterResolver,
+                             "tf_config": tf.distribute.cluster_resolver.TFConfigClusterResolver}
+        return cluster_resolvers[self.config.get("cluster_resolver", "slurm")]()
+
+    def init_mirrored_strategy(self):
         """http://www.idris.fr/jean-zay/gpu/jean-zay-gpu-hvd-tf-multi.html"""
         # --- create the distribution strategy before calling any other tensorflow op
-        cluster_resolver = tf.distribute.cluster_resolver.SlurmClusterResolver()
-        implementation = tf.distribute.experimental.CommunicationImplementation.NCCL
+        cluster_resolver = self.get_cluster_resolver()
+        # NCCL requires GPUs, RING works on CPU and AUTO lets Tensorflow choose
+        implementations = {"NCCL": tf.distribute.experimental.CommunicationImplementation.NCCL,
+                           "RING": tf.distribute.experimental.CommunicationImplementation.RING,
+                           "AUTO": tf.distribute.experimental.CommunicationImplementation.AUTO}
+        implementation = implementations[self.config.get("communication_implementation", "NCCL")]
         communication_options = tf.distribute.experimental.CommunicationOptions(implementation=implementation)
         strategy = tf.distribute.MultiWorkerMirroredStrategy(cluster_resolver=cluster_resolver,
                                                              communication_options=communication_options)
@@ -117,22 +126,25 @@ class StrategyInitializer:
         print(f"task_id: {task_id}")
         # ---
 
-        # --- get total number of GPUs
-        n_workers = int(os.environ['SLURM_NTASKS'])  # get number of workers
+        # --- get total number of devices
+        n_workers = max(1, len(cluster_resolver.cluster_spec().as_dict().get("worker", [])))
         devices = tf.config.experimental.list_physical_devices('GPU')  # get list of devices visible per worker
         n_gpus_per_worker = len(devices)  # get number of devices per worker
         n_gpus = n_workers * n_gpus_per_worker  # get total number of GPUs
+        print("nworkers: ", n_workers)
         print("ngpus: ", n_gpus)
         # ---
         return strategy
 
     def adapt_learning_rate_if_horovod(self):
+        import horovod.tensorflow as hvd
         self.config["learning_rate"] = self.config["learning_rate"] * hvd.size()
         self.config["learning_rate_adapted"] = True
 
     def init_horovod(self):
         """https://github.com/horovod/horovod/blob/master/examples/keras/keras_mnist_advanced.py"""
         # Horovod: pin GPU to be used to process local rank (one GPU per process)
+        import horovod.tensorflow as hvd
         hvd.init()
 
         gpus = tf.config.experimental.list_physical_devices('GPU')
@@ -562,18 +574,36 @@ class CustomModel(StrategyInitializer):
                                    **self.config["kwargs_optimizer"])
 
         if self.config["distribution_strategy"] == "Horovod" and _horovod:
+            import horovod.tensorflow as hvd
             return hvd.DistributedOptimizer(optimizer)
         else:
             return optimizer
 
+    def _load_loss(self, name_loss):
+        return load_loss(name_loss,
+                         *self.config["args_loss"][name_loss],
+                         **self.config["kwargs_loss"][name_loss])
+
     def get_loss(self):
         name_loss = self.config.get("loss")
         if name_loss is None:
             return None
+        elif name_loss == "mixed":
+            # One loss per head of the double_ann: speed, then direction
+            loss_speed, loss_dir = self.config.get("losses_mixed", ("pinball_proportional", "cosine_distance"))
+            if self.config["type_of_output"] == "output_speed_and_dir":
+                return [self._load_loss(loss_speed), self._load_loss(loss_dir)]
+            elif self.config["type_of_output"] == "output_direction":
+                return self._load_loss(loss_dir)
+            else:
+                return self._load_loss(loss_speed)
         else:
-            return load_loss(name_loss,
-                             *self.config["args_loss"][name_loss],
-                             **self.config["kwargs_loss"][name_loss])
+            return self._load_loss(name_loss)
+
+    def get_loss_weights(self):
+        if self.config.get("loss") == "mixed" and self.config["type_of_output"] == "output_speed_and_dir":
+            return self.config.get("loss_weights_speed_dir")
+        return None
 
     def get_initializer(self):
         name_initializer = self.config.get("initializer")
@@ -641,7 +671,10 @@ class CustomModel(StrategyInitializer):
 
         intermediate_outputs = self.model.get_layer(f"Add_dense_output{str_name}").output
         self.model = Model(inputs=inputs, outputs=(self.model.outputs, intermediate_outputs))
-        self.model.compile(loss=self.get_loss(), optimizer=self.get_optimizer(), metrics=self.get_training_metrics())
+        self.model.compile(loss=self.get_loss(),
+                           loss_weights=self.get_loss_weights(),
+                           optimizer=self.get_optimizer(),
+                           metrics=self.get_training_metrics())
 
     def _build_model_architecture(self,
                                   nb_input_variables: int,
@@ -929,7 +962,10 @@ class CustomModel(StrategyInitializer):
 
     def _build_compiled_model(self, print_=True):
         self._build_model(print_=print_)
-        self.model.compile(loss=self.get_loss(), optimizer=self.get_optimizer(), metrics=self.get_training_metrics())
+        self.model.compile(loss=self.get_loss(),
+                           loss_weights=self.get_loss_weights(),
+                           optimizer=self.get_optimizer(),
+                           metrics=self.get_training_metrics())
         print("\nmodel is compiled", flush=True)
         self.model_is_compiled = True
 
@@ -1028,20 +1064,56 @@ class CustomModel(StrategyInitializer):
             index += batch_size
         return np.squeeze(results_test)
 
-    def fit_with_strategy(self, dataset, validation_data=None, dataloader=None, mode_callback=None):
+    @profiled
+    def fit_with_strategy(self, dataset, validation_data=None, dataloader=None, mode_callback=None,
+                          extra_callbacks=None):
 
         if not self.model_is_built and not self.model_is_compiled:
             self.build_model_with_strategy()
 
-        results = self.model.fit(dataset,
-                                 validation_data=validation_data,
-                                 epochs=self.config["epochs"],
-                                 callbacks=self.get_callbacks(dataloader, mode_callback))
+        # Optional tf.profiler trace of the whole fit, written next to the TensorBoard logs
+        with tf_profiler_window(self.exp.path_to_tensorboard_logs, enabled=self.config.get("tf_profiler", False)):
+            results = self._fit(dataset, validation_data=validation_data, dataloader=dataloader,
+                                mode_callback=mode_callback, extra_callbacks=extra_callbacks)
 
         self._set_model_version_after_training()
 
         return results
 
+    def _get_checkpoint_directory(self) -> Union[str, None]:
+        if not self.config.get("resumable_checkpoints", False):
+            return None
+        from bias_correction.train.checkpointing import get_checkpoint_directory
+        return get_checkpoint_directory(self.exp, self.config["type_of_output"])
+
+    def _fit(self, dataset, validation_data=None, dataloader=None, mode_callback=None, extra_callbacks=None):
+        callbacks = self.get_callbacks(dataloader, mode_callback) + list(extra_callbacks or [])
+        if self.config.get("custom_training_loop", False):
+            from bias_correction.train.training_loop import CustomTrainingLoop
+            training_loop = CustomTrainingLoop(self.model,
+                                               self.config,
+                                               strategy=self.strategy,
+                                               log_dir=self.exp.path_to_tensorboard_logs,
+                                               checkpoint_dir=self._get_checkpoint_directory())
+            results = training_loop.fit(dataset,
+                                        validation_data=validation_data,
+                                        epochs=self.config["epochs"],
+                                        callbacks=callbacks)
+        else:
+            if self.config.get("resumable_checkpoints", False):
+                # model.fit cannot checkpoint the iterator: completed epochs and steps are skipped on restart
+                from bias_correction.train.checkpointing import set_training_seed
+                set_training_seed(self.config)
+                callbacks.append(tf.keras.callbacks.BackupAndRestore(self._get_checkpoint_directory(),
+                                                                     save_freq=self.config.get("checkpoint_every_n_steps",
+                                                                                               "epoch"),
+                                                                     delete_checkpoint=False))
+            results = self.model.fit(dataset,
+                                     validation_data=validation_data,
+                                     epochs=self.config["epochs"],
+                                     callbacks=callbacks)
+        return results
+
     def _set_model_version_after_training(self):
         has_earlystopping = "EarlyStopping" in self.config["callbacks"]
         restore_best_weights = self.config["kwargs_callbacks"]["EarlyStopping"]["restore_best_weights"] is True
@@ -0,0 +1,192 @@
+import numpy as np
+import pandas as pd
+
+from copy import deepcopy
+from typing import Dict, Hashable, List, Union
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch (KLL).
+
+    Values are stored in compactors: level h holds items of weight 2 ** h. When a level exceeds its capacity, it
+    is sorted and every other item (random offset) is promoted to the next level. Memory is O(k log(n / k)) and
+    the rank error is about 1 / k. Sketches built on different shards are combined with merge.
+    Up to k values, nothing is compacted and quantiles are exact (same as np.quantile).
+    """
+
+    def __init__(self,
+                 k: int = 200,
+                 seed: Union[int, None] = 42
+                 ) -> None:
+        self.k = k
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.compactors = [np.empty(0, dtype=np.float64)]
+        self.rng = np.random.default_rng(seed)
+
+    def _capacity(self,
+                  level: int
+                  ) -> int:
+        depth = len(self.compactors) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.compactors):
+            items = self.compactors[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0, dtype=np.float64))
+                items = np.sort(items)
+                # With an odd number of items, the largest one stays at this level
+                kept = items[-1:] if len(items) % 2 else items[:0]
+                paired = items[:len(items) - len(kept)]
+                promoted = paired[self.rng.integers(2)::2]
+                self.compactors[level] = kept
+                self.compactors[level + 1] = np.concatenate([self.compactors[level + 1], promoted])
+            level += 1
+
+    def update(self,
+               values: np.ndarray
+               ) -> 'QuantileSketch':
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+        self.n += len(values)
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self._compress()
+        return self
+
+    def merge(self,
+              other: 'QuantileSketch'
+              ) -> 'QuantileSketch':
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.empty(0, dtype=np.float64))
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate([self.compactors[level], items])
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def _get_items_and_weights(self):
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(len(items_level), 2.0 ** level)
+                                  for level, items_level in enumerate(self.compactors)])
+        order = np.argsort(items, kind="stable")
+        return items[order], weights[order]
+
+    def quantile(self,
+                 q: Union[float, List[float], np.ndarray]
+                 ) -> Union[float, np.ndarray]:
+        """Approximate quantiles, q in [0, 1] (NaN if the sketch is empty)"""
+        q = np.asarray(q, dtype=np.float64)
+        if self.n == 0:
+            return np.full(q.shape, np.nan) if q.ndim else np.nan
+        items, weights = self._get_items_and_weights()
+        if self.n == 1:
+            return np.full(q.shape, self.min) if q.ndim else self.min
+        # Middle of the positions covered by each item: with unit weights, ranks are i / (n - 1),
+        # the "linear" method of np.quantile. The exact minimum and maximum anchor the extreme quantiles.
+        ranks = (np.cumsum(weights) - (weights + 1) / 2) / (np.sum(weights) - 1)
+        items = np.r_[self.min, items, self.max]
+        ranks = np.r_[0, ranks, 1]
+        result = np.interp(q, ranks, items)
+        return result if q.ndim else float(result)
+
+    def __len__(self) -> int:
+        return self.n
+
+
+class GroupedQuantileSketch:
+    """
+    One QuantileSketch per group (station, elevation class, model...), updated from arrays of values and labels.
+
+    Sketches of different shards are combined with merge, and the sketch of all groups is obtained by merging
+    the sketches of the groups.
+    """
+
+    def __init__(self,
+                 k: int = 200,
+                 seed: Union[int, None] = 42
+                 ) -> None:
+        self.k = k
+        self.seed = seed
+        self.sketches: Dict[Hashable, QuantileSketch] = {}
+
+    def _get_or_create(self,
+                       group: Hashable
+                       ) -> QuantileSketch:
+        if group not in self.sketches:
+            self.sketches[group] = QuantileSketch(k=self.k, seed=self.seed)
+        return self.sketches[group]
+
+    def update(self,
+               values: np.ndarray,
+               groups: Union[np.ndarray, None] = None
+               ) -> 'GroupedQuantileSketch':
+        """:param groups: group of each value (None: a single group). Values with a missing group are ignored."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if groups is None:
+            self._get_or_create(None).update(values)
+            return self
+        codes, uniques = pd.factorize(np.asarray(groups).ravel())
+        order = np.argsort(codes, kind="stable")
+        sorted_codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(codes) else []
+        for rows in np.split(order, starts[1:]) if len(codes) else []:
+            code = codes[rows[0]]
+            if code >= 0:
+                self._get_or_create(uniques[code]).update(values[rows])
+        return self
+
+    def merge(self,
+              other: 'GroupedQuantileSketch'
+              ) -> 'GroupedQuantileSketch':
+        for group, sketch in other.sketches.items():
+            if group in self.sketches:
+                self.sketches[group].merge(sketch)
+            else:
+                self.sketches[group] = deepcopy(sketch)
+        return self
+
+    def get(self,
+            group: Union[Hashable, List[Hashable], None] = None
+            ) -> QuantileSketch:
+        """Sketch of a group, of a list of groups, or of all the groups (None)"""
+        if group is not None and not isinstance(group, list):
+            return self.sketches[group]
+        groups = list(self.sketches) if group is None else group
+        merged = QuantileSketch(k=self.k, seed=self.seed)
+        for group in groups:
+            merged.merge(self.sketches[group])
+        return merged
+
+    def quantile(self,
+                 q: Union[float, List[float], np.ndarray],
+                 group: Union[Hashable, List[Hashable], None] = None
+                 ) -> Union[float, np.ndarray]:
+        return self.get(group).quantile(q)
+
+    def quantiles(self,
+                  q: Union[List[float], np.ndarray]
+                  ) -> pd.DataFrame:
+        """Long format: one row per group and quantile"""
+        rows = [{"group": group, "quantile": quantile, "value": value}
+                for group, sketch in self.sketches.items()
+                for quantile, value in zip(q, sketch.quantile(q))]
+        return pd.DataFrame(rows, columns=["group", "quantile", "value"])
+
+
+def sketch_quantiles(values: np.ndarray,
+                     q: Union[float, List[float], np.ndarray],
+                     k: int = 1000
+                     ) -> Union[float, np.ndarray]:
+    """Quantiles of values from a sketch (NaNs ignored), exact up to k values"""
+    return QuantileSketch(k=k).update(values).quantile(q)
@@ -0,0 +1,217 @@
+import numpy as np
+import pandas as pd
+
+import os
+import json
+import hashlib
+from functools import partial
+from typing import Dict, List, Tuple, Union
+
+from bias_correction.train.metrics import grouped_metrics, grouped_metrics_available, get_metric
+
+
+def _get_strata(stations: pd.DataFrame,
+                parameters: List[str],
+                metric: str
+                ) -> List[np.ndarray]:
+    """
+    Station names in each stratum.
+
+    For each parameter, stations are split in tertiles of the parameter, then each tertile is split in tertiles
+    of the metric: each parameter defines 9 strata.
+    """
+    strata = []
+    for parameter in parameters:
+        q33 = np.quantile(stations[parameter].values, 0.33)
+        q66 = np.quantile(stations[parameter].values, 0.66)
+
+        small_values = stations[stations[parameter].values <= q33]
+        medium_values = stations[(q33 <= stations[parameter].values) & (stations[parameter].values < q66)]
+        large_values = stations[q66 <= stations[parameter].values]
+
+        for stratified_stations in [small_values, medium_values, large_values]:
+            q33_strat = np.nanquantile(stratified_stations[metric].values, 0.33)
+            q66_strat = np.nanquantile(stratified_stations[metric].values, 0.66)
+
+            first_q = stratified_stations[metric] < q33_strat
+            second_q = (q33_strat <= stratified_stations[metric]) & (stratified_stations[metric] < q66_strat)
+            third_q = q66_strat <= stratified_stations[metric]
+
+            for filter_q in [first_q, second_q, third_q]:
+                strata.append(stratified_stations.loc[filter_q, "name"].values)
+    return strata
+
+
+def _sample_stations(rng: np.random.Generator,
+                     strata: List[np.ndarray],
+                     list_stations: List[str],
+                     stations_to_exclude: Union[List[str], set] = ()
+                     ) -> List[str]:
+    """One station per stratum, among the stations that are not already selected or excluded"""
+    list_stations = list(list_stations)
+    for stratum in strata:
+        already_selected = set(list_stations) | set(stations_to_exclude)
+        available = [name for name in stratum if name not in already_selected]
+        if available:
+            list_stations.append(available[rng.integers(len(available))])
+    return list_stations
+
+
+def _score_split(stations: pd.DataFrame,
+                 selected: List[str],
+                 variables: List[str]
+                 ) -> float:
+    """Distance between the distribution of the selected stations and of all stations (lower is better)"""
+    selected = stations[stations["name"].isin(selected)]
+    score = 0
+    for variable in variables:
+        values = stations[variable].values
+        values_selected = selected[variable].values
+        std = np.nanstd(values)
+        if len(values_selected) == 0 or not std:
+            continue
+        score += np.abs(np.nanmean(values_selected) - np.nanmean(values)) / std
+        score += np.abs(np.nanstd(values_selected) - std) / std
+    return score
+
+
+def _evaluate_candidate(seed: int,
+                        stations: pd.DataFrame,
+                        strata_test: List[np.ndarray],
+                        strata_val: List[np.ndarray],
+                        stations_forced_in_test: List[str],
+                        variables: List[str]
+                        ) -> Tuple[float, List[str], List[str]]:
+    rng = np.random.default_rng(seed)
+    stations_test = _sample_stations(rng, strata_test, stations_forced_in_test)
+    stations_val = _sample_stations(rng, strata_val, [], stations_to_exclude=stations_test)
+    score = _score_split(stations, stations_test, variables) + _score_split(stations, stations_val, variables)
+    return score, stations_test, stations_val
+
+
+class StationSplitSearch:
+    """
+    Search a stratified split of test and validation stations.
+
+    Station statistics are computed once, many candidate splits are sampled with seeded random generators
+    (in parallel if split_search_workers > 1), and the candidate whose test and validation stations best match
+    the distribution of all stations is kept. The chosen split is cached to disk.
+    """
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self.metric = config["metric_split"]
+        self.parameters_test = list(config["parameters_split_test"])
+        self.parameters_val = list(config["parameters_split_val"])
+        self.stations_forced_in_test = list(config.get("stations_forced_in_test", ["Col du Lac Blanc"]))
+        self.nb_candidates = config.get("split_search_candidates", 256)
+        self.seed = config.get("split_search_seed", 42)
+        self.nb_workers = config.get("split_search_workers", 1)
+        self.path_cache = config.get("path_split_cache", config.get("path_experiences"))
+
+    def compute_station_stats(self,
+                              time_series: pd.DataFrame,
+                              stations: pd.DataFrame
+                              ) -> pd.DataFrame:
+        """Station parameters and NWP metric, computed in one pass over the time series"""
+        time_series = time_series[["name", "Wind", "vw10m(m/s)"]].dropna()
+        if self.metric in grouped_metrics_available:
+            df_metric = grouped_metrics(time_series, "vw10m(m/s)", ["Wind"], groupby="name", metrics=(self.metric,))
+            df_metric = df_metric[["name", self.metric]]
+        else:
+            metric_func = get_metric(self.metric)
+            df_metric = time_series.groupby("name").apply(lambda df: metric_func(df["vw10m(m/s)"].values,
+                                                                                 df["Wind"].values))
+            df_metric = df_metric.rename(self.metric).reset_index()
+
+        parameters = list(dict.fromkeys(self.parameters_test + self.parameters_val))
+        stations = stations[["name"] + parameters].drop_duplicates(subset="name")
+        stations = stations.merge(df_metric, on="name", how="left")
+        return stations.sort_values("name").reset_index(drop=True)
+
+    def _get_cache_key(self,
+                       stations: pd.DataFrame
+                       ) -> str:
+        # Station parameters and NWP metric: a new time series or new station parameters give a new split
+        stats_hash = hashlib.sha256(pd.util.hash_pandas_object(stations).values.tobytes()).hexdigest()
+        description = {"stations": list(stations["name"].values),
+                       "stations_stats": stats_hash,
+                       "metric": self.metric,
+                       "parameters_test": self.parameters_test,
+                       "parameters_val": self.parameters_val,
+                       "stations_forced_in_test": self.stations_forced_in_test,
+                       "nb_candidates": self.nb_candidates,
+                       "seed": self.seed}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16]
+
+    def _get_path_cache(self,
+                        stations: pd.DataFrame
+                        ) -> Union[str, None]:
+        if self.path_cache is None:
+            return None
+        return os.path.join(self.path_cache, f"split_stations_{self._get_cache_key(stations)}.json")
+
+    def load_split(self,
+                   path: Union[str, None]
+                   ) -> Union[Dict, None]:
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def save_split(path: Union[str, None],
+                   split: Dict
+                   ) -> None:
+        if path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(split, f, indent=2)
+        except OSError as e:
+            print(f"Split could not be cached: {e}", flush=True)
+
+    def search(self,
+               time_series: pd.DataFrame,
+               stations: pd.DataFrame
+               ) -> Tuple[List[str], List[str]]:
+        """:return: test stations and validation stations"""
+        stations = self.compute_station_stats(time_series, stations)
+
+        path = self._get_path_cache(stations)
+        split = self.load_split(path)
+        if split is not None:
+            print(f"Split loaded from {path}", flush=True)
+            return split["stations_test"], split["stations_val"]
+
+        strata_test = _get_strata(stations, self.parameters_test, self.metric)
+        strata_val = _get_strata(stations, self.parameters_val, self.metric)
+        variables = list(dict.fromkeys(self.parameters_test + self.parameters_val + [self.metric]))
+        seeds = np.random.SeedSequence(self.seed).generate_state(self.nb_candidates)
+
+        evaluate = partial(_evaluate_candidate,
+                           stations=stations,
+                           strata_test=strata_test,
+                           strata_val=strata_val,
+                           stations_forced_in_test=self.stations_forced_in_test,
+                           variables=variables)
+
+        if self.nb_workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=self.nb_workers) as executor:
+                candidates = list(executor.map(evaluate, seeds, chunksize=max(1, len(seeds) // self.nb_workers)))
+        else:
+            candidates = [evaluate(seed) for seed in seeds]
+
+        # Ties are broken by the order of the seeds
+        idx_best = int(np.argmin([score for score, _, _ in candidates]))
+        score, stations_test, stations_val = candidates[idx_best]
+        print(f"Best split among {len(candidates)} candidates: score {score:.3f}, "
+              f"{len(stations_test)} test stations, {len(stations_val)} validation stations", flush=True)
+
+        self.save_split(path, {"stations_test": stations_test,
+                               "stations_val": stations_val,
+                               "score": float(score),
+                               "seed": int(seeds[idx_best])})
+        return stations_test, stations_val
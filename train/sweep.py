@@ -0,0 +1,357 @@
+import numpy as np
+import pandas as pd
+
+import os
+import json
+import itertools
+from copy import deepcopy
+from typing import Dict, List, MutableSequence, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bias_correction.train.dataloader import CustomDataHandler
+
+
+def grid_search(space: Dict[str, MutableSequence]) -> List[Dict]:
+    """All the combinations of the values of the search space"""
+    keys = list(space.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[space[key] for key in keys])]
+
+
+def random_search(space: Dict[str, Union[list, tuple]],
+                  nb_trials: int,
+                  seed: int = 42
+                  ) -> List[Dict]:
+    """
+    Random trials of the search space.
+
+    A list is a set of choices, a tuple (low, high) a uniform range and a tuple (low, high, "log") a log-uniform range.
+    """
+    rng = np.random.default_rng(seed)
+
+    def draw(values):
+        if isinstance(values, tuple) and len(values) == 3 and values[2] == "log":
+            return float(np.exp(rng.uniform(np.log(values[0]), np.log(values[1]))))
+        if isinstance(values, tuple):
+            low, high = values
+            if isinstance(low, int) and isinstance(high, int):
+                return int(rng.integers(low, high + 1))
+            return float(rng.uniform(low, high))
+        return values[rng.integers(len(values))]
+
+    return [{key: draw(values) for key, values in space.items()} for _ in range(nb_trials)]
+
+
+def get_nb_available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class SharedDataCache:
+    """
+    Prepared splits and topographies written once as .npy files and memory-mapped by each trial.
+
+    Trials of a sweep share the same split and normalization: the parent process prepares the data once and the
+    workers open the arrays with np.load(mmap_mode="r"), so the pages are shared through the OS page cache instead
+    of being copied in each process. Names are stored as station codes and restored as a pd.Categorical.
+    Centered topographies are stacked per station (nb_stations, 140, 140, nb_channels).
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def _get_path(self,
+                  name: str
+                  ) -> str:
+        return os.path.join(self.path, name)
+
+    def is_saved(self) -> bool:
+        return os.path.exists(self._get_path("metadata.json"))
+
+    def save(self,
+             data_loader: 'CustomDataHandler',
+             modes: MutableSequence[str] = ("train", "val", "test")
+             ) -> None:
+        from bias_correction.train.tfrecords import TFRecordStore
+
+        os.makedirs(self.path, exist_ok=True)
+        modes = [mode for mode in modes if data_loader.get_inputs(mode) is not None]
+        stations = np.unique(np.concatenate([np.asarray(data_loader.get_names(mode), dtype=str) for mode in modes]))
+
+        for mode in modes:
+            inputs = data_loader.get_inputs(mode)
+            labels = data_loader.get_labels(mode)
+            names = np.asarray(data_loader.get_names(mode), dtype=str)
+            np.save(self._get_path(f"{mode}_inputs.npy"), inputs.values.astype(np.float32))
+            np.save(self._get_path(f"{mode}_labels.npy"), np.asarray(labels.values, dtype=np.float32))
+            np.save(self._get_path(f"{mode}_names.npy"), np.searchsorted(stations, names).astype(np.int32))
+            np.save(self._get_path(f"{mode}_time.npy"), pd.DatetimeIndex(inputs.index).values)
+            if self._is_uncentered(data_loader):
+                idx_x, idx_y = data_loader.get_idx(mode)
+                np.save(self._get_path(f"{mode}_idx_x.npy"), np.asarray(idx_x, dtype=np.int64))
+                np.save(self._get_path(f"{mode}_idx_y.npy"), np.asarray(idx_y, dtype=np.int64))
+
+        # Uncentered topographies (280 x 280) are loaded by UncenteredTopos in each trial
+        if not self._is_uncentered(data_loader):
+            topos = TFRecordStore(data_loader.config).get_station_maps(list(stations))
+            np.save(self._get_path("topos.npy"), topos)
+
+        labels = data_loader.get_labels(modes[0])
+        metadata = {"modes": modes,
+                    "stations": [str(station) for station in stations],
+                    "stations_train": [str(station) for station in data_loader.config.get("stations_train", [])],
+                    "input_columns": list(data_loader.get_inputs(modes[0]).columns),
+                    "label_columns": [str(column) for column in labels.columns] if hasattr(labels, "columns")
+                    else [str(labels.name)],
+                    "labels_ndim": int(np.ndim(labels.values)),
+                    "random_idx": self._is_uncentered(data_loader),
+                    "mean": None if data_loader.get_mean() is None else [float(v) for v in data_loader.get_mean()],
+                    "std": None if data_loader.get_std() is None else [float(v) for v in data_loader.get_std()]}
+        with open(self._get_path("metadata.json"), "w") as f:
+            json.dump(metadata, f, indent=2)
+        print(f"Saved shared data of {modes} in {self.path}", flush=True)
+
+    @staticmethod
+    def _is_uncentered(data_loader: 'CustomDataHandler') -> bool:
+        return bool(data_loader.config.get("random_idx", False))
+
+    def load(self,
+             data_loader: 'CustomDataHandler'
+             ) -> 'CustomDataHandler':
+        """Set the prepared splits of data_loader from the memory-mapped arrays, without copying them"""
+        with open(self._get_path("metadata.json"), "r") as f:
+            metadata = json.load(f)
+        stations = pd.Index(metadata["stations"])
+
+        for mode in metadata["modes"]:
+            index = pd.DatetimeIndex(np.load(self._get_path(f"{mode}_time.npy")))
+            inputs = np.load(self._get_path(f"{mode}_inputs.npy"), mmap_mode="r")
+            labels = np.load(self._get_path(f"{mode}_labels.npy"), mmap_mode="r")
+            codes = np.load(self._get_path(f"{mode}_names.npy"), mmap_mode="r")
+
+            setattr(data_loader, f"inputs_{mode}", pd.DataFrame(inputs,
+                                                                index=index,
+                                                                columns=metadata["input_columns"],
+                                                                copy=False))
+            if metadata["labels_ndim"] > 1:
+                labels = pd.DataFrame(labels, index=index, columns=metadata["label_columns"], copy=False)
+            else:
+                labels = pd.Series(labels, index=index, name=metadata["label_columns"][0], copy=False)
+            setattr(data_loader, f"labels_{mode}", labels)
+            setattr(data_loader, f"names_{mode}", pd.Series(pd.Categorical.from_codes(codes, categories=stations),
+                                                            index=index,
+                                                            name="name"))
+            setattr(data_loader, f"length_{mode}", len(inputs))
+            if metadata["random_idx"]:
+                setattr(data_loader, f"idx_x_{mode}", np.load(self._get_path(f"{mode}_idx_x.npy"), mmap_mode="r"))
+                setattr(data_loader, f"idx_y_{mode}", np.load(self._get_path(f"{mode}_idx_y.npy"), mmap_mode="r"))
+
+        if metadata["mean"] is not None:
+            data_loader.mean_standardize = pd.Series(metadata["mean"], index=metadata["input_columns"])
+            data_loader.std_standardize = pd.Series(metadata["std"], index=metadata["input_columns"])
+        data_loader.config["stations_train"] = metadata["stations_train"]
+
+        if not metadata["random_idx"]:
+            topos = np.load(self._get_path("topos.npy"), mmap_mode="r")
+            data_loader.dict_topos = {station: {"data": topos[idx]} for idx, station in enumerate(stations)}
+            data_loader.config["custom_dataloader"] = True
+
+        data_loader._set_is_prepared()
+        return data_loader
+
+
+def _init_worker(threads: int,
+                 cpu_only: bool
+                 ) -> None:
+    """Limit the threads of each trial before TensorFlow is imported in the worker"""
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    if cpu_only:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+
+def _run_trial(trial: Dict) -> Dict:
+    """Fit one trial in a worker process and record its score in the registry"""
+    from bias_correction.train.model import CustomModel
+    from bias_correction.train.dataloader import CustomDataHandler
+    from bias_correction.train.callbacks import SweepPruningCallback
+
+    config = trial["config"]
+    exp = trial["exp"]
+    monitor = config.get("sweep_monitor", "val_loss")
+
+    data_loader = SharedDataCache(trial["path_cache"]).load(CustomDataHandler(config))
+
+    cm = CustomModel(exp, config)
+    cm.build_model_with_strategy(print_=False)
+
+    pruning = SweepPruningCallback(exp.registry,
+                                   exp.name_current_experience,
+                                   config["sweep_key"],
+                                   monitor=monitor,
+                                   min_epochs=config.get("sweep_pruning_warmup_epochs", 2),
+                                   min_trials=config.get("sweep_pruning_min_trials", 3))
+    has_val = data_loader.get_inputs("val") is not None
+    results = cm.fit_with_strategy(data_loader.get_batched_inputs_labels(mode="train"),
+                                   validation_data=data_loader.get_batched_inputs_labels(mode="val") if has_val else None,
+                                   dataloader=data_loader,
+                                   mode_callback="train",
+                                   extra_callbacks=[pruning])
+
+    history = results.history.get(monitor, [np.nan])
+    score = float(np.nanmin(history))
+    exp.registry.set_metrics(exp.name_current_experience, {"sweep_score": score, "sweep_epochs": len(history)})
+    exp.save_all(data_loader, cm)
+    exp.mark_finished()
+
+    return {"exp": exp.name_current_experience,
+            "params": trial["params"],
+            "rung": config.get("sweep_rung", 0),
+            "epochs": len(history),
+            "score": score,
+            "pruned": pruning.pruned_at_epoch is not None}
+
+
+class SweepRunner:
+    """
+    Parallel hyperparameter sweep over a config_double_v1-style config.
+
+    The base config is prepared once and shared with the trials through SharedDataCache. Trials run in a
+    process pool sized to the available cores (threads_per_trial cores each). Each trial is an experience of the
+    registry, with its parameters and the hyperparameters sweep, sweep_key and sweep_rung. Trials worse than the
+    median of the others at the same epoch are stopped early (callbacks.SweepPruningCallback).
+
+    The search space should only contain model and training keys: data keys (input variables, split...) are
+    fixed by the shared data.
+    """
+
+    def __init__(self,
+                 config: dict,
+                 name: str,
+                 nb_workers: Union[int, None] = None,
+                 threads_per_trial: Union[int, None] = None
+                 ) -> None:
+        self.config = config
+        self.name = name
+        self.threads_per_trial = threads_per_trial or config.get("sweep_threads_per_trial", 1)
+        nb_workers = nb_workers or config.get("sweep_workers")
+        self.nb_workers = nb_workers or max(1, get_nb_available_cores() // self.threads_per_trial)
+        self.cpu_only = config.get("sweep_cpu_only", True)
+        path_cache = os.path.join(config["path_experiences"], "sweep_cache", name)
+        self.cache = SharedDataCache(config.get("path_sweep_cache", path_cache))
+
+    def prepare_shared_data(self, override: bool = False) -> None:
+        from bias_correction.train.dataloader import CustomDataHandler
+        if self.cache.is_saved() and not override:
+            print(f"Use shared data of {self.cache.path}", flush=True)
+            return
+        data_loader = CustomDataHandler(deepcopy(self.config))
+        data_loader.prepare_train_test_data()
+        self.cache.save(data_loader)
+
+    def _get_trial(self,
+                   params: Dict,
+                   idx_trial: int,
+                   rung: int = 0,
+                   epochs: Union[int, None] = None
+                   ) -> Dict:
+        from bias_correction.train.experience_manager import ExperienceManager
+
+        config = deepcopy(self.config)
+        config.update(params)
+        if epochs is not None:
+            config["epochs"] = epochs
+        config["sweep"] = self.name
+        config["sweep_trial"] = idx_trial
+        config["sweep_rung"] = rung
+        config["sweep_key"] = f"{self.name}/rung_{rung}"
+        config["details"] = f"sweep {self.name} trial {idx_trial} rung {rung}: {params}"
+
+        # Experiences are created here, one after the other, so that their names do not collide
+        exp = ExperienceManager(config)
+        return {"config": config, "exp": exp, "params": params, "path_cache": self.cache.path}
+
+    def run_trials(self,
+                   list_params: List[Dict],
+                   rung: int = 0,
+                   epochs: Union[int, None] = None,
+                   idx_trials: Union[List[int], None] = None
+                   ) -> pd.DataFrame:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        self.prepare_shared_data()
+        idx_trials = idx_trials if idx_trials is not None else list(range(len(list_params)))
+        trials = [self._get_trial(params, idx, rung=rung, epochs=epochs)
+                  for params, idx in zip(list_params, idx_trials)]
+
+        print(f"Sweep {self.name}: {len(trials)} trials on {self.nb_workers} workers "
+              f"({self.threads_per_trial} threads each)", flush=True)
+        results = []
+        with ProcessPoolExecutor(max_workers=min(self.nb_workers, len(trials)),
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(self.threads_per_trial, self.cpu_only)) as executor:
+            futures = {executor.submit(_run_trial, trial): (idx, trial) for idx, trial in zip(idx_trials, trials)}
+            for future in as_completed(futures):
+                idx, trial = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Trial {idx} failed: {e}", flush=True)
+                    result = {"exp": trial["exp"].name_current_experience, "params": trial["params"], "rung": rung,
+                              "epochs": 0, "score": np.nan, "pruned": False}
+                result["trial"] = idx
+                print(f"Trial {idx}: {result['params']} {self.config.get('sweep_monitor', 'val_loss')}="
+                      f"{result['score']:.4f} after {result['epochs']} epochs"
+                      + (" (pruned)" if result["pruned"] else ""), flush=True)
+                results.append(result)
+
+        return pd.DataFrame(results).sort_values("score").reset_index(drop=True)
+
+    def grid(self,
+             space: Dict[str, MutableSequence]
+             ) -> pd.DataFrame:
+        return self.run_trials(grid_search(space))
+
+    def random(self,
+               space: Dict[str, Union[list, tuple]],
+               nb_trials: int,
+               seed: int = 42
+               ) -> pd.DataFrame:
+        return self.run_trials(random_search(space, nb_trials, seed=seed))
+
+    def successive_halving(self,
+                           list_params: List[Dict],
+                           min_epochs: int = 1,
+                           max_epochs: Union[int, None] = None,
+                           eta: int = 3
+                           ) -> pd.DataFrame:
+        """
+        Run all the trials with min_epochs, keep the best 1/eta, multiply the epochs by eta, until one trial is
+        left or max_epochs is reached. Each rung trains the kept trials from scratch.
+        """
+        max_epochs = max_epochs or self.config["epochs"]
+        idx_trials = list(range(len(list_params)))
+        epochs = min_epochs
+        rung = 0
+        list_results = []
+        while True:
+            results = self.run_trials([list_params[idx] for idx in idx_trials],
+                                      rung=rung,
+                                      epochs=epochs,
+                                      idx_trials=idx_trials)
+            list_results.append(results)
+            if len(idx_trials) <= 1 or epochs >= max_epochs:
+                break
+            nb_kept = max(1, len(idx_trials) // eta)
+            idx_trials = list(results.dropna(subset=["score"])["trial"].iloc[:nb_kept])
+            if not idx_trials:
+                break
+            epochs = min(epochs * eta, max_epochs)
+            rung += 1
+
+        return pd.concat(list_results, ignore_index=True).sort_values(["rung", "score"],
+                                                                      ascending=[False, True]).reset_index(drop=True)
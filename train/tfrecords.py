@@ -0,0 +1,259 @@
+import numpy as np
+import pandas as pd
+
+import os
+import json
+import hashlib
+from typing import Dict, List, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tensorflow as tf
+    from bias_correction.train.dataloader import CustomDataHandler
+
+
+def _get_shard_names(mode: str,
+                     nb_shards: int
+                     ) -> List[str]:
+    return [f"{mode}-{idx:05d}-of-{nb_shards:05d}.tfrecord" for idx in range(nb_shards)]
+
+
+def _serialize_row(inputs: np.ndarray,
+                   labels: np.ndarray,
+                   station: int,
+                   time: int,
+                   idx_x: Union[int, None] = None,
+                   idx_y: Union[int, None] = None
+                   ) -> bytes:
+    import tensorflow as tf
+    feature = {"inputs": tf.train.Feature(float_list=tf.train.FloatList(value=inputs)),
+               "labels": tf.train.Feature(float_list=tf.train.FloatList(value=labels)),
+               "station": tf.train.Feature(int64_list=tf.train.Int64List(value=[station])),
+               "time": tf.train.Feature(int64_list=tf.train.Int64List(value=[time]))}
+    if idx_x is not None:
+        feature["idx_x"] = tf.train.Feature(int64_list=tf.train.Int64List(value=[idx_x]))
+        feature["idx_y"] = tf.train.Feature(int64_list=tf.train.Int64List(value=[idx_y]))
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+# Configuration of the prepared splits: records exported with other values can not be read back
+DATA_CONFIG_KEYS = ("time_series", "stations", "data_end_date", "input_variables", "labels", "map_variables",
+                    "path_to_topographic_parameters", "topos_near_station", "aspect_near_station",
+                    "tan_slope_near_station", "compute_product_with_wind_direction",
+                    "stations_train", "stations_test", "stations_val", "stations_to_reject",
+                    "country_to_reject_during_training", "split_strategy_test", "split_strategy_val",
+                    "date_split_train_test", "date_split_train_val", "random_split_test_size_test",
+                    "random_split_test_size_val", "random_split_state_test", "random_split_state_val",
+                    "index_split", "quick_test", "quick_test_stations", "remove_null_speeds", "threshold_null_speed",
+                    "unbalanced_dataset", "unbalanced_threshold", "shuffle",
+                    "random_idx", "random_idx_min", "random_idx_max", "random_idx_seed")
+
+
+def get_data_hash(config: dict) -> str:
+    """Hash of the configuration keys that define the content of the prepared splits"""
+    description = {key: config.get(key) for key in DATA_CONFIG_KEYS}
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class TFRecordStore:
+    """
+    Export prepared splits to sharded TFRecord files and stream them back.
+
+    Each record is one row: NWP inputs, labels, station index, time (ns since epoch) and optional random offsets
+    of the uncentered topographies. Topographies are not written: the reader keeps one map per station in memory
+    and gathers it with the station index. A JSON file describes the columns, stations and shards of each mode.
+
+    Records are stored in a directory named after the hash of the data configuration (get_data_hash), also written
+    in the metadata: records exported with another data configuration are not considered as exported.
+    """
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self.nb_shards = config.get("tfrecords_nb_shards", 16)
+        self.compression = config.get("tfrecords_compression", None)
+
+    @property
+    def path(self) -> str:
+        # The hash is computed when used: the splits are defined once the data is prepared
+        if self.config.get("path_tfrecords") is not None:
+            return self.config["path_tfrecords"]
+        return os.path.join(self.config.get("path_experiences", ""), "tfrecords", get_data_hash(self.config))
+
+    def _get_path_metadata(self,
+                           mode: str
+                           ) -> str:
+        return os.path.join(self.path, f"{mode}_metadata.json")
+
+    def load_metadata(self,
+                      mode: str
+                      ) -> Dict:
+        with open(self._get_path_metadata(mode), "r") as f:
+            return json.load(f)
+
+    def _check_metadata(self,
+                        metadata: Dict
+                        ) -> Union[str, None]:
+        """Reason why the records described by metadata do not match the current configuration, if any"""
+        if metadata.get("data_hash") != get_data_hash(self.config):
+            return "the data configuration changed since the export"
+        if metadata["input_columns"] != list(self.config["input_variables"]):
+            return f"input columns {metadata['input_columns']} != {list(self.config['input_variables'])}"
+        labels = self.config["labels"] if isinstance(self.config["labels"], list) else [self.config["labels"]]
+        if metadata["label_columns"] != [str(label) for label in labels]:
+            return f"label columns {metadata['label_columns']} != {labels}"
+        return None
+
+    def is_exported(self,
+                    mode: str
+                    ) -> bool:
+        """True if the records of the mode exist and were exported with the current data configuration"""
+        if not os.path.exists(self._get_path_metadata(mode)):
+            return False
+        reason = self._check_metadata(self.load_metadata(mode))
+        if reason is not None:
+            print(f"TFRecords of {mode} in {self.path} are outdated: {reason}", flush=True)
+        return reason is None
+
+    def export(self,
+               data: 'CustomDataHandler',
+               mode: str
+               ) -> Dict:
+        """Write the prepared split of the mode to nb_shards files of contiguous rows"""
+        import tensorflow as tf
+
+        inputs = data.get_inputs(mode)
+        labels = data.get_labels(mode)
+        names = np.asarray(data.get_names(mode))
+        stations, idx_stations = np.unique(names, return_inverse=True)
+        times = pd.DatetimeIndex(inputs.index).asi8
+
+        uncentered = self.config.get("random_idx", False)
+        if uncentered:
+            idx_x, idx_y = data.get_idx(mode)
+            idx_x, idx_y = np.asarray(idx_x, dtype=np.int64), np.asarray(idx_y, dtype=np.int64)
+
+        values_inputs = inputs.values.astype(np.float32)
+        values_labels = np.asarray(labels.values, dtype=np.float32).reshape((len(labels), -1))
+
+        os.makedirs(self.path, exist_ok=True)
+        nb_shards = max(1, min(self.nb_shards, len(inputs)))
+        shard_names = _get_shard_names(mode, nb_shards)
+        shard_lengths = []
+        options = tf.io.TFRecordOptions(compression_type=self.compression)
+        for shard_name, rows in zip(shard_names, np.array_split(np.arange(len(inputs)), nb_shards)):
+            with tf.io.TFRecordWriter(os.path.join(self.path, shard_name), options=options) as writer:
+                for row in rows:
+                    writer.write(_serialize_row(values_inputs[row],
+                                                values_labels[row],
+                                                int(idx_stations[row]),
+                                                int(times[row]),
+                                                int(idx_x[row]) if uncentered else None,
+                                                int(idx_y[row]) if uncentered else None))
+            shard_lengths.append(len(rows))
+
+        label_columns = list(labels.columns) if hasattr(labels, "columns") else [labels.name]
+        metadata = {"mode": mode,
+                    "data_hash": get_data_hash(self.config),
+                    "length": int(len(inputs)),
+                    "input_columns": list(inputs.columns),
+                    "label_columns": [str(column) for column in label_columns],
+                    "labels_ndim": int(np.ndim(labels.values)),
+                    "stations": [str(station) for station in stations],
+                    "uncentered": bool(uncentered),
+                    "compression": self.compression,
+                    "shards": shard_names,
+                    "shard_lengths": shard_lengths}
+        with open(self._get_path_metadata(mode), "w") as f:
+            json.dump(metadata, f, indent=2)
+        print(f"Exported {len(inputs)} {mode} rows to {nb_shards} shards in {self.path}", flush=True)
+        return metadata
+
+    def get_station_maps(self,
+                         stations: List[str]
+                         ) -> np.ndarray:
+        """One centered map per station: (nb_stations, 140, 140, nb_channels)"""
+        from bias_correction.train.dataloader import Loader
+        loader = Loader(self.config)
+        list_dict_topos = [loader.load_dict(name_map) for name_map in self.config["map_variables"]]
+        return np.stack([np.concatenate([dict_topos[station]["data"] for dict_topos in list_dict_topos], axis=-1)
+                         for station in stations]).astype(np.float32)
+
+    def read(self,
+             mode: str,
+             mean: Union[np.ndarray, None] = None,
+             std: Union[np.ndarray, None] = None,
+             nb_workers: int = 1,
+             worker_index: int = 0,
+             shuffle_shards: bool = False,
+             seed: Union[int, None] = None,
+             deterministic: bool = True,
+             random_crop: bool = False
+             ) -> 'tf.data.Dataset':
+        """
+        Unbatched dataset with the structure of CustomDataHandler.get_tf_zipped_inputs_labels:
+        ((maps, inputs, mean, std), labels), or ((maps, inputs), labels) if mean and std are None.
+
+        Shards are read with interleave and parsed in parallel. Each worker reads the shards
+        worker_index, worker_index + nb_workers, ...
+        With random_crop, uncentered maps are cropped with new random offsets at each epoch
+        (as UncenteredTopos.get_dataset) instead of the offsets written at the export.
+        """
+        import tensorflow as tf
+
+        metadata = self.load_metadata(mode)
+        reason = self._check_metadata(metadata)
+        if reason is not None:
+            raise ValueError(f"TFRecords of {mode} in {self.path} can not be read: {reason}. "
+                             f"Export them again with CustomDataHandler.export_tfrecords")
+        nb_inputs = len(metadata["input_columns"])
+        nb_labels = len(metadata["label_columns"])
+        uncentered = metadata["uncentered"]
+        labels_ndim = metadata.get("labels_ndim", 2)
+
+        features = {"inputs": tf.io.FixedLenFeature([nb_inputs], tf.float32),
+                    "labels": tf.io.FixedLenFeature([nb_labels], tf.float32),
+                    "station": tf.io.FixedLenFeature([], tf.int64),
+                    "time": tf.io.FixedLenFeature([], tf.int64)}
+        if uncentered:
+            features["idx_x"] = tf.io.FixedLenFeature([], tf.int64)
+            features["idx_y"] = tf.io.FixedLenFeature([], tf.int64)
+
+        if uncentered:
+            from bias_correction.train.dataloader import UncenteredTopos
+            uncentered_topos = UncenteredTopos(metadata["stations"], self.config)
+        else:
+            station_maps = tf.constant(self.get_station_maps(metadata["stations"]))
+        if mean is not None:
+            mean = tf.constant(np.asarray(mean, dtype=np.float32))
+            std = tf.constant(np.asarray(std, dtype=np.float32))
+
+        random_crop = random_crop and uncentered
+
+        def parse(record, sample_seed=None):
+            example = tf.io.parse_single_example(record, features)
+            if random_crop:
+                maps = uncentered_topos.random_crop(example["station"], sample_seed)
+            elif uncentered:
+                maps = uncentered_topos.crop(example["station"], example["idx_x"], example["idx_y"])
+            else:
+                maps = tf.gather(station_maps, example["station"])
+            # Labels of a Series are scalars, as in get_tf_zipped_inputs_labels
+            labels = example["labels"] if labels_ndim > 1 else example["labels"][0]
+            if mean is None:
+                return (maps, example["inputs"]), labels
+            return (maps, example["inputs"], mean, std), labels
+
+        files = [os.path.join(self.path, shard) for shard in metadata["shards"]]
+        files = tf.data.Dataset.from_tensor_slices(files).shard(nb_workers, worker_index)
+        if shuffle_shards:
+            files = files.shuffle(len(metadata["shards"]), seed=seed, reshuffle_each_iteration=True)
+
+        dataset = files.interleave(lambda file: tf.data.TFRecordDataset(file,
+                                                                        compression_type=metadata["compression"]),
+                                   cycle_length=tf.data.AUTOTUNE,
+                                   num_parallel_calls=tf.data.AUTOTUNE,
+                                   deterministic=deterministic)
+        if random_crop:
+            # One seed per sample, drawn again at each iteration over the dataset (i.e. each epoch)
+            seeds = tf.data.Dataset.random(seed=uncentered_topos.seed, rerandomize_each_iteration=True)
+            dataset = tf.data.Dataset.zip((dataset, seeds))
+        return dataset.map(parse, num_parallel_calls=tf.data.AUTOTUNE, deterministic=deterministic)
@@ -0,0 +1,280 @@
+import numpy as np
+
+import os
+import time
+from typing import List, Tuple, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tensorflow as tf
+
+
+class CustomTrainingLoop:
+    """
+    Training loop alternative to model.fit, with step-level timing.
+
+    - jit_compile: compile the training steps with XLA
+    - gradient_accumulation_steps: gradients of several batches are summed before each optimizer step
+    - steps_per_execution: number of batches processed by each call to the compiled function
+
+    With a checkpoint_dir, the training is resumable (train/checkpointing.py): weights, optimizer, gradient
+    accumulators, epoch, step, random generator and iterator state are checkpointed, and a new fit restarts at the
+    step where it stopped.
+
+    Each execution is timed in two parts: the time spent waiting for the input pipeline (data wait) and the time
+    spent in the compiled function (compute). Timings are written to TensorBoard (log_dir/train_loop) and
+    summarized at the end of each epoch: a large data wait means the configuration is input-bound.
+    """
+
+    def __init__(self,
+                 model: 'tf.keras.Model',
+                 config: dict,
+                 strategy: Union['tf.distribute.Strategy', None] = None,
+                 log_dir: Union[str, None] = None,
+                 checkpoint_dir: Union[str, None] = None
+                 ) -> None:
+        self.model = model
+        self.config = config
+        self.strategy = strategy
+        self.jit_compile = config.get("jit_compile", False)
+        self.accumulation_steps = max(1, config.get("gradient_accumulation_steps", 1))
+        self.steps_per_execution = max(1, config.get("steps_per_execution", 1))
+        self.log_every_n_executions = config.get("log_every_n_executions", 10)
+        self.log_dir = None if log_dir is None else os.path.join(log_dir, "train_loop")
+        self.checkpoint_dir = checkpoint_dir
+
+        # Defined later
+        self.accumulators = None
+        self.train_function = None
+
+    def _create_accumulators(self) -> None:
+        import tensorflow as tf
+        # One gradient accumulator per trainable variable, local to each replica
+        self.accumulators = [tf.Variable(tf.zeros_like(variable),
+                                         trainable=False,
+                                         synchronization=tf.VariableSynchronization.ON_READ,
+                                         aggregation=tf.VariableAggregation.SUM)
+                             for variable in self.model.trainable_variables]
+
+    def _micro_step(self,
+                    batch,
+                    apply_gradients: bool
+                    ) -> 'tf.Tensor':
+        import tensorflow as tf
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(batch)
+        variables = self.model.trainable_variables
+
+        with tf.GradientTape() as tape:
+            y_pred = self.model(x, training=True)
+            loss = self.model.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.model.losses)
+            scaled_loss = loss / self.accumulation_steps
+        gradients = tape.gradient(scaled_loss, variables)
+        self.model.compiled_metrics.update_state(y, y_pred, sample_weight)
+
+        if self.accumulation_steps == 1:
+            self.model.optimizer.apply_gradients([(gradient, variable)
+                                                  for gradient, variable in zip(gradients, variables)
+                                                  if gradient is not None])
+            return loss
+
+        for accumulator, gradient in zip(self.accumulators, gradients):
+            if gradient is not None:
+                accumulator.assign_add(gradient)
+
+        if apply_gradients:
+            self._apply_accumulated_gradients()
+        return loss
+
+    def _execution(self,
+                   batches: List,
+                   apply_pattern: Tuple[bool, ...]
+                   ) -> 'tf.Tensor':
+        """Several micro steps in one compiled function. apply_pattern tells after which batch gradients are applied"""
+        import tensorflow as tf
+        losses = [self._micro_step(batch, apply_gradients) for batch, apply_gradients in zip(batches, apply_pattern)]
+        return tf.reduce_mean(tf.stack(losses))
+
+    def _apply_accumulated_gradients(self) -> None:
+        import tensorflow as tf
+        self.model.optimizer.apply_gradients([(accumulator.read_value(), variable)
+                                              for accumulator, variable in zip(self.accumulators,
+                                                                               self.model.trainable_variables)])
+        for accumulator in self.accumulators:
+            accumulator.assign(tf.zeros_like(accumulator))
+
+    def _flush_accumulators(self) -> None:
+        """Apply the gradients of an incomplete accumulation group, at the end of an epoch"""
+        import tensorflow as tf
+        flush_function = tf.function(self._apply_accumulated_gradients)
+        if self.strategy is None:
+            flush_function()
+        else:
+            self.strategy.run(flush_function)
+
+    def _get_train_function(self):
+        import tensorflow as tf
+
+        if self.train_function is not None:
+            return self.train_function
+
+        replica_function = tf.function(self._execution, jit_compile=self.jit_compile, reduce_retracing=True)
+
+        if self.strategy is None:
+            self.train_function = replica_function
+        else:
+            strategy = self.strategy
+
+            @tf.function(reduce_retracing=True)
+            def distributed_function(batches, apply_pattern):
+                losses = strategy.run(replica_function, args=(batches, apply_pattern))
+                return strategy.reduce(tf.distribute.ReduceOp.SUM, losses, axis=None)
+
+            self.train_function = distributed_function
+
+        return self.train_function
+
+    def _get_apply_pattern(self,
+                           first_step: int,
+                           nb_batches: int,
+                           is_last_execution: bool
+                           ) -> Tuple[bool, ...]:
+        pattern = [(first_step + i + 1) % self.accumulation_steps == 0 for i in range(nb_batches)]
+        if is_last_execution:
+            # Do not carry accumulated gradients to the next epoch
+            pattern[-1] = True
+        return tuple(pattern)
+
+    @staticmethod
+    def _next_batches(iterator,
+                      nb_batches: int
+                      ) -> Tuple[List, bool]:
+        batches = []
+        for _ in range(nb_batches):
+            try:
+                batches.append(next(iterator))
+            except StopIteration:
+                return batches, True
+        return batches, False
+
+    def fit(self,
+            dataset: 'tf.data.Dataset',
+            validation_data: Union['tf.data.Dataset', None] = None,
+            epochs: int = 1,
+            callbacks: Union[List, None] = None
+            ) -> 'tf.keras.callbacks.History':
+        import tensorflow as tf
+        from bias_correction.train.checkpointing import ResumableCheckpoint, set_training_seed
+
+        set_training_seed(self.config)
+        if self.strategy is not None:
+            dataset = self.strategy.experimental_distribute_dataset(dataset)
+        if self.accumulation_steps > 1 and self.accumulators is None:
+            if self.strategy is not None:
+                with self.strategy.scope():
+                    self._create_accumulators()
+            else:
+                self._create_accumulators()
+
+        train_function = self._get_train_function()
+        writer = tf.summary.create_file_writer(self.log_dir) if self.log_dir is not None else None
+
+        callbacks = tf.keras.callbacks.CallbackList(callbacks,
+                                                    add_history=True,
+                                                    add_progbar=False,
+                                                    model=self.model,
+                                                    epochs=epochs,
+                                                    verbose=0)
+        self.model.stop_training = False
+        callbacks.on_train_begin()
+
+        initial_epoch, initial_step, global_step = 0, 0, 0
+        checkpoint = None
+        if self.checkpoint_dir is not None:
+            checkpoint = ResumableCheckpoint(self.model,
+                                             self.checkpoint_dir,
+                                             self.config,
+                                             accumulators=self.accumulators)
+            checkpoint.install_preemption_handler()
+            initial_epoch, initial_step, global_step = checkpoint.restore()
+
+        global_execution = 0
+        logs = {}
+        for epoch in range(initial_epoch, epochs):
+            self.model.reset_metrics()
+            callbacks.on_epoch_begin(epoch)
+
+            iterator = iter(dataset)
+            step = 0
+            if checkpoint is not None and epoch == initial_epoch and initial_step > 0:
+                checkpoint.restore_iterator(iterator)
+                step = initial_step
+            execution = 0
+            data_wait = []
+            compute = []
+            is_exhausted = False
+            # Gradients accumulated but not applied yet
+            is_pending = False
+            while not is_exhausted:
+                callbacks.on_train_batch_begin(execution)
+
+                t0 = time.perf_counter()
+                batches, is_exhausted = self._next_batches(iterator, self.steps_per_execution)
+                t1 = time.perf_counter()
+                if not batches:
+                    break
+
+                apply_pattern = self._get_apply_pattern(step, len(batches), is_exhausted)
+                loss = float(train_function(batches, apply_pattern))
+                t2 = time.perf_counter()
+                is_pending = self.accumulation_steps > 1 and not apply_pattern[-1]
+
+                data_wait.append(t1 - t0)
+                compute.append(t2 - t1)
+                step += len(batches)
+                global_step += len(batches)
+                if checkpoint is not None and checkpoint.should_save(step, len(batches)):
+                    checkpoint.save(epoch, step, global_step, iterator=iterator)
+
+                if writer is not None and global_execution % self.log_every_n_executions == 0:
+                    with writer.as_default(step=global_execution):
+                        tf.summary.scalar("step/data_wait_ms", 1000 * data_wait[-1] / len(batches))
+                        tf.summary.scalar("step/compute_ms", 1000 * compute[-1] / len(batches))
+                        tf.summary.scalar("step/loss", loss)
+
+                callbacks.on_train_batch_end(execution, {"loss": loss})
+                execution += 1
+                global_execution += 1
+
+            if is_pending:
+                # The iterator was exhausted between two executions: the last group is incomplete
+                self._flush_accumulators()
+
+            logs = {metric.name: float(metric.result()) for metric in self.model.metrics}
+            if validation_data is not None:
+                val_logs = self.model.evaluate(validation_data, return_dict=True, verbose=0)
+                logs.update({f"val_{name}": value for name, value in val_logs.items()})
+
+            total_data_wait = np.sum(data_wait)
+            total_compute = np.sum(compute)
+            ratio_data_wait = total_data_wait / (total_data_wait + total_compute) if step else np.nan
+            if writer is not None:
+                with writer.as_default(step=epoch):
+                    tf.summary.scalar("epoch/data_wait_s", total_data_wait)
+                    tf.summary.scalar("epoch/compute_s", total_compute)
+                    tf.summary.scalar("epoch/data_wait_ratio", ratio_data_wait)
+                    tf.summary.scalar("epoch/steps_per_second", step / (total_data_wait + total_compute))
+                    for name, value in logs.items():
+                        tf.summary.scalar(f"epoch/{name}", value)
+                writer.flush()
+
+            print(f"Epoch {epoch + 1}/{epochs}: {step} steps, "
+                  f"data wait {total_data_wait:.1f}s ({100 * ratio_data_wait:.0f}%), compute {total_compute:.1f}s, "
+                  + ", ".join(f"{name}: {value:.4f}" for name, value in logs.items()), flush=True)
+
+            callbacks.on_epoch_end(epoch, logs)
+            if checkpoint is not None:
+                checkpoint.save(epoch + 1, 0, global_step)
+            if self.model.stop_training:
+                break
+
+        callbacks.on_train_end(logs)
+        return self.model.history
@@ -1,10 +1,6 @@
-import matplotlib
-
 from contextlib import contextmanager
 import os
 
-#matplotlib.use('Agg')
-
 
 def plot_1_1_subplot(df, key_obs="vw10m(m/s)", key_model="Wind", min_=-1, max_=30, s=1, figsize=(20,20)):
     import matplotlib.pyplot as plt
@@ -1,27 +1,22 @@
 import numpy as np
 import pandas as pd
-import matplotlib
-# matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib import cm as cm_plt
 
 import os
 import uuid
-from typing import Union, Tuple, Dict, MutableSequence
-from functools import partial
+import importlib.util
+from typing import Union, Tuple, Dict, MutableSequence, TYPE_CHECKING
 
-from bias_correction.utils_bc.decorators import pass_if_doesnt_has_module, pass_if_doesnt_have_seaborn_version
+from bias_correction.utils_bc.decorators import pass_if_doesnt_has_module
 from bias_correction.train.utils import create_folder_if_doesnt_exist
 from bias_correction.train.experience_manager import ExperienceManager
-from bias_correction.train.windrose import plot_windrose
-from bias_correction.train.ale import ale_plot
 
-try:
-    import seaborn as sns
+# matplotlib, seaborn, windrose and ale are imported inside the plotting functions,
+# so that evaluation modules can be imported without the plotting stack.
+if TYPE_CHECKING:
+    import matplotlib
+    from bias_correction.train.sketches import QuantileSketch
 
-    _sns = True
-except ModuleNotFoundError:
-    _sns = False
+_sns = importlib.util.find_spec("seaborn") is not None
 
 KEY2NEW_NAMES = {"_AROME": "$AROME_{forecast}$",
                  "_D": "DEVINE",
@@ -84,8 +79,9 @@ def _save_figure(name_figure: str,
                  save_path: str,
                  format_: str = "png",
                  svg: bool = False,
-                 fig: Union[None, matplotlib.figure.Figure] = None
+                 fig: Union[None, 'matplotlib.figure.Figure'] = None
                  ) -> None:
+    import matplotlib.pyplot as plt
     if fig is None:
         ax = plt.gca()
         fig = ax.get_figure()
@@ -101,7 +97,7 @@ def save_figure(name_figure: str,
                 save_path: str = None,
                 format_: str = "png",
                 svg: bool = False,
-                fig: Union[None, matplotlib.figure.Figure] = None
+                fig: Union[None, 'matplotlib.figure.Figure'] = None
                 ) -> None:
     exp_is_provided = exp is not None
     save_path_is_provided = save_path is not None
@@ -137,8 +133,10 @@ class StaticPlots:
                                   hue_order: Tuple[str] = ('Training', 'Test', 'Validation')
                                   ) -> None:
         """Pair plot parameters"""
+        import matplotlib.pyplot as plt
         if not _sns:
             raise ModuleNotFoundError("Seaborn is required for this function")
+        import seaborn as sns
         # Figure 1:
         stations = stations.rename(columns={"alti": "Elevation [m]",
                                             "tpi_500_NN_0": "TPI [m]",
@@ -161,8 +159,10 @@ class StaticPlots:
                                hue_order: Tuple[str] = ('Training', 'Test', 'Validation')
                                ) -> None:
         """Pair plot metrics"""
+        import matplotlib.pyplot as plt
         metric_computed = "rmse" in stations or "mbe" in stations or "corr" in stations or "mae" in stations
         assert metric_computed, "metrics (rmse, mbe, corr, mae) must be computed befor plotting this function"
+        import seaborn as sns
 
         stations = stations.rename(columns={"rmse": "Root mean squared Error [$m\:s^{-1}$]",
                                             "mbe": "Mean bias [$m\:s^{-1}$]",
@@ -188,6 +188,8 @@ class StaticPlots:
                           hue_order: Tuple[str] = ('Training', 'Test', 'Validation')
                           ) -> None:
         """Pair plot metrics and parameters"""
+        import matplotlib.pyplot as plt
+        import seaborn as sns
         stations = stations.rename(columns={"alti": "Elevation [m]",
                                             "tpi_500_NN_0": "TPI [m]",
                                             "mu_NN_0": "Slope []",
@@ -231,6 +233,8 @@ def plot_single_subplot(df: pd.DataFrame,
                         color: str = "C0",
                         print_: bool = False
                         ) -> None:
+    import matplotlib.pyplot as plt
+
     # Get values
     obs = df[key_obs].values
     model = df[key_model].values
@@ -313,7 +317,9 @@ def plot_single_1_1(df: pd.DataFrame,
                     fontsize: float = 20,
                     plot_text: bool = True,
                     print_=False
-                    ) -> Union[None, matplotlib.figure.Figure]:
+                    ) -> Union[None, 'matplotlib.figure.Figure']:
+    import matplotlib.pyplot as plt
+
     # Get values
     obs = df[key_obs].values
     model = df[key_model].values
@@ -362,6 +368,7 @@ def plot_single_1_1(df: pd.DataFrame,
         plt.ylabel(ylabel, fontsize=fontsize)
 
     if density:
+        import seaborn as sns
         sns.kdeplot(df, x=key_obs, y=key_model, color="black", ax=ax).set(xlim=(0), ylim=(0))
 
     # Text
@@ -386,6 +393,7 @@ def plot_1_1_multiple_subplots(df: pd.DataFrame,
                                color: Tuple[str] = ("C1", "C0", "C2", "C3", "C4"),
                                print_: bool = False
                                ) -> None:
+    import matplotlib.pyplot as plt
     plt.figure(figsize=figsize)
     nb_columns = len(keys_models)
     for idx, key in enumerate(keys_models):
@@ -420,10 +428,12 @@ class ModelVersusObsPlots:
                      print_: bool = False
                      ) -> None:
 
+        import matplotlib.pyplot as plt
         current_variable = self.exp.config['current_variable']
         key_obs = f"{current_variable}_obs"
         for idx, key in enumerate(keys):
             if _sns:
+                import seaborn as sns
                 sns.set_style("ticks", {'axes.grid': True})
             print("debug plot_1_1_all")
             print(list(df.columns))
@@ -450,6 +460,7 @@ class ModelVersusObsPlots:
                             figsize: Tuple[int, int] = (40, 10),
                             print_: bool = False
                             ) -> None:
+        import matplotlib.pyplot as plt
         current_variable = self.exp.config['current_variable']
         key_obs = f"{current_variable}_obs"
         for station in df["name"].unique():
@@ -478,6 +489,7 @@ def plot_evolution(df: pd.DataFrame,
                    errorbar: Union[str, None] = None,
                    alpha: float = 0.15
                    ) -> None:
+    import matplotlib.pyplot as plt
     if isinstance(groupby, list):
         groupby = groupby[0]
 
@@ -497,6 +509,7 @@ def plot_evolution(df: pd.DataFrame,
     dict_color = {key: value for key, value in zip(list(hue_names_to_plot), list(color))}
 
     if yerr:
+        import seaborn as sns
         if groupby not in df:
             df[groupby] = getattr(df.index, groupby)
         sns.lineplot(data=df, x=groupby, y="year", hue=hue_names_to_plot, errorbar=errorbar)
@@ -506,17 +519,123 @@ def plot_evolution(df: pd.DataFrame,
                                                                        ax=ax,
                                                                        alpha=alpha)
     if _sns:
+        import seaborn as sns
         sns.set_style("ticks", {'axes.grid': True})
 
     plt.xlabel(groupby.capitalize(), fontsize=fontsize)
     plt.ylabel(y_label_name.capitalize(), fontsize=fontsize)
 
 
-def _old_names2new_names(df, keys, key2old_name):
-    old2new_names = {key2old_name[key]: KEY2NEW_NAMES[key] for key in keys}
-    new_names: MutableSequence[str] = list(old2new_names.values())
-    df = df.rename(columns=old2new_names)
-    return df, new_names
+ALL_STATIONS = "all_stations"
+
+
+def compute_evolution_table(df: pd.DataFrame,
+                            metrics: Tuple[str, ...],
+                            keys: Tuple[str, ...],
+                            groupbys: Tuple[str, ...] = ("month", "lead_time"),
+                            by_station: bool = True
+                            ) -> pd.DataFrame:
+    """
+    Long-format table of the mean, standard deviation and number of values of each metric and model,
+    by station (ALL_STATIONS for all the stations) and by month, lead time...
+
+    Sums, sums of squares and counts are computed with a single groupby on the rows (station and all the groupbys),
+    then summed over the other groupbys, so that the plots only read slices of the table.
+    Index: (model, metric, name, groupby, x), e.g. ("_nn", "bias", ALL_STATIONS, "month", 1).
+    """
+    keys = ['_' + key.split('_')[-1] for key in keys]
+    pairs = [(metric, key) for metric in metrics for key in keys if f"{metric}{key}" in df]
+    columns = [f"{metric}{key}" for metric, key in pairs]
+
+    values = df[columns].astype(np.float64).reset_index(drop=True)
+    group_keys = [pd.Series(df[groupby].values if groupby in df else getattr(df.index, groupby), name=groupby)
+                  for groupby in groupbys]
+    group_keys.append(pd.Series(df["name"].values if by_station else ALL_STATIONS, index=values.index, name="name"))
+    stats = pd.concat({"sum": values, "sum_squares": values ** 2, "count": values.notna().astype(np.int64)}, axis=1)
+    stats = stats.groupby(group_keys, observed=True).sum()
+
+    list_df = []
+    for groupby in groupbys:
+        stats_groupby = [stats.groupby(level=["name", groupby]).sum()]
+        if by_station:
+            stats_all = stats.groupby(level=groupby).sum()
+            stats_all.index = pd.MultiIndex.from_product([[ALL_STATIONS], stats_all.index], names=["name", groupby])
+            stats_groupby.append(stats_all)
+        stats_groupby = pd.concat(stats_groupby)
+
+        for (metric, key), column in zip(pairs, columns):
+            count = stats_groupby[("count", column)].values
+            total = stats_groupby[("sum", column)].values
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mean = np.where(count > 0, total / count, np.nan)
+                variance = (stats_groupby[("sum_squares", column)].values - total * mean) / (count - 1)
+            list_df.append(pd.DataFrame({"model": key,
+                                         "metric": metric,
+                                         "name": stats_groupby.index.get_level_values("name"),
+                                         "groupby": groupby,
+                                         "x": stats_groupby.index.get_level_values(groupby),
+                                         "mean": mean,
+                                         "std": np.where(count > 1, np.sqrt(np.clip(variance, 0, None)), np.nan),
+                                         "count": count}))
+
+    return pd.concat(list_df, ignore_index=True).set_index(["model", "metric", "name", "groupby", "x"]).sort_index()
+
+
+def _get_error_band(rows: pd.DataFrame,
+                    errorbar: Union[str, Tuple[str, float]]
+                    ) -> np.ndarray:
+    """Half width of the error band, with the names of seaborn errorbar: "sd", "se" or "ci" (95%)"""
+    from statistics import NormalDist
+    method, level = errorbar if isinstance(errorbar, tuple) else (errorbar, None)
+    if method == "sd":
+        return rows["std"].values * (level or 1)
+    standard_error = rows["std"].values / np.sqrt(rows["count"].values)
+    if method == "se":
+        return standard_error * (level or 1)
+    if method == "ci":
+        return standard_error * NormalDist().inv_cdf(0.5 + (level or 95) / 200)
+    raise NotImplementedError(f"errorbar {errorbar} is not available with aggregated values")
+
+
+def plot_evolution_from_table(table: pd.DataFrame,
+                              models: Tuple[str, ...],
+                              metric: str,
+                              groupby: str = "month",
+                              station: str = ALL_STATIONS,
+                              names: Union[Dict[str, str], None] = None,
+                              fontsize: int = 15,
+                              figsize: Tuple[int, int] = (20, 15),
+                              color: Tuple[str, ...] = ("C1", "C0", "C2", "C3", "C4"),
+                              errorbar: Union[str, Tuple[str, float], None] = None,
+                              alpha: float = 0.15,
+                              print_: bool = False
+                              ) -> None:
+    """Same figure as plot_evolution, from a table of compute_evolution_table"""
+    import matplotlib.pyplot as plt
+    names = KEY2NEW_NAMES if names is None else names
+
+    plt.figure(figsize=figsize)
+    ax = plt.gca()
+    for model, color_model in zip(models, color):
+        try:
+            rows = table.loc[(model, metric, station, groupby)]
+        except KeyError:
+            continue
+        if print_:
+            print(f"model {model}, metric {metric}, station {station}, groupby {groupby}, "
+                  f"nb obs {rows['count'].sum()}")
+        ax.plot(rows.index, rows["mean"].values, color=color_model, label=names.get(model, model))
+        if errorbar is not None:
+            band = _get_error_band(rows, errorbar)
+            ax.fill_between(rows.index, rows["mean"].values - band, rows["mean"].values + band,
+                            color=color_model, alpha=alpha, linewidth=0)
+    ax.legend()
+    if _sns:
+        import seaborn as sns
+        sns.set_style("ticks", {'axes.grid': True})
+
+    plt.xlabel(groupby.capitalize(), fontsize=fontsize)
+    plt.ylabel(metric.capitalize(), fontsize=fontsize)
 
 
 class SeasonalEvolution:
@@ -527,7 +646,7 @@ class SeasonalEvolution:
         self.exp = exp
 
     def plot_seasonal_evolution(self,
-                                df: pd.DataFrame,
+                                df: Union[pd.DataFrame, None],
                                 metrics: Tuple[str, ...] = ("bias", "ae", "n_bias", "n_ae"),
                                 fontsize: int = 20,
                                 figsize: Tuple[int, int] = (20, 15),
@@ -537,42 +656,34 @@ class SeasonalEvolution:
                                 color: Tuple[str] = ("C1", "C0", "C2", "C3", "C4"),
                                 errorbar: Union[str, None] = None,
                                 yerr: Union[bool, None] = False,
-                                print_: bool = False
+                                print_: bool = False,
+                                table: Union[pd.DataFrame, None] = None
                                 ) -> None:
-
+        """table: output of compute_evolution_table, shared by the seasonal evolution and lead time plots"""
+        import matplotlib.pyplot as plt
         keys = ['_' + key.split('_')[-1] for key in keys]
+        if table is None:
+            table = compute_evolution_table(df, metrics, keys, groupbys=(groupby,), by_station=False)
+
         for metric in metrics:
-            key2old_name = {"_AROME": f"{metric}_AROME",
-                            "_D": f"{metric}_D",
-                            "_nn": f"{metric}_nn",
-                            "_int": f"{metric}_int",
-                            "_A": f"{metric}_A",
-                            }
-
-            df, new_names = _old_names2new_names(df, keys, key2old_name)
-
-            plot_evolution(df,
-                           hue_names_to_plot=tuple(new_names),
-                           y_label_name=metric,
-                           fontsize=fontsize,
-                           figsize=figsize,
-                           groupby=groupby,
-                           color=color,
-                           errorbar=errorbar,
-                           yerr=yerr,
-                           print_=print_)
-            if _sns:
-                sns.set_style("ticks", {'axes.grid': True})
+            plot_evolution_from_table(table,
+                                      models=tuple(keys),
+                                      metric=metric,
+                                      groupby=groupby,
+                                      fontsize=fontsize,
+                                      figsize=figsize,
+                                      color=color,
+                                      errorbar=errorbar if yerr else None,
+                                      print_=print_)
 
             ax = plt.gca()
             ax.tick_params(axis='both', which='major', labelsize=fontsize)
             plt.xlabel("Month", fontsize=fontsize)
             plt.ylabel(METRICS2NAMES[metric], fontsize=fontsize)
             save_figure(f"Seasonal_evolution/{name}", exp=self.exp, svg=True)
-            df = df.drop(columns=list(set(new_names)))
 
     def plot_seasonal_evolution_by_station(self,
-                                           df: pd.DataFrame,
+                                           df: Union[pd.DataFrame, None],
                                            metrics: Tuple[str, str, str, str] = ("bias", "ae", "n_bias", "n_ae"),
                                            keys: Tuple[str, ...] = ("UV_nn", "UV_AROME"),
                                            groupby: str = "month",
@@ -580,33 +691,29 @@ class SeasonalEvolution:
                                            figsize: Tuple[int, int] = (20, 15),
                                            name: str = "",
                                            color: Tuple[str] = ("C1", "C0", "C2", "C3", "C4"),
-                                           print_: bool = False
+                                           print_: bool = False,
+                                           table: Union[pd.DataFrame, None] = None
                                            ) -> None:
+        import matplotlib.pyplot as plt
         keys = ['_' + key.split('_')[-1] for key in keys]
-        for station in df["name"].unique():
-            df_copy = df.copy(deep=True)
-            for idx_metric, metric in enumerate(metrics):
-                key2old_name = {"_AROME": f"{metric}_AROME",
-                                "_D": f"{metric}_D",
-                                "_nn": f"{metric}_nn",
-                                "_int": f"{metric}_int",
-                                "_A": f"{metric}_A",
-                                }
-
-                df_copy, new_names = _old_names2new_names(df_copy, keys, key2old_name)
-
-                plot_evolution(df_copy[df_copy["name"] == station],
-                               hue_names_to_plot=tuple(set(new_names)),
-                               y_label_name=metric,
-                               fontsize=fontsize,
-                               figsize=figsize,
-                               groupby=groupby,
-                               color=color,
-                               print_=print_)
+        if table is None:
+            table = compute_evolution_table(df, metrics, keys, groupbys=(groupby,))
+
+        stations = table.index.get_level_values("name").unique()
+        for station in stations[stations != ALL_STATIONS]:
+            for metric in metrics:
+                plot_evolution_from_table(table,
+                                          models=tuple(keys),
+                                          metric=metric,
+                                          groupby=groupby,
+                                          station=station,
+                                          fontsize=fontsize,
+                                          figsize=figsize,
+                                          color=color,
+                                          print_=print_)
 
                 plt.title(station)
                 save_figure(f"Seasonal_evolution_by_station/Seasonal_evolution_{station}_{name}", exp=self.exp)
-                df_copy = df_copy.drop(columns=list(set(new_names)))
 
 
 class Leadtime:
@@ -617,7 +724,7 @@ class Leadtime:
         self.exp = exp
 
     def plot_lead_time(self,
-                       df: pd.DataFrame,
+                       df: Union[pd.DataFrame, None],
                        metrics: Tuple[str, ...] = ("bias", "ae"),  # ("bias", "ae", "n_bias", "n_ae")
                        keys: Tuple[str, ...] = ("UV_nn", "UV_AROME"),
                        groupby: str = "lead_time",
@@ -626,69 +733,57 @@ class Leadtime:
                        name: str = "Lead_time",
                        color: Tuple[str, ...] = ("C1", "C0", "C2", "C3", "C4"),
                        print_: bool = False,
-                       yerr: Union[bool, None] = False
+                       yerr: Union[bool, None] = False,
+                       errorbar: Union[str, None] = None,
+                       table: Union[pd.DataFrame, None] = None
                        ) -> None:
         keys = ['_' + key.split('_')[-1] for key in keys]
+        if table is None:
+            table = compute_evolution_table(df, metrics, keys, groupbys=(groupby,), by_station=False)
+
         for metric in metrics:
-            key2old_name = {"_AROME": f"{metric}_AROME",
-                            "_D": f"{metric}_D",
-                            "_nn": f"{metric}_nn",
-                            "_int": f"{metric}_int",
-                            "_A": f"{metric}_A",
-                            "_DA": f"{metric}_DA",
-                            }
-
-            df, new_names = _old_names2new_names(df, keys, key2old_name)
-
-            plot_evolution(df,
-                           hue_names_to_plot=tuple(set(new_names)),
-                           y_label_name=metric,
-                           fontsize=fontsize,
-                           figsize=figsize,
-                           groupby=groupby,
-                           color=color,
-                           yerr=yerr,
-                           print_=print_)
+            plot_evolution_from_table(table,
+                                      models=tuple(keys),
+                                      metric=metric,
+                                      groupby=groupby,
+                                      fontsize=fontsize,
+                                      figsize=figsize,
+                                      color=color,
+                                      errorbar=errorbar if yerr else None,
+                                      print_=print_)
 
             save_figure(f"Lead_time/{name}", exp=self.exp)
-            df = df.drop(columns=list(set(new_names)))
 
     def plot_lead_time_by_station(self,
-                                  df: pd.DataFrame,
+                                  df: Union[pd.DataFrame, None],
                                   metrics: Tuple[str, str, str, str] = ("bias", "ae", "n_bias", "n_ae"),
                                   keys: Tuple[str, ...] = ("UV_nn", "UV_AROME"),
                                   groupby: str = "lead_time",
                                   fontsize: int = 15,
                                   figsize: Tuple[int, int] = (20, 15),
-                                  color: Tuple[str] = ("C1", "C0", "C2", "C3", "C4")
+                                  color: Tuple[str] = ("C1", "C0", "C2", "C3", "C4"),
+                                  table: Union[pd.DataFrame, None] = None
                                   ) -> None:
         keys = ['_' + key.split('_')[-1] for key in keys]
-        for station in df["name"].unique():
-            df_copy = df.copy(deep=True)
+        if table is None:
+            table = compute_evolution_table(df, metrics, keys, groupbys=(groupby,))
+
+        stations = table.index.get_level_values("name").unique()
+        for station in stations[stations != ALL_STATIONS]:
             for metric in metrics:
-                key2old_name = {"_AROME": f"{metric}_AROME",
-                                "_D": f"{metric}_D",
-                                "_nn": f"{metric}_nn",
-                                "_int": f"{metric}_int",
-                                "_A": f"{metric}_A",
-                                }
-
-                df_copy, new_names = _old_names2new_names(df_copy, keys, key2old_name)
-
-                plot_evolution(df_copy[df_copy["name"] == station],
-                               hue_names_to_plot=tuple(set(new_names)),
-                               y_label_name=metric,
-                               fontsize=fontsize,
-                               figsize=figsize,
-                               groupby=groupby,
-                               color=color)
+                plot_evolution_from_table(table,
+                                          models=tuple(keys),
+                                          metric=metric,
+                                          groupby=groupby,
+                                          station=station,
+                                          fontsize=fontsize,
+                                          figsize=figsize,
+                                          color=color)
 
                 save_figure(f"Lead_time/Lead_time_{station}", exp=self.exp)
-                df_copy = df_copy.drop(columns=list(set(new_names)))
 
-    @pass_if_doesnt_have_seaborn_version()
     def plot_lead_time_shadow(self,
-                              df: pd.DataFrame,
+                              df: Union[pd.DataFrame, None],
                               metrics: Tuple[str, ...] = ("bias", "ae", "n_bias", "n_ae"),
                               list_x: Tuple[str, ...] = ("lead_time",),
                               dict_keys: Dict[str, str] = {"_nn": "Neural Network", "_AROME": "AROME"},
@@ -703,43 +798,27 @@ class Leadtime:
                               palette: Union[Tuple[str, ...], None] = ("C1", "C0", "C2", "C4"),
                               print_: bool = False,
                               errorbar: Union[str, Tuple[str, float], None] = None,
-                              fontsize: float = 15
+                              fontsize: float = 15,
+                              table: Union[pd.DataFrame, None] = None
                               ) -> None:
-        print("debug plot_lead_time_shadow")
-        for idx, metric in enumerate(metrics):
-            print(metric)
-            old_names = list(dict_keys.keys())
-            new_names = list(dict_keys.values())
-            if idx > 0:
-                df.drop(columns=new_names, inplace=True)
-            new_columns = {f"{metric}{old_name}": new_name for (old_name, new_name) in zip(old_names, new_names)}
-            df = df.rename(columns=new_columns)
+        import matplotlib.pyplot as plt
+        models = tuple(dict_keys.keys())
+        if table is None:
+            table = compute_evolution_table(df, metrics, models, groupbys=tuple(list_x), by_station=False)
 
+        for metric in metrics:
             for x in list_x:
-                print(x)
-                if x not in df:
-                    df[x] = getattr(df.index, x)
-                df_to_plot = df[["name"] + [x] + new_names]
-
-                if print_:
-                    print(f"carac {x}, metric {metric}, models_names {tuple(new_names)}, nb_obs {len(df)}")
-                df_melted = df_to_plot.melt(id_vars=["name", x],
-                                            value_vars=tuple(new_names),
-                                            var_name='Model',
-                                            value_name=metric.capitalize())
-                plt.figure(figsize=figsize)
+                plot_evolution_from_table(table,
+                                          models=models,
+                                          metric=metric,
+                                          groupby=x,
+                                          names=dict_keys,
+                                          fontsize=fontsize,
+                                          figsize=figsize,
+                                          color=tuple(f"C{idx}" for idx in range(len(models))),
+                                          errorbar=errorbar,
+                                          print_=print_)
                 ax = plt.gca()
-                sns.set_style("ticks", {'axes.grid': True})
-                print("debug")
-                print(errorbar)
-                try:
-                    sns.lineplot(data=df_melted, x=x, y=metric.capitalize(), hue="Model", errorbar=errorbar)
-                    print("debug executed")
-                    print("sns.lineplot(data=df_melted, x=x, y=metric.capitalize(), hue='Model', errorbar=errorbar)")
-                except:
-                    sns.lineplot(data=df_melted, x=x, y=metric.capitalize(), hue="Model")
-                    print("debug executed")
-                    print("sns.lineplot(data=df_melted, x=x, y=metric.capitalize(), hue='Model')")
                 plt.xlabel(CARAC2NAME[x], fontsize=fontsize)
                 plt.ylabel(METRICS2NAMES[metric], fontsize=fontsize)
                 ax.tick_params(axis='both', which='major', labelsize=fontsize)
@@ -763,6 +842,8 @@ def plot_boxplot_models(df: pd.DataFrame,
                         print_: bool = False,
                         fontsize: float = 20
                         ) -> None:
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     if print_:
         print(f"carac {carac}, metric {metric}, models_names {models_names}, nb_obs {len(df)}")
 
@@ -771,12 +852,11 @@ def plot_boxplot_models(df: pd.DataFrame,
                         var_name='Model',
                         value_name=metric.capitalize())
 
-    # e.g. replace "$x \leq q_{25}$" by "$Elevation \leq q_{25}$"
-    order_with_name = []
-    for value in order:
-        new_name = value.replace("x", CLASS2CARAC[carac])
-        df_melted.loc[df_melted[carac] == value, carac] = new_name
-        order_with_name.append(new_name)
+    # e.g. replace "$x \leq q_{25}$" by "$Elevation \leq q_{25}$" (classes are categorical: only labels are renamed)
+    order_with_name = [value.replace("x", CLASS2CARAC[carac]) for value in order]
+    classes = df_melted[carac].astype("category")
+    df_melted[carac] = classes.cat.rename_categories({value: new_name for value, new_name in zip(order, order_with_name)
+                                                      if value in classes.cat.categories})
 
     plt.figure(figsize=figsize)
     ax = plt.gca()
@@ -867,6 +947,35 @@ class WindRoses:
                  ) -> None:
         self.exp = exp
 
+    def get_wind_direction_tables(self,
+                                  df: pd.DataFrame,
+                                  keys: Tuple[str, ...],
+                                  metric: str,
+                                  bins: np.ndarray,
+                                  groupby: Union[str, None] = None,
+                                  nsector: int = 16,
+                                  normed: bool = True,
+                                  name: Union[str, None] = None
+                                  ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Windrose tables of all the groups (e.g. stations) and keys (e.g. "_AROME", "_nn") in one pass.
+
+        Returns the groups and a table of shape (nb_groups, nb_keys, len(bins), nsector), rendered with
+        windrose.plot_windrose_table. With name, the tables are also saved in {path_to_figures}/{name}.
+        """
+        from bias_correction.train.windrose import batched_histogram
+        direction = np.mod(df[[f"UV_DIR{key}" for key in keys]].values, 360)
+        var = df[[f"{metric}{key}" for key in keys]].values
+        groups = df[groupby].values if groupby is not None else None
+        uniques, _, _, table = batched_histogram(direction, var, groups, bins, nsector=nsector, normed=normed)
+
+        if name is not None and self.exp is not None:
+            path = os.path.join(self.exp.path_to_figures, name)
+            create_folder_if_doesnt_exist(path, _raise=False)
+            np.savez(os.path.join(path, f"windrose_tables_{metric}.npz"),
+                     groups=np.asarray(uniques, dtype=str), keys=np.asarray(keys), bins=bins, table=table)
+        return uniques, table
+
     def plot_wind_direction_all(self,
                                 df: pd.DataFrame,
                                 keys: Tuple[str, ...] = ('UV_DIR_AROME',
@@ -877,12 +986,15 @@ class WindRoses:
                                                          "UV_DIR_DA"),
                                 metrics: Tuple[str, ...] = ("abs_bias_direction",),
                                 name: str = "wind_direction_all",
-                                cmap: matplotlib.colors.ListedColormap = cm_plt.viridis,
+                                cmap: Union[str, 'matplotlib.colors.Colormap'] = "viridis",
                                 kind="bar",
                                 print_: bool = True,
                                 rmax: int = 13
                                 ):
 
+        import matplotlib.pyplot as plt
+        from bias_correction.train.windrose import plot_windrose_table
+        cmap = plt.get_cmap(cmap)
         keys = ['_' + key.split('_')[-1] for key in keys]
         for metric in metrics:
             if metric == "bias_direction":
@@ -890,22 +1002,23 @@ class WindRoses:
             else:
                 bins = np.arange(0, 150, 30)
 
-            for key in keys:
+            _, table = self.get_wind_direction_tables(df, keys, metric, bins)
+            for idx_key, key in enumerate(keys):
                 if print_:
                     print(f"metric: {metric}, key: {key}, nb of obs {len(df)}")
-                df[f'UV_DIR{key}'] = np.mod(df[f'UV_DIR{key}'], 360)
-                plot_windrose(df,
-                              var_name=f"{metric}{key}",
-                              direction_name=f"UV_DIR{key}",
-                              normed=True,
-                              rmax=rmax,
-                              kind=kind,
-                              bins=bins,
-                              cmap=cmap)
+                plot_windrose_table(table[0, idx_key],
+                                    bins=bins,
+                                    rmax=rmax,
+                                    kind=kind,
+                                    cmap=cmap)
                 plt.title(key)
                 save_figure(f"{name}/wind_direction_all_{metric}_{key}", exp=self.exp, svg=True)
 
-    def plot_wind_rose_for_observation(self, df_results, name="Wind_direction", cmap=cm_plt.get_cmap("plasma"), plot_by_station=False):
+    def plot_wind_rose_for_observation(self, df_results, name="Wind_direction", cmap="plasma", plot_by_station=False):
+        import matplotlib.pyplot as plt
+        from bias_correction.train.windrose import plot_windrose
+        cmap = plt.get_cmap(cmap)
+
         # Plot wind rose for observations
         speed_df = pd.read_pickle(os.path.join(self.exp.path_to_current_experience, f"df_results_UV.pkl"))
 
@@ -940,31 +1053,33 @@ class WindRoses:
                                                          'UV_DIR_A'),
                                 metrics: Tuple[str, ...] = ("abs_bias_direction",),
                                 name: str = "wind_direction_all",
-                                cmap: matplotlib.colors.ListedColormap = cm_plt.viridis,
+                                cmap: Union[str, 'matplotlib.colors.Colormap'] = "viridis",
                                 kind="bar",
                                 print_: bool = True,
                                 ):
 
-        for station in df["name"].unique():
-            keys = ['_' + key.split('_')[-1] for key in keys]
+        import matplotlib.pyplot as plt
+        from bias_correction.train.windrose import plot_windrose_table
+        cmap = plt.get_cmap(cmap)
+        keys = ['_' + key.split('_')[-1] for key in keys]
 
-            for metric in metrics:
-                if metric == "bias_direction":
-                    bins = np.arange(-100, 120, 20)
-                else:
-                    bins = np.arange(0, 150, 30)
+        for metric in metrics:
+            if metric == "bias_direction":
+                bins = np.arange(-100, 120, 20)
+            else:
+                bins = np.arange(0, 150, 30)
 
-                for key in keys:
+            # Tables of all stations and keys are computed at once, then only rendered
+            stations, table = self.get_wind_direction_tables(df, keys, metric, bins, groupby="name", name=name)
+            for idx_station, station in enumerate(stations):
+                for idx_key, key in enumerate(keys):
                     if print_:
-                        print(f"metric: {metric}, key: {key}, nb of obs {len(df)}")
-
-                    plot_windrose(df[df["name"] == station],
-                                  var_name=f"{metric}{key}",
-                                  direction_name=f"UV_DIR{key}",
-                                  normed=True,
-                                  kind=kind,
-                                  bins=bins,
-                                  cmap=cmap)
+                        print(f"metric: {metric}, key: {key}, station: {station}")
+
+                    plot_windrose_table(table[idx_station, idx_key],
+                                        bins=bins,
+                                        kind=kind,
+                                        cmap=cmap)
                     plt.title(key)
                     save_figure(f"{name}/{station}_{metric}_{key}", exp=self.exp, svg=True)
 
@@ -992,20 +1107,28 @@ class ALEPlot:
                  type_of_output="speed",
                  only_local_effects=False,
                  colors=None,
-                 fontsize=25):
+                 fontsize=25,
+                 budget_per_bin=None,
+                 batch_size=1024):
 
+        import matplotlib.pyplot as plt
+        from bias_correction.train.ale import ale_plot, ALEEngine
         df_inputs = data_loader.get_inputs(mode="test")
         cmap = plt.get_cmap(cmap, 3)
 
         if colors is None:
             colors = cmap(np.linspace(0, 1, 3))
 
-        predictor = partial(cm.predict_multiple_batches,
-                            model_version="last",
-                            batch_size=128,
-                            index_max=data_loader.get_length("test"),
-                            output_shape=(data_loader.get_length("test"),),
-                            force_build=False)
+        # ALE of all features are computed with one prediction stream
+        cm.select_model(model_version="last", print_=False)
+        engine = ALEEngine(data_loader,
+                           cm.model,
+                           mode="test",
+                           bins=bins,
+                           budget_per_bin=budget_per_bin,
+                           batch_size=batch_size,
+                           type_of_output=type_of_output)
+        results = engine.first_order(features, use_std=use_std, only_local_effects=only_local_effects)
 
         for feature in features:
             print(f"Feature: {feature}")
@@ -1027,13 +1150,13 @@ class ALEPlot:
                      color=color,
                      marker=marker,
                      markersize=markersize,
-                     predictor=predictor,
                      exp=exp,
                      use_std=use_std,
                      folder_name=folder_name,
                      type_of_output=type_of_output,
                      only_local_effects=only_local_effects,
-                     linewidth=linewidth)
+                     linewidth=linewidth,
+                     precomputed=results[feature])
             if ylim:
                 plt.ylim(ylim)
             ax = plt.gca()
@@ -1057,16 +1180,25 @@ class ALEPlot:
                                exp=None,
                                use_std=None,
                                type_of_output="speed",
-                               fontsize=25):
+                               fontsize=25,
+                               budget_per_bin=None,
+                               batch_size=1024):
+        import matplotlib.pyplot as plt
+        from bias_correction.train.ale import ale_plot, ALEEngine
         df_inputs = data_loader.get_inputs(mode="test")
         cmap = plt.get_cmap(cmap, 4)
         colors = cmap(np.linspace(0, 1, len(features)))
-        predictor = partial(cm.predict_multiple_batches,
-                            model_version="last",
-                            batch_size=128,
-                            index_max=data_loader.get_length("test"),
-                            output_shape=(data_loader.get_length("test"),),
-                            force_build=False)
+
+        # ALE of all pairs of features are computed with one prediction stream
+        cm.select_model(model_version="last", print_=False)
+        engine = ALEEngine(data_loader,
+                           cm.model,
+                           mode="test",
+                           bins=bins,
+                           budget_per_bin=budget_per_bin,
+                           batch_size=batch_size,
+                           type_of_output=type_of_output)
+        results = engine.second_order(features)
 
         for list_feature, color in zip(features, colors):
             print(f"Features: {list_feature}")
@@ -1080,12 +1212,12 @@ class ALEPlot:
                      color=color,
                      marker=marker,
                      markersize=markersize,
-                     predictor=predictor,
                      exp=exp,
                      use_std=use_std,
                      folder_name=folder_name,
                      type_of_output=type_of_output,
-                     linewidth=linewidth)
+                     linewidth=linewidth,
+                     precomputed=results[tuple(list_feature)])
             if ylim:
                 plt.ylim(ylim)
             ax = plt.gca()
@@ -1094,12 +1226,21 @@ class ALEPlot:
             save_figure(f"{folder_name}/ale_two_variables_{list_feature[0]}_{list_feature[1]}", exp=self.exp, svg=True)
 
 
+def _get_quantiles(values, percs):
+    """Percentiles of an array, or of a QuantileSketch (no need to keep all the values in memory)"""
+    if hasattr(values, "quantile") and not isinstance(values, (pd.Series, pd.DataFrame)):
+        return values.quantile(percs / 100)
+    return np.percentile(values, percs)
+
+
 def qq_plot(obs, model, nb_point=10_000, marker="x", linestyle="-", markersize=5, color="C0", color_1_1="red",
             linewidth=2, ax=None):
+    """obs and model are arrays of values or QuantileSketch (see train/sketches.py)"""
+    import matplotlib.pyplot as plt
     # quantiles
     percs = np.round(np.linspace(0, 100, nb_point), 2)
-    qn_obs = np.percentile(obs, percs)
-    qn_model = np.percentile(model, percs)
+    qn_obs = _get_quantiles(obs, percs)
+    qn_model = _get_quantiles(model, percs)
 
     # QQ-plot
     ax.plot(qn_obs, qn_model, linestyle=linestyle, linewidth=linewidth, marker=marker, markersize=markersize,
@@ -1138,6 +1279,7 @@ class QQplot:
                   ax=None
                   ) -> None:
 
+        import matplotlib.pyplot as plt
         if ax is None:
             plt.figure(figsize=figsize)
             ax = plt.gca()
@@ -1182,6 +1324,7 @@ class QQplot:
                   ax=None
                   ) -> None:
 
+        import matplotlib.pyplot as plt
         if ax is None:
             plt.figure(figsize=figsize)
             ax = plt.gca()
@@ -1230,6 +1373,44 @@ class QQplot:
         plt.tight_layout()
         save_figure(f"QQ_plot/qq_plot_double", exp=self.exp)
 
+    def qq_sketches(self,
+                    sketches: Dict[str, 'QuantileSketch'],
+                    key_obs: str = "obs",
+                    figsize: Tuple[int, int] = (15, 10),
+                    nb_point: int = 1_000,
+                    markersize: int = 2,
+                    color_1_1="red",
+                    fontsize=20,
+                    linewidth=2,
+                    name_figure: str = "qq_plot_sketches",
+                    ax=None
+                    ) -> None:
+        """QQ plot of each model against the observations from quantile sketches (e.g. StreamingEvaluation)"""
+        import matplotlib.pyplot as plt
+        if ax is None:
+            plt.figure(figsize=figsize)
+            ax = plt.gca()
+
+        models = [key for key in sketches if key != key_obs]
+        for idx, key in enumerate(models):
+            qq_plot(obs=sketches[key_obs],
+                    model=sketches[key],
+                    nb_point=nb_point,
+                    color=f"C{idx}",
+                    marker="x",
+                    markersize=markersize,
+                    linewidth=linewidth,
+                    color_1_1=color_1_1,
+                    ax=ax)
+
+        plt.grid(visible=True)
+        plt.xlabel("Observed wind speed [$m\:s^{-1}$]", fontsize=fontsize)
+        plt.ylabel("Modeled wind speed [$m\:s^{-1}$]", fontsize=fontsize)
+        plt.legend([KEY2NEW_NAMES.get("_" + key.split("_")[-1], key) for key in models], fontsize=fontsize)
+        ax.tick_params(axis='both', which='major', labelsize=fontsize)
+        plt.tight_layout()
+        save_figure(f"QQ_plot/{name_figure}", exp=self.exp)
+
 
 class VizualizationResults(Boxplots,
                            Leadtime,
@@ -312,8 +312,13 @@ class WindroseAxes(PolarAxes):
         # self.clear()
         kwargs.pop("zorder", None)
 
+        # Table precomputed by batched_histogram: direction and var are not used
+        table = kwargs.pop("table", None)
+
         # Init of the bins array if not set
         bins = kwargs.pop("bins", None)
+        if table is not None and (bins is None or isinstance(bins, int)):
+            raise ValueError("bins must be the sequence used to compute the table")
         if bins is None:
             bins = np.linspace(np.min(var), np.max(var), 6)
         if isinstance(bins, int):
@@ -346,6 +351,15 @@ class WindroseAxes(PolarAxes):
         normed = kwargs.pop("normed", False)
         blowto = kwargs.pop("blowto", False)
 
+        if table is not None:
+            kwargs.pop("normed", None)
+            kwargs.pop("blowto", None)
+            kwargs.pop("calm_limit", None)
+            self._info["dir"] = _get_dir_edges(nsector)
+            self._info["bins"] = bins.tolist() + [np.inf]
+            self._info["table"] = np.asarray(table, dtype=np.float64)
+            return bins, nbins, nsector, colors, angles, kwargs
+
         # Calm condition
         calm_limit = kwargs.pop("calm_limit", None)
         if calm_limit is not None:
@@ -762,6 +776,90 @@ def histogram(direction, var, bins, nsector, normed=False, blowto=False):
     return dir_edges, var_bins, table
 
 
+def _get_dir_edges(nsector):
+    angle = 360.0 / nsector
+    dir_edges = np.arange(-angle / 2, 360.0 + angle, angle, dtype=float).tolist()
+    dir_edges.pop(-1)
+    dir_edges[0] = dir_edges.pop(-1)
+    return dir_edges
+
+
+def batched_histogram(direction, var, groups, bins, nsector=16, normed=False, blowto=False, clean_flag=True):
+    """
+    Windrose tables of many groups (e.g. stations) and many variables (e.g. models) in one pass.
+
+    Speeds and directions are converted to integer bins, combined into a flat index and counted with np.bincount.
+    Each table is the same as histogram(direction, var, bins, nsector, normed, blowto) computed on the rows of a
+    group and a column of var, after clean (var == 0 and NaN removed) if clean_flag.
+    Parameters
+    ----------
+    direction : 2D array (n, nb_models), or 1D array (n,) shared by all the columns of var
+        directions the wind blows from, North centred
+    var : 2D array (n, nb_models) or 1D array (n,)
+        values of the variable to compute. Typically the wind speeds or errors
+    groups : 1D array (n,) or None
+        group of each row (None: a single group)
+    bins : 1D array
+        list of var category against we're going to compute the table
+    Returns
+    -------
+    uniques : groups, in the order of the first axis of table
+    dir_edges, var_bins : as returned by histogram
+    table : array of shape (nb_groups, nb_models, len(bins), nsector)
+    """
+    import pandas as pd
+
+    var = np.asarray(var, dtype=np.float64)
+    var = var.reshape(len(var), -1)
+    direction = np.asarray(direction, dtype=np.float64)
+    direction = np.broadcast_to(direction.reshape(len(direction), -1), var.shape)
+    bins = np.asarray(bins, dtype=np.float64)
+    nbins = len(bins)
+    nb_models = var.shape[1]
+
+    if groups is None:
+        codes = np.zeros(len(var), dtype=np.int64)
+        uniques = np.array([None])
+    else:
+        codes, uniques = pd.factorize(np.asarray(groups))
+    codes = np.broadcast_to(codes.reshape(-1, 1), var.shape)
+
+    if blowto:
+        direction = np.mod(direction + 180.0, 360.0)
+
+    # Same intervals as histogram: [bins[i], bins[i + 1]) and [bins[-1], inf]
+    # for speeds, and sectors centred on the North for directions (values in [0, 360 + angle / 2])
+    angle = 360.0 / nsector
+    var_index = np.searchsorted(bins, var, side="right") - 1
+    sector = np.floor((direction + angle / 2) / angle).astype(np.int64) % nsector
+    valid = (codes >= 0) & (var_index >= 0) & np.isfinite(var) & np.isfinite(direction)
+    valid &= (direction >= 0) & (direction <= 360.0 + angle / 2)
+    if clean_flag:
+        valid &= var != 0
+
+    model_index = np.broadcast_to(np.arange(nb_models), var.shape)
+    flat_index = ((codes * nb_models + model_index) * nbins + var_index) * nsector + sector
+    shape = (len(uniques), nb_models, nbins, nsector)
+    table = np.bincount(flat_index[valid], minlength=int(np.prod(shape))).reshape(shape).astype(np.float64)
+
+    if normed:
+        total = table.sum(axis=(2, 3), keepdims=True)
+        table = np.divide(table * 100, total, out=np.zeros_like(table), where=total > 0)
+
+    return uniques, _get_dir_edges(nsector), bins.tolist() + [np.inf], table
+
+
+def plot_windrose_table(table, bins, kind="bar", rmax=None, ax=None, figsize=FIGSIZE_DEFAULT, **kwargs):
+    """Plot a windrose from a table of batched_histogram (shape (len(bins), nsector))"""
+    if kind not in ["bar", "box", "contour", "contourf"]:
+        raise Exception(f"kind={kind!r} but it must be in ['bar', 'box', 'contour', 'contourf']")
+    table = np.asarray(table)
+    ax = WindroseAxes.from_ax(ax, rmax=rmax, figsize=figsize)
+    getattr(ax, kind)(None, None, table=table, bins=bins, nsector=table.shape[-1], **kwargs)
+    ax.set_legend()
+    return ax
+
+
 @docstring.copy(WindroseAxes.contour)
 def wrcontour(direction, var, ax=None, rmax=None, figsize=FIGSIZE_DEFAULT, **kwargs):
     """
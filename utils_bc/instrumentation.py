@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+import os
+import json
+import time
+import functools
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Union
+
+try:
+    import resource
+
+    _resource = True
+except ModuleNotFoundError:
+    _resource = False
+
+
+def get_memory_high_water_mb() -> float:
+    """Peak resident memory of the process (NaN if not available on this platform)"""
+    if not _resource:
+        return np.nan
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Profiler:
+    """
+    Nested timers, counters and memory high-water marks.
+
+    Timers opened inside other timers are recorded with their full path (e.g. "fit/epoch"), so that
+    the same stage can be compared between experiences. Records are exported to JSON or CSV.
+    """
+
+    def __init__(self) -> None:
+        self.records = []
+        self.counters = defaultdict(float)
+        self._stack = []
+
+    def reset(self) -> None:
+        self.records = []
+        self.counters = defaultdict(float)
+        self._stack = []
+
+    @contextmanager
+    def timer(self,
+              name: str
+              ):
+        self._stack.append(name)
+        path = "/".join(self._stack)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - t0
+            self._stack.pop()
+            self.records.append({"path": path,
+                                 "name": name,
+                                 "depth": len(self._stack),
+                                 "duration_s": duration,
+                                 "memory_high_water_mb": get_memory_high_water_mb(),
+                                 "end_time": time.time()})
+
+    def count(self,
+              name: str,
+              value: float = 1
+              ) -> None:
+        self.counters[name] += value
+
+    def summary(self) -> pd.DataFrame:
+        """One row per timer path: number of calls, total, mean and max durations, memory high-water mark"""
+        columns = ["path", "calls", "total_s", "mean_s", "max_s", "memory_high_water_mb"]
+        if not self.records:
+            return pd.DataFrame(columns=columns)
+        df = pd.DataFrame(self.records)
+        df = df.groupby("path", sort=False).agg(calls=("duration_s", "size"),
+                                                total_s=("duration_s", "sum"),
+                                                mean_s=("duration_s", "mean"),
+                                                max_s=("duration_s", "max"),
+                                                memory_high_water_mb=("memory_high_water_mb", "max"))
+        return df.reset_index()[columns]
+
+    def to_dict(self) -> Dict:
+        return {"timers": self.summary().to_dict(orient="records"),
+                "counters": dict(self.counters),
+                "memory_high_water_mb": get_memory_high_water_mb()}
+
+    def save(self,
+             path: str,
+             name: str = "profiling"
+             ) -> None:
+        """Save {name}.json (timers, counters, memory) and {name}.csv (timers) in path"""
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, f"{name}.json"), "w") as f:
+            json.dump(self.to_dict(), f, indent=4, default=float)
+        self.summary().to_csv(os.path.join(path, f"{name}.csv"), index=False)
+
+
+# Profiler shared by the whole process
+profiler = Profiler()
+
+
+def profiled(name: Union[str, Callable, None] = None):
+    """
+    Record the duration of each call of the decorated function in the process profiler.
+
+    Usable as @profiled or @profiled("name").
+    """
+
+    def decorator(function):
+        timer_name = name if isinstance(name, str) else function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiler.timer(timer_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    if callable(name):
+        return decorator(name)
+    return decorator
+
+
+@contextmanager
+def tf_profiler_window(log_dir: Union[str, None],
+                       enabled: bool = True
+                       ):
+    """Trace the enclosed code with tf.profiler (visible in the TensorBoard profile tab)"""
+    if not enabled or log_dir is None:
+        yield
+        return
+    import tensorflow as tf
+    tf.profiler.experimental.start(log_dir)
+    try:
+        yield
+    finally:
+        tf.profiler.experimental.stop()
+
+
+def compare_profiles(paths: List[str],
+                     name: str = "profiling"
+                     ) -> pd.DataFrame:
+    """Total duration of each timer in several experiences (one column per experience)"""
+    list_df = []
+    for path in paths:
+        df = pd.read_csv(os.path.join(path, f"{name}.csv"))
+        list_df.append(df.set_index("path")["total_s"].rename(os.path.basename(os.path.normpath(path))))
+    return pd.concat(list_df, axis=1)
@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import subprocess
+from typing import List, MutableSequence, Union
+
+
+def get_tf_config(nb_workers: int,
+                  index: int,
+                  host: str = "localhost",
+                  base_port: int = 12345
+                  ) -> str:
+    """TF_CONFIG of the worker index in a cluster of nb_workers processes on the same host"""
+    workers = [f"{host}:{base_port + i}" for i in range(nb_workers)]
+    return json.dumps({"cluster": {"worker": workers},
+                       "task": {"type": "worker", "index": index}})
+
+
+def get_task_index() -> int:
+    """Index of this worker: task index of TF_CONFIG, else Slurm rank, else 0"""
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    if tf_config.get("task"):
+        return int(tf_config["task"].get("index", 0))
+    return int(os.environ.get("SLURM_PROCID", 0))
+
+
+def is_chief(config: Union[dict, None] = None) -> bool:
+    """
+    True if this process is the chief of a MultiWorkerMirroredStrategy cluster (worker 0), or is not distributed.
+
+    Only the chief writes the experience (folders, registry, models). The other workers still call the save
+    functions, which are collective, but write to a temporary directory.
+    """
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    if tf_config.get("task"):
+        task_type = tf_config["task"].get("type", "worker")
+        has_chief = "chief" in tf_config.get("cluster", {})
+        return task_type == "chief" or (not has_chief and task_type == "worker" and get_task_index() == 0)
+    if config is not None and config.get("distribution_strategy") == "MirroredStrategy":
+        return get_task_index() == 0
+    return True
+
+
+def launch_local_workers(script: str,
+                         nb_workers: int,
+                         args: MutableSequence[str] = (),
+                         base_port: int = 12345,
+                         cpu_only: bool = True,
+                         threads_per_worker: Union[int, None] = None
+                         ) -> List[int]:
+    """
+    Spawn nb_workers processes running the script on this machine and wait for them.
+
+    Each process gets its TF_CONFIG, so that a config with distribution_strategy="MirroredStrategy",
+    cluster_resolver="tf_config" and communication_implementation="RING" (or "AUTO") trains
+    with MultiWorkerMirroredStrategy without Slurm. Only worker 0 (the chief, see is_chief) writes the experience.
+
+    :return: exit code of each worker
+    """
+    processes = []
+    for index in range(nb_workers):
+        env = dict(os.environ)
+        env["TF_CONFIG"] = get_tf_config(nb_workers, index, base_port=base_port)
+        if cpu_only:
+            env["CUDA_VISIBLE_DEVICES"] = ""
+        if threads_per_worker is not None:
+            env["TF_NUM_INTRAOP_THREADS"] = str(threads_per_worker)
+            env["OMP_NUM_THREADS"] = str(threads_per_worker)
+        print(f"Launch worker {index}/{nb_workers}: {script}", flush=True)
+        processes.append(subprocess.Popen([sys.executable, script, *args], env=env))
+
+    exit_codes = [process.wait() for process in processes]
+    for index, exit_code in enumerate(exit_codes):
+        print(f"Worker {index} exited with code {exit_code}", flush=True)
+    return exit_codes
+
+
+if __name__ == "__main__":
+    # python local_launcher.py nb_workers script.py [script arguments]
+    exit_codes = launch_local_workers(sys.argv[2], int(sys.argv[1]), args=sys.argv[3:])
+    sys.exit(max(exit_codes, default=0))
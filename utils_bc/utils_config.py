@@ -1,4 +1,5 @@
 import numpy as np
+import os
 
 
 def assert_input_for_skip_connection(config):
@@ -39,11 +40,25 @@ def sort_input_variables(config):
     return config
 
 
+def set_cuda_visible_devices(visible_devices="0"):
+    """Must be called before Tensorflow lists or initializes the GPUs"""
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"  # see issue #152
+    # An empty value hides the GPUs on purpose (e.g. CPU workers spawned by local_launcher)
+    if os.environ.get("CUDA_VISIBLE_DEVICES") == "":
+        return
+    os.environ["CUDA_VISIBLE_DEVICES"] = visible_devices
+
+
 def adapt_distribution_strategy_to_available_devices(config):
+    set_cuda_visible_devices()
     import tensorflow as tf
 
     no_gpu_available = not tf.config.list_physical_devices('GPU')
-    gpu_distribution_strategy_is_specified = config["distribution_strategy"] is not None
+    # MirroredStrategy with RING or AUTO communications also runs on CPU
+    cpu_distribution_strategy_is_specified = config["distribution_strategy"] == "MirroredStrategy" \
+        and config.get("communication_implementation", "NCCL") != "NCCL"
+    gpu_distribution_strategy_is_specified = config["distribution_strategy"] is not None \
+        and not cpu_distribution_strategy_is_specified
 
     if gpu_distribution_strategy_is_specified and no_gpu_available:
         config["distribution_strategy"] = None